@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import logging
+import random
+import time
+
+from referencesrv import app
+from referencesrv.resolver.common import Evidences, Hypothesis, NoSolution, sorted2
+from referencesrv.resolver.solve import sort_scored, choose_solution
+
+"""
+benchmark making, sorting and choosing among the evidences of the candidates of a hypothesis,
+the path every solr response goes through after the records are scored
+
+the evidences are made up, -c candidates per response, with the labels and values the scoring
+functions give
+"""
+
+LABELS = ['authors', 'year', 'pub', 'volume', 'page', 'title']
+VALUES = [1, 1, 1, 0.8, 0.5, 0.3, 0, 0, -0.5, -1]
+
+
+def make_scored(num_candidates):
+    """
+    returns the made up scored candidates of a response
+
+    :param num_candidates:
+    :return:
+    """
+    scored = []
+    for i in range(num_candidates):
+        evidences = Evidences()
+        for label in LABELS:
+            evidences.add_evidence(random.choice(VALUES), label)
+        scored.append((evidences, {'bibcode': '2000ApJ...%3d..%3dX' % (random.randint(100, 999), i)}))
+    return scored
+
+
+def choose(responses, sort):
+    """
+    sorts the candidates of each response and chooses among them
+
+    :param responses:
+    :param sort: function sorting the scored candidates
+    :return: number of responses resolved
+    """
+    hypothesis = Hypothesis('benchmark', {}, None)
+    num_resolved = 0
+    for scored in responses:
+        try:
+            choose_solution(sort(scored), 'benchmark', hypothesis)
+            num_resolved += 1
+        except NoSolution:
+            pass
+    return num_resolved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark sorting and choosing among scored candidates')
+    parser.add_argument('-n', '--num_responses', type=int, default=2000, help='number of responses.')
+    parser.add_argument('-c', '--num_candidates', type=int, default=100, help='number of candidates in each response.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    application = app.create_app(REFERENCE_SERVICE_LIVE=False)
+    application.logger.setLevel(logging.CRITICAL)
+    with application.app_context():
+        start_time = time.time()
+        responses = [make_scored(args.num_candidates) for _ in range(args.num_responses)]
+        duration = (time.time() - start_time) * 1000
+        print('%-24s %6d responses of %4d candidates in %10.1f ms, %6.3f ms each' % (
+            'making evidences', args.num_responses, args.num_candidates, duration, duration / max(args.num_responses, 1)))
+        results = {}
+        for name, sort in [('sorted2, choose', lambda scored: list(sorted2(scored))),
+                           ('sort_scored, choose', sort_scored)]:
+            start_time = time.time()
+            results[name] = choose(responses, sort)
+            duration = (time.time() - start_time) * 1000
+            print('%-24s %6d responses of %4d candidates in %10.1f ms, %6.3f ms each' % (
+                name, args.num_responses, args.num_candidates, duration, duration / max(args.num_responses, 1)))
+        print('resolved: %s' % ', '.join('%s %d' % item for item in results.items()))
+    sys.exit(0)
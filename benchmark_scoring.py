@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import logging
+import random
+import time
+
+from referencesrv import app
+from referencesrv.resolver.common import Hypothesis, sorted2
+from referencesrv.resolver.scoring import get_score_for_input_fields
+from referencesrv.resolver.authors import get_author_matcher
+from referencesrv.resolver.columnar import get_numeric_evidences
+from referencesrv.resolver.solve import sort_scored
+
+"""
+benchmark scoring the candidates solr returns for a hypothesis, one at a time and with the
+year and volume evidences of all the candidates computed at once (see resolver/columnar.py),
+and check the evidences are the same
+
+the responses are made up, each of -c candidates, with years and volumes around the ones
+of the reference, as a query on author and year, or on bibstem and volume, returns them
+"""
+
+LAST_NAMES = ['Smith', 'Jones', 'Brown', 'Garcia', 'Miller', 'Davis', 'Martinez', 'Lopez', 'Wilson', 'Anderson',
+              'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin', 'Lee', 'Thompson', 'White', 'Harris', 'Clark']
+
+
+def make_response(num_candidates):
+    """
+    returns the candidates of a made up response, and the input fields of the reference
+
+    :param num_candidates:
+    :return:
+    """
+    year, volume, page = random.randint(1990, 2020), random.randint(100, 900), random.randint(1, 2000)
+    candidates = []
+    for i in range(num_candidates):
+        authors = ['%s, %s.' % (random.choice(LAST_NAMES), random.choice('ABCDEFGHJK'))
+                   for _ in range(random.choice([1, 2, 3, 5, 10, 50]))]
+        candidates.append({
+            'bibcode': '%dApJ...%3d.%4dX' % (year, volume, i),
+            'author_norm': authors, 'first_author_norm': authors[0],
+            'year': str(year + random.choice([-1, 0, 0, 0, 1])),
+            'volume': str(volume + random.choice([-12, -1, 0, 0, 0, 1, 7, 30])),
+            'page': str(page + random.randint(-3, 3)), 'page_range': '', 'issue': '', 'eid': None,
+            'pub': 'The Astrophysical Journal', 'pub_raw': 'The Astrophysical Journal, vol %d' % volume,
+            'bibstem': 'ApJ', 'title': 'On the stars %d' % i,
+            'doctype': random.choice(['article', 'article', 'inproceedings', 'book']),
+        })
+    input_fields = {'author': 'Smith, J.; Jones, K.', 'year': str(year), 'volume': str(volume), 'page': str(page),
+                    'pub': 'ApJ', 'refstr': 'Smith, J., Jones, K. %d, ApJ, %d, %d' % (year, volume, page)}
+    return candidates, input_fields
+
+
+def score(responses, columnar, sort):
+    """
+    scores the candidates of each response
+
+    :param responses:
+    :param columnar: compute the year and volume evidences at once
+    :param sort: function sorting the scored candidates
+    :return: list of the evidences of each response, in string form
+    """
+    results = []
+    for candidates, input_fields in responses:
+        hypothesis = Hypothesis('benchmark', {}, get_score_for_input_fields, input_fields=input_fields,
+                                normalized_authors='Smith, J; Jones, K',
+                                author_matcher=get_author_matcher('Smith, J; Jones, K'))
+        if columnar:
+            hypothesis.details['numeric_evidences'] = get_numeric_evidences(hypothesis, candidates)
+        scored = sort([(hypothesis.get_score(candidate, hypothesis), candidate) for candidate in candidates])
+        results.append(sorted(str(evidences) for evidences, _ in scored))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark scoring the candidates of a hypothesis')
+    parser.add_argument('-n', '--num_responses', type=int, default=200, help='number of responses to score.')
+    parser.add_argument('-c', '--num_candidates', type=int, default=100, help='number of candidates in each response.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    application = app.create_app(REFERENCE_SERVICE_LIVE=False)
+    # comparing the evidences of chapters logs an error for the empty ones
+    application.logger.setLevel(logging.CRITICAL)
+    with application.app_context():
+        responses = [make_response(args.num_candidates) for _ in range(args.num_responses)]
+        results = {}
+        for name, columnar, sort in [('one at a time, sorted2', False, lambda scored: list(sorted2(scored))),
+                                     ('one at a time', False, sort_scored),
+                                     ('columnar', True, sort_scored)]:
+            start_time = time.time()
+            results[name] = score(responses, columnar, sort)
+            duration = (time.time() - start_time) * 1000
+            print('%-24s %6d responses of %4d candidates in %10.1f ms, %6.3f ms each' % (
+                name, args.num_responses, args.num_candidates, duration, duration / max(args.num_responses, 1)))
+        identical = len(set(str(result) for result in results.values())) == 1
+        print('evidences identical: %s' % identical)
+    sys.exit(0 if identical else 1)
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys, os, io
+import argparse
+import copy
+import json
+import time
+
+import requests
+
+from referencesrv import app
+from referencesrv.resolver import solrquery
+from referencesrv.resolver.solrquery import Querier, decode_solr_response
+from referencesrv.resolver.solrtestdata import get_test_data
+
+"""
+benchmark decoding the responses of solr and massaging their documents, with json and with orjson,
+and check the documents are the same
+
+the responses are read from a file of recorded response bodies, one per line, or made up, of -r
+documents each, from the test data
+"""
+
+
+def make_body(num_rows):
+    """
+    returns the body of a made up response, of num_rows documents
+
+    :param num_rows:
+    :return:
+    """
+    body = get_test_data()
+    docs = body['response']['docs']
+    body['response']['docs'] = []
+    for i in range(num_rows):
+        doc = copy.deepcopy(docs[i % len(docs)])
+        doc['bibcode'] = '%s%04d' % (doc['bibcode'][:-4], i)
+        # mostly ascii, as the records are
+        doc['author'] = doc['author'] + [(u'Müller, Kläus %d' if j % 10 == 0 else u'Miller, Klaus %d') % j for j in range(i % 40)]
+        doc['author_norm'] = doc.get('author_norm', []) + [(u'Müller, K%d' if j % 10 == 0 else u'Miller, K%d') % j for j in range(i % 40)]
+        body['response']['docs'].append(doc)
+    body['response']['numFound'] = num_rows
+    return json.dumps(body, ensure_ascii=False).encode('utf-8')
+
+
+def make_response(body):
+    """
+    returns a response of requests holding body, as solr sends it
+
+    :param body: bytes
+    :return:
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response.encoding = 'utf-8'
+    response._content = body
+    return response
+
+
+def decode(querier, bodies, use_orjson):
+    """
+    decodes the responses and massages their documents, one response at a time, as the service does
+
+    :param querier:
+    :param bodies:
+    :param use_orjson:
+    :return: the documents of each response, in json, the time spent in ms, and the part of it decoding
+    """
+    results = []
+    duration = decoding = 0
+    for body in bodies:
+        start_time = time.time()
+        from_solr = decode_solr_response(make_response(body), use_orjson)
+        decoded_time = time.time()
+        docs = [querier.massage_solution(doc) for doc in from_solr['response']['docs']]
+        end_time = time.time()
+        decoding += decoded_time - start_time
+        duration += end_time - start_time
+        # not kept, so that the documents of the earlier responses are not there to be garbage collected
+        results.append(json.dumps(docs, sort_keys=True))
+    return results, duration * 1000, decoding * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark decoding the responses of solr')
+    parser.add_argument('-i', '--input', help='the path to a file of recorded response bodies, one per line.')
+    parser.add_argument('-n', '--num_responses', type=int, default=500, help='number of responses to make up.')
+    parser.add_argument('-r', '--num_rows', type=int, default=100, help='number of documents in each made up response.')
+    args = parser.parse_args()
+
+    if args.input:
+        with io.open(os.path.join(os.getcwd(), args.input), 'rb') as f:
+            bodies = [line.strip() for line in f if line.strip()]
+    else:
+        bodies = [make_body(args.num_rows) for _ in range(args.num_responses)]
+
+    if solrquery.orjson is None:
+        print('orjson is not installed, json is used either way')
+    application = app.create_app(REFERENCE_SERVICE_LIVE=False)
+    with application.test_request_context():
+        querier = Querier()
+        results = {}
+        for name, use_orjson in [('json', False), ('orjson', True)]:
+            results[name], duration, decoding = decode(querier, bodies, use_orjson)
+            print('%-8s %6d responses, %8.1f kB in %10.1f ms, %6.3f ms each, %6.3f ms of it decoding' % (
+                name, len(bodies), sum(len(body) for body in bodies) / 1024.0, duration,
+                duration / max(len(bodies), 1), decoding / max(len(bodies), 1)))
+        identical = results['json'] == results['orjson']
+        print('documents identical: %s' % identical)
+    sys.exit(0 if identical else 1)
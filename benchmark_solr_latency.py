@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import logging
+import random
+import time
+
+from referencesrv import app
+from referencesrv.metrics import counters
+from referencesrv.resolver.common import SolrTimeout
+from referencesrv.resolver.solrquery import Querier
+from referencesrv.resolver.solrtestdata import FakeSolr
+
+"""
+benchmark the requests to a local fake solr that answers a fraction of them slowly, as a slow replica
+does, with the fixed timeout and no hedging, and with the timeout and the hedging delay derived from
+the observed latencies (see resolver/latency.py), and report the percentiles of the time to a response
+
+the first -w requests of each run are sent to observe the latencies, and not reported
+"""
+
+
+def run(querier, num_requests, num_warmup):
+    """
+    sends the requests, and returns the time each took, in ms, after the warmup, and the number timed out
+
+    :param querier:
+    :param num_requests:
+    :param num_warmup:
+    :return:
+    """
+    params = querier.make_params('author:("Accomazzi, A") AND year:"2019" AND bibstem:(AAS)')
+    durations = []
+    num_timeouts = 0
+    for i in range(num_warmup + num_requests):
+        start_time = time.time()
+        try:
+            querier.send(params)
+        except SolrTimeout:
+            num_timeouts += 1 if i >= num_warmup else 0
+        if i >= num_warmup:
+            durations.append((time.time() - start_time) * 1000)
+    return sorted(durations), num_timeouts
+
+
+def percentile(durations, percent):
+    """
+
+    :param durations: sorted
+    :param percent:
+    :return:
+    """
+    return durations[min(int(len(durations) * percent / 100.0), len(durations) - 1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the requests to a fake solr with slow responses')
+    parser.add_argument('-n', '--num_requests', type=int, default=1000, help='number of requests reported.')
+    parser.add_argument('-w', '--num_warmup', type=int, default=200, help='number of requests sent first.')
+    parser.add_argument('-f', '--fast', type=float, default=0.005, help='delay in seconds of most responses.')
+    parser.add_argument('-s', '--slow', type=float, default=0.5, help='delay in seconds of the slow responses.')
+    parser.add_argument('-p', '--slow_fraction', type=float, default=0.02, help='fraction of the responses that are slow.')
+    args = parser.parse_args()
+
+    random.seed(0)
+    fake_solr = FakeSolr(lambda: args.slow if random.random() < args.slow_fraction else args.fast * random.uniform(0.5, 1.5)).start()
+    try:
+        for name, config in [('fixed timeout', {'REFERENCE_SERVICE_SOLR_LATENCY_MIN_SAMPLES': sys.maxsize,
+                                                'REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE': None}),
+                             ('adaptive timeout', {'REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE': None}),
+                             ('adaptive, hedged', {})]:
+            application = app.create_app(REFERENCE_SERVICE_LIVE=True, REFERENCE_SERVICE_SOLRQUERY_URL=fake_solr.url,
+                                         REFERENCE_SERVICE_SOLR_MIN_TIMEOUT=0.05, **config)
+            application.logger.setLevel(logging.CRITICAL)
+            counters.reset()
+            with application.test_request_context():
+                durations, num_timeouts = run(Querier(), args.num_requests, args.num_warmup)
+            print('%-18s %6d requests, p50 %8.1f ms, p99 %8.1f ms, max %8.1f ms, %4d timed out, %4d hedged' % (
+                name, len(durations), percentile(durations, 50), percentile(durations, 99), durations[-1],
+                num_timeouts, counters.get('solr_hedged_requests')))
+    finally:
+        fake_solr.stop()
+    sys.exit(0)
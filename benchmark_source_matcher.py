@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys, os, io
+import argparse
+import random
+import time
+
+from referencesrv import app
+from referencesrv.resolver.sourcematchers import SOURCE_MATCHERS
+
+"""
+benchmark the source matchers head to head, and report how often they agree
+
+the pub strings are taken from the JOURNAL tokens of the training references (arxiv.raw),
+or from an input file, one pub string per line
+
+with -p, sources of the authority files are misspelled with one random edit, and the
+source matchers are scored on how often they recover the bibstem of the source
+"""
+
+training_file = os.path.dirname(__file__) + '/referencesrv/parser/training_files/arxiv.raw'
+
+
+def get_training_pub_strings():
+    """
+    collects the pub strings tagged in the training references
+
+    :return:
+    """
+    pub_strings = []
+    tokens = []
+    with io.open(training_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 2 and (parts[0] == 'JOURNAL' or (tokens and parts[0] == 'PUNCTUATION_DOT')):
+                tokens.append(parts[1].strip())
+                continue
+            if tokens:
+                pub_strings.append(' '.join(tokens).replace(' .', '.'))
+                tokens = []
+    return pub_strings
+
+
+def get_misspelled_sources(source_matcher, num_sources):
+    """
+    returns num_sources of (misspelled source, bibstem) taken from the authority files
+
+    :param source_matcher:
+    :param num_sources:
+    :return:
+    """
+    random.seed(0)
+    sources = sorted(source_matcher.source_dict.val_dict.items())
+    misspelled = []
+    for source, bibstems in random.sample(sources, min(num_sources, len(sources))):
+        i = random.randrange(len(source))
+        edit = random.choice(['delete', 'substitute', 'insert'])
+        char = random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+        if edit == 'delete':
+            source = source[:i] + source[i+1:]
+        elif edit == 'substitute':
+            source = source[:i] + char + source[i+1:]
+        else:
+            source = source[:i] + char + source[i:]
+        misspelled.append((source, bibstems))
+    return misspelled
+
+
+def get_best_bibstem(matches):
+    """
+    the bibstem of the best match, which is at the end of the list
+
+    :param matches:
+    :return:
+    """
+    if matches:
+        return matches[-1][1]
+    return None
+
+
+def run(source_matchers, pub_strings, num_best):
+    """
+    times matching pub_strings with each of source_matchers
+
+    :param source_matchers:
+    :param pub_strings:
+    :param num_best:
+    :return: dict of source matcher name to list of best bibstems
+    """
+    best = {}
+    for name, source_matcher in source_matchers.items():
+        start_time = time.time()
+        best[name] = [get_best_bibstem(source_matcher.bestmatches(pub.upper(), num_best)) for pub in pub_strings]
+        duration = (time.time() - start_time) * 1000
+        found = len([bibstem for bibstem in best[name] if bibstem])
+        print('%-10s %6d pub strings in %10.1f ms, %6.3f ms each, %6d matched' % (
+            name, len(pub_strings), duration, duration / max(len(pub_strings), 1), found))
+    return best
+
+
+def report_agreement(pub_strings, best, verbose):
+    """
+
+    :param pub_strings:
+    :param best:
+    :param verbose:
+    :return:
+    """
+    names = sorted(best)
+    for length, label in [(6, 'short (<= 6 characters)'), (None, 'all')]:
+        selected = [i for i, pub in enumerate(pub_strings) if length is None or len(pub) <= length]
+        agreed = [i for i in selected if len(set(best[name][i] for name in names)) == 1]
+        print('agreement on %-24s %6d of %6d' % (label, len(agreed), len(selected)))
+    if verbose:
+        for i, pub in enumerate(pub_strings):
+            if len(set(best[name][i] for name in names)) > 1:
+                print('%-40s %s' % (pub, '  '.join('%s=%s' % (name, best[name][i]) for name in names)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the source matchers and report their agreement')
+    parser.add_argument('-i', '--input', help='the path to input file containing list of pub strings, one per line.')
+    parser.add_argument('-p', '--perturbed', type=int, help='number of misspelled sources of the authority files to match.')
+    parser.add_argument('-n', '--num_best', type=int, default=1, help='number of best matches to ask for.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='list the pub strings the source matchers disagree on.')
+    args = parser.parse_args()
+
+    application = app.create_app(REFERENCE_SERVICE_LIVE=False)
+    with application.app_context():
+        source_matchers = {}
+        for name, source_matcher_class in sorted(SOURCE_MATCHERS.items()):
+            start_time = time.time()
+            source_matcher = source_matcher_class()
+            source_matchers[name] = source_matcher
+            print('%-10s built in %10.1f ms' % (name, (time.time() - start_time) * 1000))
+
+        if args.perturbed:
+            misspelled = get_misspelled_sources(source_matchers['trigdict'], args.perturbed)
+            pub_strings = [source for source, _ in misspelled]
+            best = run(source_matchers, pub_strings, args.num_best)
+            for name in sorted(best):
+                for length, label in [(6, 'short'), (None, 'all')]:
+                    selected = [(bibstems, bibstem) for (source, bibstems), bibstem in zip(misspelled, best[name])
+                                if length is None or len(source) <= length]
+                    correct = len([1 for bibstems, bibstem in selected if bibstem in bibstems])
+                    print('%-10s recovered the bibstem of %6d of %6d %s misspelled sources' % (name, correct, len(selected), label))
+        else:
+            if args.input:
+                with io.open(os.path.join(os.getcwd(), args.input), 'r', encoding='utf-8') as f:
+                    pub_strings = [line.strip() for line in f if line.strip()]
+            else:
+                pub_strings = get_training_pub_strings()
+            best = run(source_matchers, pub_strings, args.num_best)
+        report_agreement(pub_strings, best, args.verbose)
+    sys.exit(0)
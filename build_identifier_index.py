@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys, os, io
+import argparse
+import time
+
+from referencesrv import app
+from referencesrv.resolver.localindex import build_identifier_index, build_bibcode_index
+
+"""
+build the key file of a local index, by default the identifier index, from a bulk export of the identifiers of the records
+
+the export has one line per record, the bibcode followed by the identifiers of the record, tab separated,
+ie, the identifier field of solr; the doi, arXiv and ascl ids are indexed, the other identifiers are skipped
+
+with -b, the key file of the bibcode index is built instead, from a bulk export of the bibcodes of the
+records, one line per record, the bibcode followed by its alternate bibcodes, tab separated
+
+the key file is written next to the old one and renamed over it, set REFERENCE_SERVICE_IDENTIFIER_INDEX
+(REFERENCE_SERVICE_BIBCODE_INDEX) to its path, a worker opens it the first time it is needed, so restart
+the workers to pick up a new one
+
+the bibcode index is a snapshot, records added after it is built are not found by the fielded-bibcode
+hypotheses, but by the later ones, so rebuild it regularly
+"""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the local identifier index, or the bibcode index, from a bulk export')
+    parser.add_argument('-i', '--input', required=True, help='the path to input file containing the bibcode and identifiers (alternate bibcodes) of a record per line, - for stdin.')
+    parser.add_argument('-o', '--output', help='the path to the key file, REFERENCE_SERVICE_IDENTIFIER_INDEX (REFERENCE_SERVICE_BIBCODE_INDEX) if not given.')
+    parser.add_argument('-b', '--bibcodes', action='store_true', help='build the bibcode index from an export of the bibcodes.')
+    args = parser.parse_args()
+
+    application = app.create_app(REFERENCE_SERVICE_LIVE=False)
+    with application.app_context():
+        config_key = 'REFERENCE_SERVICE_BIBCODE_INDEX' if args.bibcodes else 'REFERENCE_SERVICE_IDENTIFIER_INDEX'
+        build_index = build_bibcode_index if args.bibcodes else build_identifier_index
+        filename = args.output or application.config[config_key]
+        if not filename:
+            print('no output file given, and %s is not set' % config_key)
+            sys.exit(1)
+        start_time = time.time()
+        if args.input == '-':
+            num_identifiers = build_index(io.open(sys.stdin.fileno(), 'r', encoding='utf-8'), filename)
+        else:
+            with io.open(os.path.join(os.getcwd(), args.input), 'r', encoding='utf-8') as f:
+                num_identifiers = build_index(f, filename)
+        print('indexed %d %s in %s in %.1f s' % (num_identifiers, 'bibcodes' if args.bibcodes else 'identifiers',
+                                                 filename, time.time() - start_time))
+    sys.exit(0)
@@ -11,14 +11,112 @@ SERVICE_TOKEN = None
 # these values can be overwritten by local_config values
 REFERENCE_SERVICE_SOLRQUERY_URL = "https://api.adsabs.harvard.edu/v1/search/query"
 REFERENCE_SERVICE_MAX_RECORDS_SOLR = 100
+# decode the responses of solr with orjson straight from the bytes of the body, if orjson is installed,
+# instead of decoding the body to a str and parsing it with json
+REFERENCE_SERVICE_SOLR_ORJSON = True
+# timeout, in seconds, of the requests to solr, until enough of them have been observed, and the upper
+# bound of the timeout derived from the observed p99 latency times the factor (see resolver/latency.py)
+# the p99 is of all the queries, the lower bound is for the expensive ones, ie, the bibcode or broad
+# author/year~ queries, that take much longer than most, a hypothesis whose query times out is dropped
+# (see the timeouts of each hypothesis in /metrics)
+REFERENCE_SERVICE_SOLR_TIMEOUT = 10
+REFERENCE_SERVICE_SOLR_MIN_TIMEOUT = 5
+REFERENCE_SERVICE_SOLR_TIMEOUT_FACTOR = 3
+# number of the latest requests to solr the latencies are kept of, and the number to observe
+# before the timeout and the hedging delay are derived from them
+REFERENCE_SERVICE_SOLR_LATENCY_WINDOW = 1000
+REFERENCE_SERVICE_SOLR_LATENCY_MIN_SAMPLES = 100
+# percentile of the observed latencies after which a duplicate of a request to solr still pending
+# is sent, and the first response used, None to not send any
+REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE = 95
+# number of threads in each worker the requests to solr are sent from when they are hedged
+REFERENCE_SERVICE_SOLR_HEDGE_THREADS = 32
+# circuit breaker around the requests to solr (see resolver/circuitbreaker.py), it opens when at least
+# the rate of the latest requests failed or took longer than the slow seconds, it then fails the requests
+# right away, and the references are answered from the cache only, for the open seconds, after which
+# the number of probes are let through, and it closes again if they all succeed
+REFERENCE_SERVICE_SOLR_BREAKER_WINDOW = 50
+REFERENCE_SERVICE_SOLR_BREAKER_MIN_REQUESTS = 20
+REFERENCE_SERVICE_SOLR_BREAKER_FAILURE_RATE = 0.5
+REFERENCE_SERVICE_SOLR_BREAKER_SLOW_SECONDS = 5
+REFERENCE_SERVICE_SOLR_BREAKER_OPEN_SECONDS = 30
+REFERENCE_SERVICE_SOLR_BREAKER_PROBES = 3
 
 REFERENCE_SERVICE_QUERY_FIELDS_SOLR = "author,[fields author=10]author_norm,[fields author_norm=10],first_author_norm," \
                                       "year,title,pub,pub_raw,aff_raw,[fields aff_raw=1]," \
                                       "volume,issue,page,page_range,bibstem,bibcode,identifier,doi,doctype"
 
+# how often, in seconds, each worker checks if a new version of the models (crf text model and
+# source matcher) has been published, to load it in the background and swap it in
+REFERENCE_SERVICE_MODEL_CHECK_INTERVAL = 60
+# number of versioned pickle files of each model to keep on disk
+REFERENCE_SERVICE_MODEL_VERSIONS_TO_KEEP = 3
+
+# request from solr only the fields the score function of a hypothesis declared it reads
+# (see score_fields in resolver/common.py), all of REFERENCE_SERVICE_QUERY_FIELDS_SOLR if False
+REFERENCE_SERVICE_FIELD_PROJECTION = True
+
+# for the hypotheses marked broad, that often overflow, count the documents matching first,
+# with a query returning no rows, and fetch them only if they do not overflow
+REFERENCE_SERVICE_COUNT_PROBE = False
+
+# the key file of the local index of the doi, arXiv and ascl ids of the records to their bibcodes,
+# built by build_identifier_index.py, the identifiers found in it are not queried in solr,
+# None to query solr for all of them
+REFERENCE_SERVICE_IDENTIFIER_INDEX = None
+
+# the key file of the local snapshot of the bibcodes of the records, built by build_identifier_index.py
+# with -b, the constructed bibcodes are matched in it, and the records matched fetched by their bibcodes,
+# instead of querying solr with the wildcards, None to query solr for all of them
+REFERENCE_SERVICE_BIBCODE_INDEX = None
+
+# evaluate the hypotheses that narrow down an earlier query of the same reference on the
+# documents that query returned, instead of querying solr again (see candidatepool.py)
+REFERENCE_SERVICE_CANDIDATE_POOL = True
+
+# compute the year and volume evidences of all the records solr returned for a hypothesis at once,
+# with numpy, instead of one record at a time (see resolver/columnar.py)
+REFERENCE_SERVICE_COLUMNAR_SCORING = True
+
+# score a record on the year, volume and page first, and skip comparing its authors, publication
+# and title when those already rule it out (see score_cheap_first in resolver/scoring.py)
+REFERENCE_SERVICE_LAZY_EVIDENCES = True
+
+# number of hypotheses of a reference, including the one being evaluated, with their solr
+# queries sent concurrently ahead of time, 1 to query one hypothesis at a time
+REFERENCE_SERVICE_SPECULATIVE_WINDOW = 3
+# maximum number of queries sent ahead of time for one reference
+REFERENCE_SERVICE_SPECULATIVE_BUDGET = 8
+# number of threads in each worker executing the queries sent ahead of time
+REFERENCE_SERVICE_SPECULATIVE_THREADS = 16
+
+# the order hypotheses are evaluated in (see resolver/ordering.py), either `fixed`, `learned` to try
+# first the hypothesis that most often resolved references of the same shape, or `shadow` to use
+# the fixed order and count how often the learned order would agree with it, note that in shadow
+# mode the queries of the learned order not answered from the candidate pool are sent to solr
+# as well, and add their round trips to the time each reference takes to resolve
+REFERENCE_SERVICE_HYPOTHESIS_ORDERING = 'fixed'
+# number of references of a shape to be resolved before the learned order is used for the shape
+REFERENCE_SERVICE_HYPOTHESIS_ORDERING_MIN_OBSERVATIONS = 100
+
+# query solr for the first round of hypotheses, the identifier lookups, of all the references
+# of a /text request at once (see resolver/batch.py)
+REFERENCE_SERVICE_BATCH_FIRST_ROUND = True
+# maximum number of conditions or-ed in one query of the first round
+REFERENCE_SERVICE_BATCH_QUERY_SIZE = 20
+
 # maximum references that can be resolved in one call
 REFERENCE_SERVICE_MAX_REFERENCE = 16
 
+# the source matcher used to match journal strings to bibstems, either
+# `trigdict` (trigram index) or `deldict` (deletion index, see pydeldict.py)
+REFERENCE_SERVICE_SOURCE_MATCHER = 'trigdict'
+
+# maximum journal strings that can be matched to bibstems in one call
+REFERENCE_SERVICE_MAX_BIBSTEM_QUERIES = 2000
+# number of bibstem candidates returned for each journal string
+REFERENCE_SERVICE_NUM_BIBSTEM_CANDIDATES = 5
+
 EVIDENCE_SCORE_RANGE = [-1,1]
 
 REFERENCE_SERVICE_STOP_WORDS = [
@@ -6,6 +6,7 @@ from flask_discoverer import Discoverer
 from adsmutils import ADSFlask
 
 from referencesrv.views import bp, redis_db, text_model
+from referencesrv.resolver.settings import make_settings, configure_settings
 
 def create_app(**config):
     """
@@ -22,6 +23,9 @@ def create_app(**config):
 
     Discoverer(app)
 
+    # the resolver reads its configuration from these, not from the app
+    configure_settings(make_settings(app.config, app.logger))
+
     with  app.app_context() as ac:
         text_model()
 
@@ -0,0 +1,140 @@
+"""
+This module keeps counters of the work done resolving references in this worker,
+for example the number of solr queries sent, and the queries of each hypothesis
+that overflowed, to be reported by the /metrics endpoint.
+"""
+
+import threading
+
+
+class Counters(object):
+    """
+    named counters, that can be incremented from multiple threads
+    """
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def increment(self, name, value=1):
+        """
+
+        :param name:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def get(self, name):
+        """
+
+        :param name:
+        :return:
+        """
+        with self.lock:
+            return self.counts.get(name, 0)
+
+    def to_dict(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.counts = {}
+
+
+# counters are kept per process
+counters = Counters()
+
+
+class HypothesisCounters(object):
+    """
+    the solr queries sent for each hypothesis, and how many of them overflowed or timed out
+    """
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        # hypothesis name -> counter name -> count
+        self.counts = {}
+
+    def record(self, hypothesis_name, overflowed, probed=False):
+        """
+        counts a query sent for the hypothesis
+
+        :param hypothesis_name:
+        :param overflowed: True if the query overflowed
+        :param probed: True if the documents were counted before being fetched
+        :return:
+        """
+        with self.lock:
+            hypothesis_counts = self.get_counts(hypothesis_name)
+            hypothesis_counts['solr_queries'] += 1
+            if overflowed:
+                hypothesis_counts['overflows'] += 1
+                if probed:
+                    hypothesis_counts['overflows_probed'] += 1
+
+    def record_timeout(self, hypothesis_name):
+        """
+        counts a query sent for the hypothesis that solr did not answer within the timeout,
+        the hypothesis was dropped
+
+        :param hypothesis_name:
+        :return:
+        """
+        with self.lock:
+            hypothesis_counts = self.get_counts(hypothesis_name)
+            hypothesis_counts['solr_queries'] += 1
+            hypothesis_counts['timeouts'] += 1
+
+    def get_counts(self, hypothesis_name):
+        """
+        returns the counters of the hypothesis, called with the lock held
+
+        :param hypothesis_name:
+        :return:
+        """
+        return self.counts.setdefault(hypothesis_name, {'solr_queries': 0, 'overflows': 0, 'overflows_probed': 0, 'timeouts': 0})
+
+    def to_dict(self):
+        """
+
+        :return: dict of hypothesis name to its counters, and the rate its queries overflowed
+        """
+        with self.lock:
+            return dict((name, dict(hypothesis_counts, overflow_rate=float(hypothesis_counts['overflows']) / hypothesis_counts['solr_queries']))
+                        for name, hypothesis_counts in self.counts.items())
+
+    def reset(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.counts = {}
+
+
+hypothesis_counters = HypothesisCounters()
+
+
+def get_memo_counters(functions):
+    """
+    returns the hits, misses and size of the memos of functions, memoized with lru_cache
+
+    :param functions:
+    :return: dict of function name to its counters
+    """
+    return dict((function.__name__, function.cache_info()._asdict()) for function in functions)
@@ -0,0 +1,404 @@
+"""
+This module keeps track of the versions of the models, the crf text model and the source matcher.
+
+A model is built by a background job into a versioned pickle file, the version being the digest of
+the files the model is built from, and then a pointer file next to it is atomically replaced to name
+the new version. Every worker checks the pointer files periodically, loads a new version in the
+background, and swaps it into current_app.extensions with a single assignment, so that a request
+sees either the old or the new model, never a half loaded one.
+
+"""
+
+import os
+import glob
+import time
+import threading
+import traceback
+from hashlib import md5
+
+from flask import current_app
+
+from referencesrv.parser.crf import create_text_model, load_text_model
+from referencesrv.resolver.sourcematchers import TrigdictSourceMatcher, create_source_matcher, load_source_matcher, \
+    update_source_matcher, source_matcher_pickle_file
+
+
+# separates the version a delta was applied on from the digest of the delta in the version of the model
+DELTA_SEPARATOR = '+'
+
+
+class ModelArtifact(object):
+    """
+    the versioned pickle files of one model
+
+    for the pickle file <path>/<name>.pkl, version v is saved in <path>/<name>-v.pkl and
+    the latest version is named in the pointer file <path>/<name>.version
+    """
+    def __init__(self, name, pickle_file, input_files, create_function, load_function, config_keys=()):
+        """
+
+        :param name: name of the model in current_app.extensions
+        :param pickle_file: the unversioned pickle file
+        :param input_files: files the model is built from, version is computed from their content
+        :param create_function: builds the model and saves it to the file passed in, returns None if it fails
+        :param load_function: loads the model from the file passed in, returns None if it fails
+        :param config_keys: configuration the model is built with, version is computed from their values as well
+        """
+        self.name = name
+        self.pickle_file = pickle_file
+        self.input_files = input_files
+        self.config_keys = config_keys
+        self.create_function = create_function
+        self.load_function = load_function
+        self.root, self.ext = os.path.splitext(pickle_file)
+        self.pointer_file = self.root + '.version'
+
+    def compute_version(self):
+        """
+        digest of the content of the input files and the configuration values
+
+        :return:
+        """
+        digest = md5()
+        for filename in self.input_files:
+            with open(filename, 'rb') as f:
+                digest.update(f.read())
+        for key in self.config_keys:
+            digest.update(('%s=%s'%(key, current_app.config[key])).encode('utf-8'))
+        return digest.hexdigest()[:12]
+
+    def get_filename(self, version):
+        """
+
+        :param version:
+        :return: the pickle file of the version, the unversioned one if version is None
+        """
+        if version is None:
+            return self.pickle_file
+        return '%s-%s%s'%(self.root, version, self.ext)
+
+    def get_delta_version(self, version, source_lines):
+        """
+        version of the model with the delta applied to version, made of the version the deltas were
+        applied on, and the digest of the delta
+
+        :param version:
+        :param source_lines: lines of the delta file
+        :return:
+        """
+        digest = md5(('%s\n%s' % (version, ''.join(source_lines))).encode('utf-8')).hexdigest()[:12]
+        return '%s%s%s' % (self.get_base_version(version) or '', DELTA_SEPARATOR, digest)
+
+    def get_base_version(self, version):
+        """
+
+        :param version:
+        :return: the version built from the input files that the deltas of version were applied on,
+                 version itself if no delta was applied to it, None if not known
+        """
+        if version is None:
+            return None
+        return version.split(DELTA_SEPARATOR, 1)[0] or None
+
+    def get_latest_version(self):
+        """
+
+        :return: the version named in the pointer file, None if there is no pointer file
+        """
+        try:
+            with open(self.pointer_file, 'r') as f:
+                return f.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def publish(self, version):
+        """
+        atomically points to version as the latest and removes older versions
+
+        :param version:
+        :return:
+        """
+        tmp_file = '%s.%d.tmp'%(self.pointer_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(version)
+        os.replace(tmp_file, self.pointer_file)
+        self.prune(keep=version)
+
+    def prune(self, keep):
+        """
+        removes the pickle files of the versions beyond the configured number to keep
+
+        :param keep: version never to remove
+        :return:
+        """
+        versions_to_keep = current_app.config['REFERENCE_SERVICE_MODEL_VERSIONS_TO_KEEP']
+        filenames = sorted(glob.glob('%s-*%s'%(self.root, self.ext)), key=os.path.getmtime, reverse=True)
+        for filename in filenames[versions_to_keep:]:
+            if filename != self.get_filename(keep):
+                try:
+                    os.remove(filename)
+                except OSError:
+                    current_app.logger.error('unable to remove old %s version %s' % (self.name, filename))
+
+
+parser_path = os.path.dirname(__file__) + '/parser/'
+
+MODEL_ARTIFACTS = {
+    'text_crf': ModelArtifact('text_crf',
+                              pickle_file=parser_path + 'serialized_files/crfModelText.pkl',
+                              input_files=[parser_path + 'training_files/arxiv.raw',
+                                           parser_path + 'training_files/foldModelText.dat'],
+                              create_function=create_text_model,
+                              load_function=load_text_model),
+    'source_matcher': ModelArtifact('source_matcher',
+                                    pickle_file=source_matcher_pickle_file,
+                                    input_files=TrigdictSourceMatcher(load_sources=False).authority_files,
+                                    create_function=create_source_matcher,
+                                    load_function=load_source_matcher,
+                                    config_keys=['REFERENCE_SERVICE_SOURCE_MATCHER']),
+}
+
+
+class BuildJob(object):
+    """
+    a background job building one version of a model
+    """
+    def __init__(self, artifact, version):
+        """
+
+        :param artifact:
+        :param version:
+        """
+        self.artifact = artifact
+        self.version = version
+        self.state = 'pending'
+        self.stage = None
+        self.error = None
+        self.warning = None
+        self.started = self.finished = None
+
+    def is_running(self):
+        """
+
+        :return:
+        """
+        return self.state in ['pending', 'running']
+
+    def run(self, app):
+        """
+        builds the model, saves it in its versioned file and publishes it
+
+        :param app:
+        :return:
+        """
+        with app.app_context():
+            try:
+                self.state = 'running'
+                self.started = time.time()
+                self.stage = 'building'
+                current_app.logger.info('started building %s version %s' % (self.artifact.name, self.version))
+                result = self.artifact.create_function(self.artifact.get_filename(self.version))
+                if result is None:
+                    raise Exception('unable to build %s' % self.artifact.name)
+                self.stage = 'publishing'
+                self.artifact.publish(self.version)
+                self.stage = None
+                self.state = 'done'
+                current_app.logger.info('built and published %s version %s' % (self.artifact.name, self.version))
+            except Exception as e:
+                self.state = 'failed'
+                self.error = str(e)
+                current_app.logger.error('Exception: %s' % (str(e)))
+                current_app.logger.error(traceback.format_exc())
+            finally:
+                self.finished = time.time()
+
+    def to_dict(self):
+        """
+
+        :return:
+        """
+        return {
+            'version': self.version,
+            'state': self.state,
+            'stage': self.stage,
+            'error': self.error,
+            'warning': self.warning,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+# jobs are kept per process, the versions are shared among the workers through the pointer files
+build_jobs = {}
+build_jobs_lock = threading.Lock()
+
+# workers loading a new version in the background, one per model
+loader_threads = {}
+
+
+def start_build(name):
+    """
+    starts a background job to build the model, unless a job for it is already running, or
+    the version of the input files has already been built and published, with or without
+    deltas applied to it
+
+    a new version of the input files is built without the deltas applied to the earlier one,
+    the job warns about it
+
+    :param name: 'text_crf' or 'source_matcher'
+    :return: the job
+    """
+    artifact = MODEL_ARTIFACTS[name]
+    with build_jobs_lock:
+        job = build_jobs.get(name, None)
+        if job and job.is_running():
+            return job
+        version = artifact.compute_version()
+        latest_version = artifact.get_latest_version()
+        job = BuildJob(artifact, version)
+        if artifact.get_base_version(latest_version) == version and os.path.exists(artifact.get_filename(latest_version)):
+            job.version = latest_version
+            job.state = 'done'
+            job.stage = 'already built' if latest_version == version else 'already built, with deltas applied'
+            build_jobs[name] = job
+            return job
+        if latest_version is not None and latest_version != artifact.get_base_version(latest_version):
+            job.warning = 'the deltas applied in version %s are not in version %s, built from the input files' % (
+                latest_version, version)
+            current_app.logger.warning(job.warning)
+        build_jobs[name] = job
+        thread = threading.Thread(target=job.run, args=(current_app._get_current_object(),))
+        thread.daemon = True
+        thread.start()
+        return job
+
+
+def apply_source_matcher_delta(source_lines):
+    """
+    applies a delta to a copy of the latest source matcher, publishes it as a new version,
+    and swaps it in
+
+    the active source matcher is never modified, so that requests being resolved are not affected,
+    and the deltas are applied one at a time, never while the source matcher is being built, so that
+    each is applied to the version the one before published
+
+    :param source_lines: lines of the delta file
+    :return: tuple of (number of entries added, number of entries removed)
+    """
+    artifact = MODEL_ARTIFACTS['source_matcher']
+    with build_jobs_lock:
+        job = build_jobs.get('source_matcher', None)
+        if job and job.is_running():
+            raise Exception('source matcher version %s is being built, apply the delta once it is done' % job.version)
+        latest_version = artifact.get_latest_version()
+        source_matcher = artifact.load_function(artifact.get_filename(latest_version))
+        if source_matcher is None:
+            raise Exception('unable to load source matcher version %s' % latest_version)
+        version = artifact.get_delta_version(latest_version, source_lines)
+        num_added, num_removed = update_source_matcher(source_matcher, source_lines, filename=artifact.get_filename(version))
+        artifact.publish(version)
+        swap_model('source_matcher', source_matcher, version)
+    return num_added, num_removed
+
+
+def get_active_versions():
+    """
+
+    :return: dict of model name to the version loaded in this worker
+    """
+    return current_app.extensions.setdefault('model_versions', {})
+
+
+def swap_model(name, model, version):
+    """
+    makes model the one used by this worker
+
+    :param name:
+    :param model:
+    :param version:
+    :return:
+    """
+    current_app.extensions[name] = model
+    get_active_versions()[name] = version
+    current_app.logger.info('%s version %s is now active' % (name, version))
+
+
+def load_models():
+    """
+    loads the latest version of all the models in this worker
+
+    :return:
+    """
+    for name, artifact in MODEL_ARTIFACTS.items():
+        version = artifact.get_latest_version()
+        model = artifact.load_function(artifact.get_filename(version))
+        if model is None and version is not None:
+            # fall back on the unversioned pickle file
+            version = None
+            model = artifact.load_function(artifact.get_filename(version))
+        swap_model(name, model, version)
+    current_app.extensions['model_versions_checked'] = time.time()
+
+
+def load_in_background(app, name, version):
+    """
+    loads the version of the model and swaps it in, if loaded successfully
+
+    :param app:
+    :param name:
+    :param version:
+    :return:
+    """
+    with app.app_context():
+        artifact = MODEL_ARTIFACTS[name]
+        model = artifact.load_function(artifact.get_filename(version))
+        if model is not None:
+            swap_model(name, model, version)
+        else:
+            current_app.logger.error('unable to load %s version %s, keeping the active version' % (name, version))
+
+
+def check_model_versions():
+    """
+    at most once every configured interval, checks if there is a newer version of a model than
+    the one loaded in this worker, and if so loads it in the background
+
+    :return:
+    """
+    now = time.time()
+    if now - current_app.extensions.get('model_versions_checked', 0) < current_app.config['REFERENCE_SERVICE_MODEL_CHECK_INTERVAL']:
+        return
+    current_app.extensions['model_versions_checked'] = now
+
+    active_versions = get_active_versions()
+    for name, artifact in MODEL_ARTIFACTS.items():
+        version = artifact.get_latest_version()
+        if version is None or version == active_versions.get(name, None):
+            continue
+        loader = loader_threads.get(name, None)
+        if loader and loader.is_alive():
+            continue
+        current_app.logger.info('found %s version %s, loading it in the background' % (name, version))
+        loader = threading.Thread(target=load_in_background, args=(current_app._get_current_object(), name, version))
+        loader.daemon = True
+        loader_threads[name] = loader
+        loader.start()
+
+
+def get_status():
+    """
+
+    :return: dict of model name to its active version in this worker, its latest version, and the last build job
+    """
+    active_versions = get_active_versions()
+    status = {}
+    for name, artifact in MODEL_ARTIFACTS.items():
+        job = build_jobs.get(name, None)
+        status[name] = {
+            'active_version': active_versions.get(name, None),
+            'latest_version': artifact.get_latest_version(),
+            'loaded': current_app.extensions.get(name, None) is not None,
+            'build_job': job.to_dict() if job else None,
+        }
+    return status
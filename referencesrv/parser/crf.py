@@ -639,15 +639,18 @@ class CRFClassifierText(object):
         return words
 
 
-def create_text_model():
+def create_text_model(filename=None):
     """
     create a crf text model and save it to a pickle file
 
+    :param filename: pickle file to save the model to, if not given the default one is used
     :return:
     """
     try:
         start_time = time.time()
         crf = CRFClassifierText()
+        if filename:
+            crf.filename = filename
         if not (crf.create_crf() and crf.save()):
             raise
         current_app.logger.debug("crf text model trained and saved in %s ms" % ((time.time() - start_time) * 1000))
@@ -657,15 +660,18 @@ def create_text_model():
         current_app.logger.error(traceback.format_exc())
         return None
 
-def load_text_model():
+def load_text_model(filename=None):
     """
     load the text model from pickle file
 
+    :param filename: pickle file to load the model from, if not given the default one is used
     :return:
     """
     try:
         start_time = time.time()
         crf = CRFClassifierText()
+        if filename:
+            crf.filename = filename
         if not (crf.load()):
             raise
         current_app.logger.debug("crf text model loaded in %s ms" % ((time.time() - start_time) * 1000))
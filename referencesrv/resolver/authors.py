@@ -6,10 +6,17 @@ import regex as re
 import editdistance
 import unidecode
 
-from flask import current_app
+from functools import lru_cache
 
 from referencesrv.resolver.common import Undecidable
 
+# the same author strings are normalized by the parser, for the digested record, and for the
+# query of every hypothesis, the normalizations are remembered for this many distinct strings
+AUTHOR_MEMO_SIZE = 4096
+# the same authors come back in the records solr returns over and over, the normalizations
+# of the single author names of the records are remembered for this many distinct names
+AUTHOR_NAME_MEMO_SIZE = 65536
+
 # all author lists coming in need to be case-folded
 # replaced van(?: der) with van|van der
 SINGLE_NAME_RE = "(?:(?:d|de|de la|De|des|Des|in '[a-z]|van|van der|van den|van de|von|Mc|[A-Z]')[' ]?)?[A-Z][a-z]['A-Za-z]*"
@@ -188,6 +195,7 @@ def get_authors_last_attempt(ref_string):
     return None
 
 
+@lru_cache(maxsize=AUTHOR_MEMO_SIZE)
 def get_authors(ref_string):
     """
     returns something what should be the authors in ref_string, assuming
@@ -196,6 +204,8 @@ def get_authors(ref_string):
     This works by returning the longest match of either leading or trailing
     authors starting at the beginning of ref_string.
 
+    Memoized, when no authors are found the Undecidable raised is not remembered.
+
     :param ref_string:
     :return:
     """
@@ -304,6 +314,7 @@ def get_and_colleagues(ref_string):
     return 0, 0
 
 
+@lru_cache(maxsize=AUTHOR_NAME_MEMO_SIZE)
 def normalize_single_author(author_string):
     """
     returns a normalized form for a single author string.
@@ -313,18 +324,37 @@ def normalize_single_author(author_string):
     authors are at the same normalization level as what happens
     in normalize_author_list.
 
+    Memoized.
+
     :param author_string:
     :return:
     """
     return unidecode.unidecode(author_string).replace("-", " ").lower()
 
 
+@lru_cache(maxsize=AUTHOR_NAME_MEMO_SIZE)
+def transliterate_author(author_string):
+    """
+    returns author_string in ascii, for the records without author_norm,
+    where the author field stands in for it
+
+    Memoized.
+
+    :param author_string:
+    :return:
+    """
+    return unidecode.unidecode(author_string)
+
+
+@lru_cache(maxsize=AUTHOR_MEMO_SIZE)
 def normalize_author_list(author_string, initials=True):
     """
     tries to bring author_string in the form AuthorLast1; AuthorLast2
 
     If the function cannot make sense of author_string, it returns it unchanged.
 
+    Memoized on author_string and initials.
+
     :param author_string:
     :param initials:
     :return:
@@ -392,6 +422,132 @@ def get_author_last_name_only(author_string):
         return [single_name.lower() for name in LAST_NAME_PAT.findall(author_string) for single_name in name.split()][1::2]
 
 
+# the ADS last names are joined into a regular expression, names without metacharacters are taken literally
+REGEX_METACHARACTERS = re.compile(r"[\\.^$*+?{}\[\]|()]")
+
+
+class AuthorMatcher(object):
+    """
+    the authors of a reference, prepared once to be matched against the authors of many solr records
+
+    ref_authors must be a string, where we try to assume as little as
+    possible about the format.  Full first names will kill this, though.
+    """
+    def __init__(self, ref_authors):
+        """
+
+        :param ref_authors:
+        """
+        self.ref_authors = ref_authors
+        self.ref_authors_lastname = get_author_last_name_only(ref_authors)
+        self.ref_authors_lastname_lengths = [len(ref_auth) for ref_auth in self.ref_authors_lastname]
+        self.ref_authors_joined = '; '.join(self.ref_authors_lastname)
+        self.folded_ref_authors = EXTRAS_PAT.sub('', ref_authors.lower().replace('.', ' '))
+        # ADS last name to the reference last name it is a misspelling of, None if it is not one
+        self.misspellings = {}
+
+    def get_misspelling(self, ads_auth):
+        """
+        returns the last name of the reference ads_auth is a misspelling of, None if there is none
+
+        difference of <30% is indication of misspelling
+
+        :param ads_auth:
+        :return:
+        """
+        if ads_auth in self.misspellings:
+            return self.misspellings[ads_auth]
+        misspelling = None
+        for ref_auth, ref_length in zip(self.ref_authors_lastname, self.ref_authors_lastname_lengths):
+            N_max = max(len(ads_auth), ref_length)
+            # the edit distance is at least the difference in length, so it cannot be close enough
+            if min(len(ads_auth), ref_length) / float(N_max) <= 0.7:
+                continue
+            distance = (N_max - float(editdistance.eval(ads_auth, ref_auth))) / N_max
+            if distance > 0.7:
+                misspelling = ref_auth
+                break
+        self.misspellings[ads_auth] = misspelling
+        return misspelling
+
+    def remove_ads_authors(self, ads_authors_lastname):
+        """
+        returns the last names of the reference with the ADS last names removed
+
+        :param ads_authors_lastname:
+        :return:
+        """
+        if any(REGEX_METACHARACTERS.search(ads_auth) for ads_auth in ads_authors_lastname):
+            return re.sub("|".join(ads_authors_lastname), "", self.ref_authors_joined)
+        # only the names found in the reference can match, so compile the alternation of just these,
+        # in the same order, instead of one of all the authors of a collaboration paper
+        found = [ads_auth for ads_auth in ads_authors_lastname if ads_auth in self.ref_authors_joined]
+        if not found:
+            return self.ref_authors_joined
+        return re.sub("|".join(found), "", self.ref_authors_joined)
+
+    def count(self, ads_authors, ads_first_author=None):
+        """
+        returns statistics on the authors matching between the reference
+        and ads_authors, see count_matching_authors
+
+        :param ads_authors:
+        :param ads_first_author:
+        :return:
+        """
+        if not ads_authors:
+            raise NotImplementedError("ADS paper without authors -- what should we do?")
+
+        matching_authors, missing_in_ref, first_author_missing = 0, 0, False
+
+        # clean up ADS authors to only contain surnames and be lowercased
+        ads_authors_lastname = [a.split(',')[0].strip().lower().replace('-', ' ')
+                                for a in ads_authors]
+
+        ref_authors = self.folded_ref_authors
+
+        if ads_first_author is None:
+            ads_first_author = ads_authors_lastname[0]
+        first_author_missing = ads_first_author.lower() not in ref_authors
+        # compare the last name only
+        if first_author_missing:
+            first_author_missing = ads_first_author.split(',')[0] not in ref_authors
+
+        different = []
+        for ads_auth in ads_authors_lastname:
+            if ads_auth in ref_authors or (" " in ads_auth and ads_auth.split()[-1] in ref_authors):
+                matching_authors += 1
+            else:
+                # see if there is actually no match (check for misspelling here)
+                misspelling = self.get_misspelling(ads_auth)
+                if misspelling is None:
+                    missing_in_ref += 1
+                else:
+                    different.append(misspelling)
+
+        # Now try to figure out if the reference has additional authors
+        # (we assume ADS author lists are complete)
+        if self.ref_authors_lastname:
+            wordsNotInADS = SINGLE_WORD_EXTRACTOR.findall(self.remove_ads_authors(ads_authors_lastname))
+            # remove recognized misspelled authors
+            wordsNotInADS = [word for word in wordsNotInADS if word not in different]
+            missing_in_ads = len(wordsNotInADS)
+        else:
+            missing_in_ads = 0
+
+        return (missing_in_ref, missing_in_ads, matching_authors, first_author_missing)
+
+
+def get_author_matcher(ref_authors):
+    """
+    returns the AuthorMatcher add_author_evidence uses for ref_authors, to be built once per reference
+
+    :param ref_authors:
+    :return:
+    """
+    return AuthorMatcher(ref_authors.replace('-', ' '))
+
+
 def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
     """
     returns statistics on the authors matching between ref_authors
@@ -408,64 +564,18 @@ def count_matching_authors(ref_authors, ads_authors, ads_first_author=None):
     No initials verification takes place here, case is folded, everything
     is supposed to have been dumbed down to ASCII by ADS conventions.
 
+    To match the same reference against several records, build an
+    AuthorMatcher once instead.
+
     :param ref_authors:
     :param ads_authors:
     :param ads_first_author:
     :return:
     """
-    if not ads_authors:
-        raise NotImplementedError("ADS paper without authors -- what should we do?")
-
-    matching_authors, missing_in_ref, first_author_missing = 0, 0, False
-
-    # clean up ADS authors to only contain surnames and be lowercased
-    ads_authors_lastname = [a.split(',')[0].strip().lower().replace('-', ' ')
-                            for a in ads_authors]
-
-    ref_authors_lastname = get_author_last_name_only(ref_authors)
-    ref_authors = EXTRAS_PAT.sub('', ref_authors.lower().replace('.', ' '))
-
-    if ads_first_author is None:
-        ads_first_author = ads_authors_lastname[0]
-    first_author_missing = ads_first_author.lower() not in ref_authors
-    # compare the last name only
-    if first_author_missing:
-        first_author_missing = ads_first_author.split(',')[0] not in ref_authors
-
-    different = []
-    for ads_auth in ads_authors_lastname:
-        if ads_auth in ref_authors or (" " in ads_auth and ads_auth.split()[-1] in ref_authors):
-            matching_authors += 1
-        else:
-            # see if there is actually no match (check for misspelling here)
-            # difference of <30% is indication of misspelling
-            misspelled = False
-            for ref_auth in ref_authors_lastname:
-                N_max = max(len(ads_auth), len(ref_auth))
-                distance = (N_max - float(editdistance.eval(ads_auth, ref_auth))) / N_max
-                if distance > 0.7:
-                    different.append(ref_auth)
-                    misspelled = True
-                    break
-            if not misspelled:
-                missing_in_ref += 1
-
-    # Now try to figure out if the reference has additional authors
-    # (we assume ADS author lists are complete)
-    ads_authors_lastname_pattern = "|".join(ads_authors_lastname)
-
-    if ref_authors_lastname:
-        wordsNotInADS = SINGLE_WORD_EXTRACTOR.findall(re.sub(ads_authors_lastname_pattern, "", '; '.join(ref_authors_lastname)))
-        # remove recognized misspelled authors
-        wordsNotInADS = [word for word in wordsNotInADS if word not in different]
-        missing_in_ads = len(wordsNotInADS)
-    else:
-        missing_in_ads = 0
-
-    return (missing_in_ref, missing_in_ads, matching_authors, first_author_missing)
+    return AuthorMatcher(ref_authors).count(ads_authors, ads_first_author)
 
 
-def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, has_etal=False):
+def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, has_etal=False, author_matcher=None):
     """
     adds an evidence for ref_authors matching ads_authors.
 
@@ -481,16 +591,18 @@ def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, h
     :param ads_authors:
     :param ads_first_author:
     :param has_etal:
+    :param author_matcher: get_author_matcher(ref_authors), if it was built already for the reference
     :return:
     """
-    ref_authors = ref_authors.replace('-', ' ')
+    if author_matcher is None:
+        author_matcher = get_author_matcher(ref_authors)
 
     # note that ref_authors is a string, and we need to have at least one name to match it to
     # ads_authors with is a list, that should contain at least one name
-    if len(ref_authors) == 0 or len(ads_authors) == 0:
+    if len(author_matcher.ref_authors) == 0 or len(ads_authors) == 0:
         return
     (missing_in_ref, missing_in_ads, matching_authors, first_author_missing
-     ) = count_matching_authors(ref_authors, ads_authors, ads_first_author)
+     ) = author_matcher.count(ads_authors, ads_first_author)
 
     if has_etal:
         normalizer = float(matching_authors + missing_in_ads)
@@ -499,12 +611,12 @@ def add_author_evidence(evidences, ref_authors, ads_authors, ads_first_author, h
 
     # if the first author is missing, apply the factor by which matching authors are discounted
     if first_author_missing:
-        matching_authors *= current_app.config['MISSING_FIRST_AUTHOR_FACTOR']
+        matching_authors *= evidences.settings.missing_first_author_factor
 
     if normalizer != 0:
         score = round((matching_authors - missing_in_ads) / normalizer, 2)
     else:
         score = 0
 
-    evidences.add_evidence(max(current_app.config['EVIDENCE_SCORE_RANGE'][0], min(current_app.config['EVIDENCE_SCORE_RANGE'][1], score)), "authors")
+    evidences.add_evidence(max(evidences.min_score, min(evidences.max_score, score)), "authors")
 
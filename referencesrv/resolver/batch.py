@@ -0,0 +1,175 @@
+"""
+Querying solr for the first round of hypotheses of a batch of references at once.
+
+The first hypotheses of a reference look up identifiers, its doi, arXiv id, ascl id, and
+the bibcodes constructed from its fields, one query each. For a batch of references, say
+the bibliography of a paper, these are combined into a few queries or-ing the conditions,
+and each document returned is routed to the references whose conditions it matches. The
+candidate pool of each reference is seeded with the documents of its first round, so
+resolving the reference does not query solr for them again.
+
+The documents are routed by matching the identifiers of the conditions on their fields here,
+which may not agree with how solr analyzes them, so a condition is seeded only if some documents
+are routed to it, and only if every document of its combined query is routed to some condition,
+otherwise it is left for the reference to query as usual. A combined query requests the fields
+read by the hypotheses of all of its conditions.
+"""
+
+import traceback
+
+import regex as re
+
+from flask import current_app
+
+from referencesrv.resolver.common import Solr
+from referencesrv.resolver.solrquery import Querier
+from referencesrv.resolver.candidatepool import CandidatePool
+from referencesrv.resolver.hypotheses import Hypotheses
+from referencesrv.resolver.solve import make_solr_conditions, enough_to_proceed, get_hypothesis_fields, \
+    lookup_identifier_index, match_bibcode_index
+from referencesrv.metrics import counters
+
+# hint keys of the hypotheses making up the first round, all looking up identifiers
+FIRST_ROUND_KEYS = ['doi', 'arxiv', 'ascl', 'bibcode']
+# fields the documents are routed to the conditions on, see match_first_round
+ROUTING_FIELDS = frozenset(['doi', 'identifier'])
+
+
+def get_first_round(ref):
+    """
+    returns the leading hypotheses of ref that look up an identifier, as a list of (key, value, condition, fields)
+
+    :param ref: Hypotheses instance
+    :return:
+    """
+    first_round = []
+    for hypothesis in Hypotheses.iter_hypotheses(ref):
+        if len(hypothesis.hints) != 1:
+            break
+        key, value = list(hypothesis.hints.items())[0]
+        if key not in FIRST_ROUND_KEYS:
+            break
+        # the constructed bibcodes the bibcode index matches are not queried in solr as such
+        if match_bibcode_index(hypothesis) is not None:
+            continue
+        conditions = make_solr_conditions(hypothesis.hints)
+        if conditions:
+            first_round.append((key, value, conditions[key], get_hypothesis_fields(hypothesis)))
+    return first_round
+
+
+def get_batch_fields(fields_list):
+    """
+    returns the fields to request for a combined query, None for all
+
+    :param fields_list: fields to request for each of its conditions
+    :return:
+    """
+    if any(fields is None for fields in fields_list):
+        return None
+    return ROUTING_FIELDS.union(*fields_list)
+
+
+def get_identifier_pattern(key, value):
+    """
+    returns a regular expression for the identifiers the condition of key matches, see make_solr_condition
+
+    :param key:
+    :param value:
+    :return:
+    """
+    if key == 'bibcode':
+        # ? is a single character wildcard
+        return re.compile('^%s$' % ''.join('.' if char == '?' else re.escape(char) for char in value), re.IGNORECASE)
+    if key in ['arxiv', 'ascl']:
+        return re.compile('^%s$' % re.escape('%s:%s' % (key, value)), re.IGNORECASE)
+    return re.compile('^%s$' % re.escape(value), re.IGNORECASE)
+
+
+def match_first_round(key, value, doc):
+    """
+    returns True if doc matches the condition of key
+
+    :param key:
+    :param value:
+    :param doc:
+    :return:
+    """
+    pattern = get_identifier_pattern(key, value)
+    identifiers = doc.get('doi', []) if key == 'doi' else doc.get('identifier', [])
+    return any(pattern.match(identifier) for identifier in identifiers)
+
+
+def plan_first_round(refs):
+    """
+    queries solr for the first round of hypotheses of all of refs, and seeds their candidate pools
+
+    :param refs: list of Hypotheses instances, None for the references not to be planned
+    :return: list of the candidate pools of refs, None for the references not planned
+    """
+    first_rounds = []
+    for ref in refs:
+        # the references the local identifier index resolves do not query solr at all
+        if ref is not None and enough_to_proceed(ref) and lookup_identifier_index(ref) is None:
+            first_rounds.append(get_first_round(ref))
+        else:
+            first_rounds.append([])
+
+    # condition -> (key, value) of the hypotheses
+    conditions = {}
+    # condition -> fields to request for each of the hypotheses
+    condition_fields = {}
+    for first_round in first_rounds:
+        for key, value, condition, fields in first_round:
+            conditions[condition] = (key, value)
+            condition_fields.setdefault(condition, []).append(fields)
+
+    # conditions with wildcards match more documents, they go in their own queries, so
+    # that if they overflow the exact ones are still seeded
+    exact = sorted(condition for condition in conditions if '?' not in condition)
+    wildcard = sorted(condition for condition in conditions if '?' in condition)
+    batch_size = current_app.config['REFERENCE_SERVICE_BATCH_QUERY_SIZE']
+    batches = [group[i:i+batch_size] for group in [exact, wildcard] for i in range(0, len(group), batch_size)]
+
+    querier = Querier()
+    # condition -> (documents matching it, fields requested)
+    seeded = {}
+    for batch in batches:
+        fields = get_batch_fields([fields for condition in batch for fields in condition_fields[condition]])
+        try:
+            solutions = querier.query(' OR '.join(batch), fields)
+        except Solr:
+            current_app.logger.error('batch query failed, the references are going to query solr themselves')
+            current_app.logger.error(traceback.format_exc())
+            continue
+        if solutions is None:
+            continue
+        routed = {}
+        for condition in batch:
+            key, value = conditions[condition]
+            routed[condition] = [doc for doc in solutions if match_first_round(key, value, doc)]
+        num_routed = len(set(id(doc) for docs in routed.values() for doc in docs))
+        if num_routed < len(solutions):
+            # a document matched a condition in solr but none here, the condition it matched is not known
+            current_app.logger.debug('%d documents of the batch query not routed, its conditions are not seeded' % (
+                len(solutions) - num_routed))
+            continue
+        for condition, docs in routed.items():
+            # an empty list might be solr matching the identifier differently than here
+            if docs:
+                seeded[condition] = (docs, fields)
+
+    candidate_pools = []
+    for ref, first_round in zip(refs, first_rounds):
+        if ref is None:
+            candidate_pools.append(None)
+            continue
+        candidate_pool = CandidatePool(refine_locally=current_app.config['REFERENCE_SERVICE_CANDIDATE_POOL'])
+        for key, _, condition, _ in first_round:
+            if condition in seeded:
+                solutions, fields = seeded[condition]
+                candidate_pool.add(condition, {key: condition}, solutions, fields)
+        candidate_pools.append(candidate_pool)
+    counters.increment('batch_queries', len(batches))
+    counters.increment('batch_conditions_seeded', len(seeded))
+    return candidate_pools
@@ -0,0 +1,318 @@
+"""
+A candidate pool keeps the documents solr returned for the hypotheses of one reference.
+
+When a hypothesis asks for all the conditions of an earlier query, that did not
+overflow, plus some more, its answer is a subset of the documents of the earlier
+query, and if these additional conditions can be evaluated on the documents here,
+the hypothesis is answered by filtering the pooled documents instead of querying solr.
+
+The conditions are evaluated conservatively: whenever it is not certain that a
+document would (or would not) match the condition in solr, the hypothesis is sent
+to solr, so that the answers are the same as querying solr for every hypothesis.
+
+The pool also remembers the answer to every query string, including the queries
+that came back empty or overflowed, since different hypotheses often compile to
+the same query, which then is not sent to solr again.
+
+Hypotheses request only the fields their score function reads, so pooled documents
+are used only for hypotheses reading no more fields than were requested for them.
+"""
+
+import regex as re
+
+from flask import current_app
+
+from referencesrv.metrics import counters
+
+# values that solr matches verbatim, anything else is left to solr
+PLAIN_VALUE = re.compile(r"^[A-Za-z0-9]+$")
+LOWER_VALUE = re.compile(r"^[a-z0-9]+$")
+BIBSTEM_VALUE = re.compile(r"^[A-Za-z0-9&.]+\*?$")
+
+
+def match_exact(value, doc_value):
+    """
+    returns True if doc_value is value, False if it is not, and None if solr might
+    match them depending on the case
+
+    :param value:
+    :param doc_value:
+    :return:
+    """
+    if not PLAIN_VALUE.match(value) or not PLAIN_VALUE.match(doc_value):
+        return None
+    if doc_value == value:
+        return True
+    if doc_value.lower() == value.lower():
+        return None
+    return False
+
+
+def match_year(value, doc):
+    """
+
+    :param value:
+    :param doc:
+    :return:
+    """
+    if 'year' not in doc:
+        return None
+    return match_exact(value, doc['year'])
+
+
+def match_year_range(value, doc):
+    """
+    see make_solr_condition for the 10 year window
+
+    :param value:
+    :param doc:
+    :return:
+    """
+    try:
+        return int(value) - 5 <= int(doc['year']) <= int(value) + 5
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def match_volume(value, doc):
+    """
+
+    :param value:
+    :param doc:
+    :return:
+    """
+    if 'volume' not in doc:
+        return None
+    return match_exact(value, doc['volume'])
+
+
+def match_page(value, doc):
+    """
+    see make_solr_condition for the page query; a page of more than one character
+    matches if it differs in at most one character, where the first character
+    can be any lower case letter or digit
+
+    massage_solution joins the page values of the document, which is only
+    meaningful for a single page, solr matches any of them, so the documents
+    not known to have a single page are left to solr
+
+    :param value:
+    :param doc:
+    :return:
+    """
+    doc_page = doc.get('page', None)
+    if not doc_page or getattr(doc, 'num_pages', None) != 1:
+        return None
+    # the case of the values in the index is not known here
+    if not LOWER_VALUE.match(value) or not LOWER_VALUE.match(doc_page):
+        return None
+    if len(value) == 1 or len(doc_page) != len(value):
+        return doc_page == value
+    return sum(1 for a, b in zip(value, doc_page) if a != b) <= 1
+
+
+def match_doctype(value, doc):
+    """
+
+    :param value: for example `book OR proceedings`
+    :param doc:
+    :return:
+    """
+    doc_doctype = doc.get('doctype', None)
+    if not doc_doctype:
+        return None
+    doctypes = [doctype for doctype in value.split() if doctype.upper() != 'OR']
+    if not all(PLAIN_VALUE.match(doctype) for doctype in doctypes):
+        return None
+    return doc_doctype in doctypes
+
+
+def match_bibstem(value, doc):
+    """
+    the bibstem of the document is the short one (see massage_solution), which
+    is the one the hypotheses query for
+
+    :param value: bibstem, ending in a wildcard for the journals with sections
+    :param doc:
+    :return:
+    """
+    doc_bibstem = doc.get('bibstem', None)
+    if not doc_bibstem or not BIBSTEM_VALUE.match(value):
+        return None
+    if value.endswith('*'):
+        prefix = value[:-1]
+        if doc_bibstem.startswith(prefix):
+            return True
+        if doc_bibstem.lower().startswith(prefix.lower()):
+            return None
+        return False
+    if doc_bibstem == value:
+        return True
+    if doc_bibstem.lower() == value.lower():
+        return None
+    return False
+
+
+def has_fields(pooled_fields, fields):
+    """
+    returns True if the documents requested with pooled_fields have all of fields
+
+    :param pooled_fields: fields requested, None for all
+    :param fields: fields needed, None for all
+    :return:
+    """
+    if pooled_fields is None:
+        return True
+    if fields is None:
+        return False
+    return fields <= pooled_fields
+
+
+# hint keys that can be evaluated on the pooled documents
+LOCAL_MATCHERS = {
+    'year': match_year,
+    'year~': match_year_range,
+    'volume': match_volume,
+    'page': match_page,
+    'doctype': match_doctype,
+    'bibstem': match_bibstem,
+}
+
+
+def extends(conditions, pooled_conditions):
+    """
+    returns True if conditions are all of pooled_conditions, plus some that might be evaluated
+    on the pooled documents
+
+    :param conditions: dict of hint key to solr condition
+    :param pooled_conditions: dict of hint key to solr condition
+    :return:
+    """
+    if any(conditions.get(key, None) != condition for key, condition in pooled_conditions.items()):
+        return False
+    return all(key in LOCAL_MATCHERS for key in conditions if key not in pooled_conditions)
+
+
+class CandidatePool(object):
+    """
+    the documents fetched from solr for the hypotheses of one reference
+    """
+    def __init__(self, refine_locally=True):
+        """
+
+        :param refine_locally: if False, only identical query strings are answered from the pool
+        """
+        self.refine_locally = refine_locally
+        # list of (conditions, documents, fields) of the queries that did not overflow
+        self.queries = []
+        # query string to (documents, fields), documents being None if the query overflowed
+        self.results = {}
+        self.num_queried = 0
+        self.num_refined = 0
+        self.num_repeated = 0
+
+    def add(self, query_string, conditions, solutions, fields=None):
+        """
+        keeps the documents solr returned for conditions
+
+        :param query_string: the query conditions were compiled to
+        :param conditions: dict of hint key to solr condition
+        :param solutions: documents returned, None if the query overflowed
+        :param fields: fields requested, None for all
+        :return:
+        """
+        self.results[query_string] = (solutions, fields)
+        if solutions is not None:
+            self.queries.append((conditions, solutions, fields))
+
+    def has_result(self, query_string, fields=None):
+        """
+        returns True if the query has been executed for this reference already, with all of fields requested
+
+        :param query_string:
+        :param fields: fields needed, None for all
+        :return:
+        """
+        if query_string not in self.results:
+            return False
+        solutions, pooled_fields = self.results[query_string]
+        # an overflow does not depend on the fields
+        return solutions is None or has_fields(pooled_fields, fields)
+
+    def get_result(self, query_string):
+        """
+        returns the documents of the query that was executed already, None if it overflowed
+
+        :param query_string:
+        :return:
+        """
+        self.num_repeated += 1
+        counters.increment('queries_repeated')
+        current_app.logger.debug('query %s already executed for this reference' % query_string)
+        return self.results[query_string][0]
+
+    def filter(self, extra_hints, solutions):
+        """
+        returns the documents of solutions matching all extra_hints, None if that cannot be decided here
+
+        :param extra_hints: dict of hint key to value
+        :param solutions:
+        :return:
+        """
+        matchers = [(LOCAL_MATCHERS.get(key, None), value) for key, value in extra_hints.items()]
+        if any(matcher is None for matcher, _ in matchers):
+            return None
+        refined = []
+        for doc in solutions:
+            matched = True
+            for matcher, value in matchers:
+                result = matcher(value, doc)
+                if result is None:
+                    return None
+                if not result:
+                    matched = False
+                    break
+            if matched:
+                refined.append(doc)
+        return refined
+
+    def may_refine(self, conditions, pending_conditions=()):
+        """
+        returns True if the documents of conditions might be worked out here from the documents of
+        an earlier query, either pooled already or of a hypothesis still to be evaluated
+
+        :param conditions: dict of hint key to solr condition
+        :param pending_conditions: list of the conditions of the hypotheses still to be evaluated
+        :return:
+        """
+        if not self.refine_locally:
+            return False
+        earlier = [pooled_conditions for pooled_conditions, _, _ in self.queries] + list(pending_conditions)
+        return any(extends(conditions, pooled_conditions) for pooled_conditions in earlier)
+
+    def refine(self, hints, conditions, fields=None):
+        """
+        returns the documents solr would return for conditions, if they can be worked out
+        from the documents of an earlier query, otherwise None
+
+        :param hints: dict of hint key to value, of the hypothesis
+        :param conditions: dict of hint key to solr condition, of the hypothesis
+        :param fields: fields needed, None for all
+        :return:
+        """
+        if not self.refine_locally:
+            return None
+        # try the smallest earlier answer first
+        for pooled_conditions, solutions, pooled_fields in sorted(self.queries, key=lambda query: len(query[1])):
+            if not has_fields(pooled_fields, fields):
+                continue
+            if any(conditions.get(key, None) != condition for key, condition in pooled_conditions.items()):
+                continue
+            extra_hints = dict((key, hints[key]) for key in conditions if key not in pooled_conditions)
+            refined = self.filter(extra_hints, solutions)
+            if refined is not None:
+                self.num_refined += 1
+                counters.increment('queries_refined')
+                current_app.logger.debug('refined %d of %d pooled candidates locally' % (len(refined), len(solutions)))
+                return refined
+        return None
@@ -0,0 +1,149 @@
+"""
+Circuit breaker around the requests to solr.
+
+When solr is degraded, every reference still goes through its hypotheses, each waiting for
+solr up to the timeout, and the threads of the worker pile up waiting. The circuit breaker
+keeps the outcomes of the latest requests, and when too many of them failed, or were too slow,
+it opens: requests to solr fail right away, and the views answer from the cache only, until
+
+  - after a while the breaker is half open, and lets a few requests through to probe solr,
+  - if these succeed, it closes again, if any of them fails, it opens again.
+"""
+
+import threading
+import time
+from collections import deque
+
+from flask import current_app
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half open'
+
+
+class CircuitBreaker(object):
+    """
+    the state of the requests to solr, that can be checked and updated from multiple threads
+    """
+    def __init__(self, window, min_requests, failure_rate, slow_seconds, open_seconds, num_probes):
+        """
+
+        :param window: number of the latest requests the outcomes are kept of
+        :param min_requests: number of requests to observe before the breaker can open
+        :param failure_rate: rate of the requests failed, or slow, that opens the breaker
+        :param slow_seconds: requests taking longer are counted as failed
+        :param open_seconds: time the breaker stays open before letting probes through
+        :param num_probes: number of requests let through, that need to succeed to close the breaker
+        """
+        self.lock = threading.Lock()
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self.num_probes = num_probes
+        self.state = CLOSED
+        # True for the requests that succeeded, the latest last
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.probes_sent = 0
+        self.probes_succeeded = 0
+
+    def open(self):
+        """
+        opens the breaker, called with the lock held
+
+        :return:
+        """
+        self.state = OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+    def is_open(self):
+        """
+        returns True if the breaker is open, and not yet ready to let probes through
+
+        :return:
+        """
+        with self.lock:
+            return self.state == OPEN and time.time() - self.opened_at < self.open_seconds
+
+    def allow(self):
+        """
+        returns True if a request can be sent to solr, as a probe if the breaker is half open
+
+        :return:
+        """
+        with self.lock:
+            if self.state == OPEN:
+                if time.time() - self.opened_at < self.open_seconds:
+                    return False
+                self.state = HALF_OPEN
+                self.probes_sent = self.probes_succeeded = 0
+            if self.state == HALF_OPEN:
+                if self.probes_sent >= self.num_probes:
+                    return False
+                self.probes_sent += 1
+            return True
+
+    def record(self, succeeded, seconds):
+        """
+        records the outcome of a request let through
+
+        :param succeeded: False if solr returned an error, or did not respond
+        :param seconds: time the request took
+        :return:
+        """
+        succeeded = succeeded and seconds < self.slow_seconds
+        with self.lock:
+            if self.state == HALF_OPEN:
+                if not succeeded:
+                    self.open()
+                    return
+                self.probes_succeeded += 1
+                if self.probes_succeeded >= self.num_probes:
+                    self.state = CLOSED
+                return
+            if self.state == OPEN:
+                # sent before the breaker opened
+                return
+            self.outcomes.append(succeeded)
+            if len(self.outcomes) >= self.min_requests and \
+                    self.outcomes.count(False) >= self.failure_rate * len(self.outcomes):
+                self.open()
+
+    def to_dict(self):
+        """
+
+        :return: the state, and the rate of the latest requests that failed
+        """
+        with self.lock:
+            return {'state': self.state,
+                    'requests': len(self.outcomes),
+                    'failure_rate': float(self.outcomes.count(False)) / len(self.outcomes) if self.outcomes else 0.0}
+
+
+# the breaker of the worker is created on first use, possibly from several threads at once,
+# the lock makes sure there is only one, so that all the failures are recorded on it
+breaker_lock = threading.Lock()
+
+
+def get_circuit_breaker():
+    """
+    returns the circuit breaker of this worker
+
+    :return:
+    """
+    breaker = current_app.extensions.get('solr_circuit_breaker', None)
+    if breaker is None:
+        with breaker_lock:
+            breaker = current_app.extensions.get('solr_circuit_breaker', None)
+            if breaker is None:
+                breaker = CircuitBreaker(current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_WINDOW'],
+                                         current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_MIN_REQUESTS'],
+                                         current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_FAILURE_RATE'],
+                                         current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_SLOW_SECONDS'],
+                                         current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_OPEN_SECONDS'],
+                                         current_app.config['REFERENCE_SERVICE_SOLR_BREAKER_PROBES'])
+                current_app.extensions['solr_circuit_breaker'] = breaker
+    return breaker
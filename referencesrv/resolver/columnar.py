@@ -0,0 +1,175 @@
+"""
+Numeric evidences of all the candidates of a hypothesis, computed at once.
+
+The year and volume evidences of a candidate depend only on the value in the
+reference and the value in the record, and the records solr returns for one
+hypothesis share few distinct years and volumes. So before the candidates are
+scored one at a time, the distinct values of the records are put in arrays, their
+evidences are computed with numpy, and add_year_evidence and add_volume_evidence
+look them up instead of comparing the values again for every record.
+
+Values the vectorized computation does not cover, for example volumes that are
+not plain numbers, or that are a multiple of ten apart, where the evidence depends
+on their digits, are left to the code scoring a single candidate, so the evidences
+are identical either way. The string heavy evidences (authors, publication, title)
+are always computed per candidate.
+"""
+
+import numpy as np
+import regex as re
+
+from referencesrv.resolver.common import round_two_significant_digits
+from referencesrv.resolver.settings import get_settings
+
+# volumes compared as numbers here, short enough not to overflow
+PLAIN_NUMBER = re.compile(r"^[0-9]{1,15}$")
+YEAR_PATTERN = re.compile(r'^([12][089]\d\d)')
+
+# below this many candidates, scoring them one at a time is faster
+MIN_COLUMNAR_CANDIDATES = 10
+
+
+def get_distinct_values(solutions, field):
+    """
+    returns the distinct string values of field in the solutions, in the order they first appear
+
+    :param solutions:
+    :param field:
+    :return:
+    """
+    values = []
+    seen = set()
+    for solution in solutions:
+        value = solution.get(field)
+        if isinstance(value, str) and value not in seen:
+            seen.add(value)
+            values.append(value)
+    return values
+
+
+def get_year_evidences(ref_year, ads_years):
+    """
+    returns the year evidence, see number_similarity, of ref_year against each of ads_years,
+    None if they cannot be computed here
+
+    :param ref_year:
+    :param ads_years: list of str
+    :return:
+    """
+    ref_year = str(ref_year)
+    # the characters of the padding must not match any of ref_year
+    if not ref_year or '\x00' in ref_year or not ads_years:
+        return None
+    width = max(len(ref_year), max(len(ads_year) for ads_year in ads_years))
+    ads_codes = np.array(ads_years, dtype='U%d' % width).view(np.uint32).reshape(len(ads_years), width)
+    ref_codes = np.array([ref_year], dtype='U%d' % width).view(np.uint32)
+    counts = (ads_codes[:, :len(ref_year)] == ref_codes[:len(ref_year)]).sum(axis=1)
+    return (counts / float(len(ref_year))).tolist()
+
+
+def get_volume_scores(ref_volume, ads_volumes, max_score):
+    """
+    returns the volume evidence, see add_volume_evidence, of ref_volume against each of ads_volumes,
+    None for the ones that are not computed here
+
+    :param ref_volume:
+    :param ads_volumes: list of str
+    :param max_score:
+    :return:
+    """
+    if not isinstance(ref_volume, str) or not PLAIN_NUMBER.match(ref_volume) or not ads_volumes:
+        return None
+    # volumes holding a year are compared against the issue as well, leave those
+    covered = [PLAIN_NUMBER.match(ads_volume) is not None and not YEAR_PATTERN.findall(ads_volume)
+               for ads_volume in ads_volumes]
+    ads = np.array([int(ads_volume) if is_covered else 0 for ads_volume, is_covered in zip(ads_volumes, covered)],
+                   dtype=np.int64)
+    ref = int(ref_volume)
+    diff = np.abs(ads - ref)
+    equal = ads == ref
+    # closer than this is a near miss, scored from the digits or rounded
+    closeness = 0.03 - diff / np.where(ads == 0, 1, ads).astype(np.float64)
+    multiple_of_ten = diff % 10 == 0
+
+    scores = []
+    for i, is_covered in enumerate(covered):
+        if not is_covered:
+            scores.append(None)
+        elif equal[i]:
+            scores.append(max_score)
+        elif multiple_of_ten[i]:
+            scores.append(None)
+        elif ads[i] == 0 or closeness[i] <= 0:
+            scores.append(0 * max_score)
+        else:
+            scores.append(max_score * max(round_two_significant_digits(float(closeness[i]) * 10), 0))
+    return scores
+
+
+class NumericEvidences(object):
+    """
+    the year and volume evidences of the records solr returned for a hypothesis
+    """
+    def __init__(self, input_fields, solutions, settings=None):
+        """
+
+        :param input_fields: of the hypothesis
+        :param solutions: the records solr returned
+        :param settings: ResolverSettings
+        """
+        settings = settings or get_settings()
+        self.ref_year = input_fields.get('year')
+        self.ref_volume = input_fields.get('volume')
+        self.year_evidences = {}
+        self.volume_scores = {}
+
+        if self.ref_year is not None:
+            ads_years = get_distinct_values(solutions, 'year')
+            year_evidences = get_year_evidences(self.ref_year, ads_years)
+            if year_evidences is not None:
+                self.year_evidences = dict(zip(ads_years, year_evidences))
+
+        ads_volumes = get_distinct_values(solutions, 'volume')
+        volume_scores = get_volume_scores(self.ref_volume, ads_volumes, settings.max_score)
+        if volume_scores is not None:
+            self.volume_scores = dict((ads_volume, score) for ads_volume, score in zip(ads_volumes, volume_scores)
+                                      if score is not None)
+
+    def get_year_evidence(self, ref_year, ads_year):
+        """
+        returns the year evidence of the values, None if it was not computed
+
+        :param ref_year:
+        :param ads_year:
+        :return:
+        """
+        if ref_year != self.ref_year or not isinstance(ads_year, str):
+            return None
+        return self.year_evidences.get(ads_year, None)
+
+    def get_volume_score(self, ref_volume, ads_volume):
+        """
+        returns the volume evidence of the values, None if it was not computed
+
+        :param ref_volume:
+        :param ads_volume:
+        :return:
+        """
+        if ref_volume != self.ref_volume or not isinstance(ads_volume, str):
+            return None
+        return self.volume_scores.get(ads_volume, None)
+
+
+def get_numeric_evidences(hypothesis, solutions):
+    """
+    returns the NumericEvidences of the solutions of hypothesis, None if there are too few
+    candidates or the hypothesis has no input fields to compare
+
+    :param hypothesis:
+    :param solutions:
+    :return:
+    """
+    input_fields = hypothesis.get_detail('input_fields')
+    if not input_fields or len(solutions) < MIN_COLUMNAR_CANDIDATES:
+        return None
+    return NumericEvidences(input_fields, solutions)
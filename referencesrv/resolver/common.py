@@ -6,6 +6,8 @@ from numbers import Real
 from decimal import Decimal
 from itertools import tee, filterfalse
 
+from referencesrv.resolver.settings import get_settings
+
 
 class DeferredSourceMatcher(object):
     """
@@ -28,6 +30,13 @@ class DeferredSourceMatcher(object):
 SOURCE_MATCHER = DeferredSourceMatcher()
 
 
+# the fields that together decide a match when all their evidences are the highest, see count_votes
+VOTE_COMBINATIONS = (
+    ('authors', 'pubstring', 'volume', 'year'),
+    ('authors', 'year', 'page'),
+)
+
+
 class Evidences(object):
     """
     a measure of confidence of a match.
@@ -48,17 +57,28 @@ class Evidences(object):
 
     These evidences stand in as scores in that, when compared, they
     are ordered according to what get_score returns.
+
+    The evidence functions read the settings of the resolver from the
+    evidences they add to.
+
+    Evidences are made for every record solr returns, so they are slotted.
+    The evidences and their labels are kept in the order they were added,
+    labels may repeat, and the score is their sum in that order.
     """
-    def __init__(self):
+    __slots__ = ('evidences', 'labels', 'score', 'settings', 'min_score', 'max_score')
+
+    def __init__(self, settings=None):
         """
 
+        :param settings: ResolverSettings, the ones of the process if not given
         """
         self.evidences = []
         self.labels = []
         # _score is cached; None means "not computed yet or invalid"
         self.score = None
-        self.min_score = current_app.config['EVIDENCE_SCORE_RANGE'][0]
-        self.max_score = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+        self.settings = settings or get_settings()
+        self.min_score = self.settings.min_score
+        self.max_score = self.settings.max_score
 
     def __lt__(self, other):
         """
@@ -66,12 +86,9 @@ class Evidences(object):
         :param other:
         :return:
         """
-        try:
+        if isinstance(other, Evidences):
             return self.get_score() < other.get_score()
-        except (AttributeError, TypeError):
-            if other:
-                return self.get_score() < float(other)
-            return False
+        return bool(other) and self.get_score() < float(other)
 
     def __le__(self, other):
         """
@@ -79,12 +96,9 @@ class Evidences(object):
         :param other:
         :return:
         """
-        try:
+        if isinstance(other, Evidences):
             return self.get_score() <= other.get_score()
-        except (AttributeError, TypeError):
-            if other:
-                return self.get_score() <= float(other)
-            return False
+        return bool(other) and self.get_score() <= float(other)
 
     def __gt__(self, other):
         """
@@ -92,12 +106,9 @@ class Evidences(object):
         :param other:
         :return:
         """
-        try:
+        if isinstance(other, Evidences):
             return self.get_score() > other.get_score()
-        except (AttributeError, TypeError):
-            if other:
-                return self.get_score() > float(other)
-            return False
+        return bool(other) and self.get_score() > float(other)
 
     def __ge__(self, other):
         """
@@ -105,12 +116,9 @@ class Evidences(object):
         :param other:
         :return:
         """
-        try:
+        if isinstance(other, Evidences):
             return self.get_score() >= other.get_score()
-        except (AttributeError, TypeError):
-            if other:
-                return self.get_score() >= float(other)
-            return False
+        return bool(other) and self.get_score() >= float(other)
 
     def __eq__(self, other):
         """
@@ -118,12 +126,9 @@ class Evidences(object):
         :param other:
         :return:
         """
-        try:
+        if isinstance(other, Evidences):
             return self.get_score() == other.get_score()
-        except (AttributeError, TypeError):
-            if other:
-                return self.get_score() == float(other)
-            return False
+        return bool(other) and self.get_score() == float(other)
 
     def __len__(self):
         """
@@ -190,7 +195,7 @@ class Evidences(object):
         :return:
         """
         if not self.evidences:
-            current_app.logger.error('No evidence, rejecting')
+            self.settings.logger.error('No evidence, rejecting')
             return 0
         if self.score is None:
             self.score = sum(self.evidences)
@@ -226,17 +231,8 @@ class Evidences(object):
 
         :return:
         """
-        d = dict(zip(self.labels, self.evidences))
-        combinations = [
-            ['authors', 'pubstring', 'volume', 'year'],
-            ['authors', 'year', 'page']
-        ]
-        for fields in combinations:
-            vote = 0
-            for term in fields:
-                if term in d and d[term] == current_app.config['EVIDENCE_SCORE_RANGE'][1]:
-                    vote += 1
-            if vote == len(fields):
+        for fields in VOTE_COMBINATIONS:
+            if all(self[term] == self.max_score for term in fields):
                 return True
         return False
 
@@ -248,9 +244,10 @@ class Evidences(object):
         :param label:
         :return:
         """
-        if label in self.labels:
-            d = dict(zip(self.labels, self.evidences))
-            return d[label]
+        # the last one added, if the label repeats
+        for i in range(len(self.labels) - 1, -1, -1):
+            if self.labels[i] == label:
+                return self.evidences[i]
         return None
 
 
@@ -264,6 +261,8 @@ class Solution(object):
     * score
     * source_hypothesis (the hypothesis that eventually got it right)
     """
+    __slots__ = ('cited_bibcode', 'score', 'citing_bibcode', 'source_hypothesis')
+
     def __init__(self, cited_bibcode, score, source_hypothesis='not given', citing_bibcode=None):
         """
 
@@ -290,6 +289,26 @@ class Solution(object):
         return repr(self.cited_bibcode)
 
 
+def score_fields(*fields):
+    """
+    declares the fields of the solr record a score function reads, so that only these
+    are requested from solr for its hypotheses
+
+    :param fields: names of the fields, or score functions called by the decorated one, to include their fields
+    :return:
+    """
+    def decorate(get_score_function):
+        solr_fields = set()
+        for field in fields:
+            if callable(field):
+                solr_fields.update(field.solr_fields)
+            else:
+                solr_fields.add(field)
+        get_score_function.solr_fields = frozenset(solr_fields)
+        return get_score_function
+    return decorate
+
+
 class Hypothesis(object):
     """A container for expectations to a reference.
 
@@ -300,7 +319,8 @@ class Hypothesis(object):
 
     The get_score function receives a result record, i.e.,
     a dictionary containing at most the fields given in the
-    apiQueryFields configuration.    How it compares this against
+    apiQueryFields configuration, or the ones declared with
+    score_fields for the function.    How it compares this against
     what's in the record is basically up to the class.
 
     Additionally, it gets the hypotheses that generated the response.
@@ -313,6 +333,7 @@ class Hypothesis(object):
     For debugging, you should give hypotheses short, but somewhat
     expressive names.  See below for examples.
     """
+    __slots__ = ('name', 'hints', 'get_score_function', 'details')
 
     def __init__(self, name, hints, get_score_function, **details):
         """
@@ -335,15 +356,21 @@ class Hypothesis(object):
         """
         return self.get_score_function(response_record, hints)
 
+    def get_solr_fields(self):
+        """
+        returns the fields of the solr record the score function reads, None if it did not declare them
+
+        :return:
+        """
+        return getattr(self.get_score_function, 'solr_fields', None)
+
     def get_detail(self, detail_name):
         """
 
         :param detail_name:
         :return:
         """
-        if detail_name in self.details:
-            return self.details.get(detail_name)
-        return None
+        return self.details.get(detail_name)
 
     def get_hint(self, hint_name):
         """
@@ -351,9 +378,7 @@ class Hypothesis(object):
         :param hint_name:
         :return:
         """
-        if hint_name in self.hints:
-            return self.hints.get(hint_name)
-        return None
+        return self.hints.get(hint_name)
 
 
 class NotResolved(object):
@@ -431,6 +456,16 @@ class Solr(Error):
     is raised when solr returns an error.
     """
 
+class SolrTimeout(Solr):
+    """
+    is raised when solr does not respond within the timeout.
+    """
+
+class SolrUnavailable(Solr):
+    """
+    is raised, without querying solr, while the circuit breaker is open.
+    """
+
 class Incomplete(Error):
     """
     is raised when parsed reference is incomplete and hence not able to resolve the reference.
@@ -1,13 +1,12 @@
 import regex as re
 
 from referencesrv.resolver.common import Hypothesis
-from referencesrv.resolver.authors import normalize_author_list, get_first_author_last_name
+from referencesrv.resolver.authors import normalize_author_list, get_first_author_last_name, get_author_matcher
 from referencesrv.resolver.scoring import get_score_for_reference_identifier, get_score_for_input_fields, \
     get_thesis_score_for_input_fields, get_book_score_for_input_fields
 from referencesrv.resolver.specialrules import iter_journal_specific_hypotheses
 from referencesrv.resolver.journalfield import get_best_bibstem_for, cook_title_string, has_thesis_indicators
-
-from flask import current_app
+from referencesrv.resolver.settings import get_settings
 
 
 class Hypotheses(object):
@@ -86,9 +85,12 @@ class Hypotheses(object):
                 self.digested_record[dest_key] = value
 
         self.normalized_authors = None
+        self.author_matcher = None
         if "author" in self.digested_record:
             self.digested_record["author"] = self.ETAL_PAT.sub('', self.digested_record["author"])
             self.normalized_authors = normalize_author_list(self.digested_record["author"], initials='.' in self.digested_record["author"])
+            # the authors are matched against every record solr returns for the hypotheses, prepare them once
+            self.author_matcher = get_author_matcher(self.normalized_authors)
             self.normalized_first_author = re.sub(r"\.( ?[A-Z]\.)*", "", re.sub(r"-[A-Z]\.", "", self.normalized_authors)).split(";")[0].strip()
             if len(self.normalized_first_author) <= 3:
                 self.digested_record.pop("author")
@@ -216,7 +218,7 @@ class Hypotheses(object):
         :return:
         """
         for token in refstr.lower().split():
-            if token in current_app.config["THESIS_INDICATOR_WORDS"]:
+            if token in get_settings().thesis_indicator_words:
                 return True
         return False
 
@@ -305,14 +307,16 @@ class Hypotheses(object):
         # otherwise compare metadata for scoring
         if self.has_keys("year", "pub"):
             for bibcode in self.construct_bibcode():
-                self.digested_record.update({'bibcode': bibcode})
+                # hypotheses can be generated ahead of being evaluated, so each gets its own bibcode,
+                # and the digested record, shared by all hypotheses, is not changed
                 yield Hypothesis("fielded-bibcode", {"bibcode": bibcode},
                     get_score_for_reference_identifier if '?' not in bibcode
                                                        else get_score_for_input_fields,
-                    input_fields=self.digested_record,
+                    input_fields=dict(self.digested_record, bibcode=bibcode),
                     page_qualifier=self.digested_record.get("qualifier", ""),
                     has_etal=has_etal,
-                    normalized_authors=self.normalized_authors)
+                    normalized_authors=self.normalized_authors,
+                    author_matcher=self.author_matcher)
 
         # could this be a thesis?
         # single author, no volume and page or indication that it is a thesis
@@ -327,11 +331,12 @@ class Hypotheses(object):
             if has_thesis_indicators(self.digested_record["refstr"]):
                 yield Hypothesis("fielded-thesis", {
                     "author": self.normalized_authors,
-                    "pub": "(%s)" % " OR ".join(current_app.config["THESIS_INDICATOR_WORDS"]),
+                    "pub": "(%s)" % " OR ".join(get_settings().thesis_indicator_words),
                     "year": self.digested_record["year"]},
                                  get_thesis_score_for_input_fields,
                                  input_fields=self.digested_record,
-                                 normalized_authors=self.normalized_authors)
+                                 normalized_authors=self.normalized_authors,
+                                 author_matcher=self.author_matcher)
 
         # try resolving as book
         if self.has_keys("author", "year") and self.lacks_keys("volume"):
@@ -344,7 +349,8 @@ class Hypotheses(object):
                                  input_fields=self.digested_record,
                                  page_qualifier=self.digested_record.get("qualifier", ""),
                                  has_etal=has_etal,
-                                 normalized_authors=self.normalized_authors)
+                                 normalized_authors=self.normalized_authors,
+                                 author_matcher=self.author_matcher)
                 yield Hypothesis("fielded-book-pub-title", {
                     "title": self.digested_record["title"],
                     "year": self.digested_record["year"],
@@ -353,7 +359,8 @@ class Hypotheses(object):
                                  input_fields=self.digested_record,
                                  page_qualifier=self.digested_record.get("qualifier", ""),
                                  has_etal=has_etal,
-                                 normalized_authors=self.normalized_authors)
+                                 normalized_authors=self.normalized_authors,
+                                 author_matcher=self.author_matcher)
 
 
                 # having author-year-title is indication that this was a book,
@@ -376,9 +383,12 @@ class Hypotheses(object):
                     input_fields=self.digested_record,
                     page_qualifier=self.digested_record.get("qualifier", ""),
                     has_etal=has_etal,
-                    normalized_authors=self.normalized_authors)
+                    normalized_authors=self.normalized_authors,
+                    author_matcher=self.author_matcher)
 
         # is it inproceedings but with incomplete metadata (either both volume and page, or either missing)
+        # this and the other broad hypotheses often overflow, so with REFERENCE_SERVICE_COUNT_PROBE
+        # their documents are counted before they are fetched
         if self.has_keys("author", "year") and (self.lacks_keys("volume", "page") or
                                                     self.lacks_keys("volume") or self.lacks_keys("page")):
             yield Hypothesis("fielded-author/year", {
@@ -388,7 +398,9 @@ class Hypotheses(object):
                 input_fields=self.digested_record,
                 page_qualifier=self.digested_record.get("qualifier", ""),
                 has_etal=has_etal,
-                normalized_authors=self.normalized_authors)
+                normalized_authors=self.normalized_authors,
+                author_matcher=self.author_matcher,
+                broad=True)
 
         # try author, year, volume, and page
         if self.has_keys("author", "year", "volume", "page"):
@@ -401,7 +413,8 @@ class Hypotheses(object):
                              input_fields=self.digested_record,
                              page_qualifier=self.digested_record.get("qualifier", ""),
                              has_etal=has_etal,
-                             normalized_authors=self.normalized_authors)
+                             normalized_authors=self.normalized_authors,
+                             author_matcher=self.author_matcher)
 
         # search by author, bibstem, and year
         if self.has_keys("author", "pub", "year"):
@@ -413,7 +426,8 @@ class Hypotheses(object):
                 input_fields=self.digested_record,
                 page_qualifier=self.digested_record.get("qualifier", ""),
                 has_etal=has_etal,
-                normalized_authors=self.normalized_authors)
+                normalized_authors=self.normalized_authors,
+                author_matcher=self.author_matcher)
 
         # try some reference type-specific hypotheses
         if "pub" in self.digested_record:
@@ -440,7 +454,8 @@ class Hypotheses(object):
                              input_fields=self.digested_record,
                              page_qualifier=self.digested_record.get("qualifier", ""),
                              has_etal=has_etal,
-                             normalized_authors=self.normalized_authors)
+                             normalized_authors=self.normalized_authors,
+                             author_matcher=self.author_matcher)
 
         # try author search with either volume or page
         if self.has_keys("author"):
@@ -450,14 +465,16 @@ class Hypotheses(object):
                     "author": self.normalized_authors,
                     "volume": self.digested_record["volume"]},
                     get_score_for_input_fields,
-                    input_fields=self.digested_record)
+                    input_fields=self.digested_record,
+                    broad=True)
             # with page
             if self.has_keys("page"):
                 yield Hypothesis("fielded-author/page", {
                     "author": self.normalized_authors,
                     "page": self.digested_record["page"]},
                     get_score_for_input_fields,
-                    input_fields=self.digested_record)
+                    input_fields=self.digested_record,
+                    broad=True)
 
         # if no author, try bibstem-year-volume-page
         if self.has_keys("year", "pub", "volume", "page"):
@@ -470,7 +487,8 @@ class Hypotheses(object):
                 input_fields=self.digested_record,
                 page_qualifier='',
                 has_etal=has_etal,
-                normalized_authors=self.normalized_authors)
+                normalized_authors=self.normalized_authors,
+                author_matcher=self.author_matcher)
 
         # if no year, try first_author-bibstem-volume-page
         if self.has_keys("author", "pub", "volume", "page"):
@@ -483,7 +501,8 @@ class Hypotheses(object):
                              input_fields=self.digested_record,
                              page_qualifier=self.digested_record.get("qualifier", ""),
                              has_etal=has_etal,
-                             normalized_authors=self.normalized_authors)
+                             normalized_authors=self.normalized_authors,
+                             author_matcher=self.author_matcher)
 
         # now fuzzy search
         if self.has_keys("author", "year"):
@@ -495,7 +514,9 @@ class Hypotheses(object):
                 input_fields=self.digested_record,
                 page_qualifier=self.digested_record.get("qualifier", ""),
                 has_etal=has_etal,
-                normalized_authors=self.normalized_authors)
+                normalized_authors=self.normalized_authors,
+                author_matcher=self.author_matcher,
+                broad=True)
             # and now approximate year
             yield Hypothesis("fielded-author/year~", {
                 "author": self.normalized_authors,
@@ -504,5 +525,7 @@ class Hypotheses(object):
                 input_fields=self.digested_record,
                 page_qualifier=self.digested_record.get("qualifier", ""),
                 has_etal=has_etal,
-                normalized_authors=self.normalized_authors)
+                normalized_authors=self.normalized_authors,
+                author_matcher=self.author_matcher,
+                broad=True)
 
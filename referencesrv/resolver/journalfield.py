@@ -12,9 +12,8 @@ import editdistance
 import unidecode
 import math
 
-from flask import current_app
-
 from referencesrv.resolver.common import SOURCE_MATCHER, round_two_significant_digits
+from referencesrv.resolver.settings import get_settings
 
 
 # A string containing all "modifiers" to page numbers from
@@ -39,7 +38,7 @@ def get_best_bibstem_for(sourceSpec):
     :param sourceSpec: 
     :return: 
     """
-    current_app.logger.debug("sourceSpec=%s"%(sourceSpec))
+    get_settings().logger.debug("sourceSpec=%s", sourceSpec)
     try:
         return SOURCE_MATCHER.bestmatches(sourceSpec.upper(), 1)[0][1][:5].strip('.')
     except IndexError:
@@ -55,7 +54,7 @@ def get_exact_bibstem_for(sourceSpec):
     :param sourceSpec:
     :return:
     """
-    current_app.logger.debug("sourceSpec=%s" % (sourceSpec))
+    get_settings().logger.debug("sourceSpec=%s", sourceSpec)
     try:
         return SOURCE_MATCHER.exactmatch(sourceSpec.upper())
     except IndexError:
@@ -69,14 +68,14 @@ def get_bibstem(stem):
     :param sourceSpec:
     :return:
     """
-    current_app.logger.debug("stem=%s" % (stem))
+    get_settings().logger.debug("stem=%s", stem)
     bibstem = SOURCE_MATCHER.has_key(stem.upper())
     if bibstem:
         return bibstem[0].strip('.')
     return None
 
 
-def add_volume_evidence(evidences, ref_volume, ads_volume, ads_issue, ads_pub_raw):
+def add_volume_evidence(evidences, ref_volume, ads_volume, ads_issue, ads_pub_raw, numeric_evidences=None):
     """
     adds evidence from comparing volume specifications from
     the reference and from ADS.
@@ -85,6 +84,7 @@ def add_volume_evidence(evidences, ref_volume, ads_volume, ads_issue, ads_pub_ra
     :param ref_volume: 
     :param ads_volume: 
     :param ads_issue:
+    :param numeric_evidences: NumericEvidences of the candidates, if computed
     :return:
     """
     if not ref_volume and not (ads_volume or ads_issue):
@@ -97,22 +97,27 @@ def add_volume_evidence(evidences, ref_volume, ads_volume, ads_issue, ads_pub_ra
         if not ads_volume and ads_pub_raw:
             # see if reference volume appears in ads pub_raw
             if re.search(r'\b(%s)\b'%ref_volume, ads_pub_raw):
-                evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][1] * current_app.config['MISSING_VOLUME_FACTORY'], 'volume')
+                evidences.add_evidence(evidences.max_score * evidences.settings.missing_volume_factor, 'volume')
                 return
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0] if ads_volume else 0, 'volume')
+        evidences.add_evidence(evidences.min_score if ads_volume else 0, 'volume')
+        return
+
+    score = numeric_evidences.get_volume_score(ref_volume, ads_volume) if numeric_evidences else None
+    if score is not None:
+        evidences.add_evidence(score, 'volume')
         return
 
     try:
         if int(ref_volume) == int(ads_volume):
-            score = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+            score = evidences.max_score
         # sometimes ads_volume holds conference year, and references include the issue
         # see if ads_volume is a year, if so then check the reference against issue
         elif ads_issue and YEAR_PATTERN.findall(ads_volume) and int(ref_volume)==int(ads_issue):
-            score = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+            score = evidences.max_score
         else:
             delta_volume = compute_closeness_two_numbers(ref_volume, ads_volume)
             delta_issue = compute_closeness_two_numbers(ref_volume, ads_issue) if ads_issue and YEAR_PATTERN.findall(ads_volume) else 0
-            score = current_app.config['EVIDENCE_SCORE_RANGE'][1] * max(delta_volume, delta_issue)
+            score = evidences.max_score * max(delta_volume, delta_issue)
     except ValueError:
         # Some weird format, so use edit distance
         score = string_similarity(ref_volume, ads_volume)
@@ -200,10 +205,11 @@ def compute_page_delta_plain_number(ref_page, ads_match, ref_qualifier):
     ref_page = ref_page.replace(".", "")
 
     if int(ads_page)==int(ref_page):
-        delta += current_app.config['EVIDENCE_SCORE_RANGE'][1]
+        settings = get_settings()
+        delta += settings.max_score
         if ads_letter or ref_qualifier:
             if ads_letter!=ref_qualifier:
-                delta += current_app.config['NO_LETTER_DEMERIT']
+                delta += settings.no_letter_demerit
     else:
         return compute_closeness_two_numbers(ref_page, ads_page)
 
@@ -234,7 +240,7 @@ def compute_page_delta(ref_page, ads_page, ref_qualifier=None):
     except ValueError:
         # it's some weird identifier.  String identity should do for the moment.
         if ads_page==ref_page:
-            delta = current_app.config['EVIDENCE_SCORE_RANGE'][1]
+            delta = get_settings().max_score
         else:
             return 0
 
@@ -284,13 +290,14 @@ def number_similarity(num1,num2):
     return count/float(total)
 
 
-def add_year_evidence(evidences, ref_year, ads_year):
+def add_year_evidence(evidences, ref_year, ads_year, numeric_evidences=None):
     """
     adds evidence from comparing publication years.
 
     :param evidences:
     :param ref_year:
     :param ads_year:
+    :param numeric_evidences: NumericEvidences of the candidates, if computed
     :return:
     """
 # This is here since it's perfectly possible that year is not part of
@@ -310,7 +317,10 @@ def add_year_evidence(evidences, ref_year, ads_year):
 #         evidences.add_evidence(-1, "year")
 
     # new way of sccoring!
-    evidences.add_evidence(number_similarity(ref_year, ads_year), "year")
+    evidence = numeric_evidences.get_year_evidence(ref_year, ads_year) if numeric_evidences else None
+    if evidence is None:
+        evidence = number_similarity(ref_year, ads_year)
+    evidences.add_evidence(evidence, "year")
 
 
 def compute_pubstring_statistics(ref_pub, ads_pub, suggested_bibcode):
@@ -347,9 +357,9 @@ def string_similarity(str_a, str_b):
     :return:
     """
     if str_a is None or str_b is None:
-        return current_app.config['EVIDENCE_SCORE_RANGE'][0]
+        return get_settings().min_score
     if max(len(str_a), len(str_b)) == 0:
-        return current_app.config['EVIDENCE_SCORE_RANGE'][0]
+        return get_settings().min_score
 
     # remove punctuation and turn lower case
     str_a = " ".join(re.split('\W+', str_a.lower()))
@@ -357,7 +367,7 @@ def string_similarity(str_a, str_b):
 
     words = re.findall(r"\w+", str_b or "")
     if len(words) == 0:
-        return current_app.config['EVIDENCE_SCORE_RANGE'][0]
+        return get_settings().min_score
 
     # if the beginning matches, bring that score
     # sometimes subtitle is missing in one string and is included in another
@@ -399,7 +409,7 @@ def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub,
     """
     if (len(ref_bibstem) > 1 and (ref_bibstem in ads_bibcode)) or \
        (len(ref_pub) > 1 and (ads_bibstem in ref_pub)):
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][1], 'pub')
+        evidences.add_evidence(evidences.max_score, 'pub')
         return
 
     nonzeros = [a for a in [ref_pub, ads_pub] if a]
@@ -407,7 +417,7 @@ def add_publication_evidence(evidences, ref_pub, ref_bibstem, ref_str, ads_pub,
     if len(nonzeros) == 0 or not ref_pub:
         return
     if len(nonzeros) == 1:
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0], 'pub')
+        evidences.add_evidence(evidences.min_score, 'pub')
         return
 
     # if ref_pub is one word, see how similar it is with ads_bibstem
@@ -448,7 +458,7 @@ def has_thesis_indicators(pub_string):
     :return:
     """
     stuff_to_match = unidecode.unidecode(pub_string).lower()
-    for thesis_word in current_app.config['THESIS_INDICATOR_WORDS']:
+    for thesis_word in get_settings().thesis_indicator_words:
         if thesis_word.endswith("*"):
             if thesis_word[:-1] in stuff_to_match:
                 return True
@@ -466,9 +476,9 @@ def cook_reference_pub(pub_string):
     :param pub_string:
     :return:
     """
-    expansion_mapping = current_app.config["JOURNAL_ABBREVIATION"]
-    stop_words = re.compile("\b({})\b".format("|".join(current_app.config["REFERENCE_SERVICE_STOP_WORDS"])))
-    elements = stop_words.sub(" ", pub_string).split()
+    settings = get_settings()
+    expansion_mapping = settings.journal_abbreviation
+    elements = settings.stop_words_pattern.sub(" ", pub_string).split()
     # we need embedded ampersands as "and" so we accept A&A as  word
     return " ".join(expansion_mapping.get(e, e) for e in elements).replace("&", "and")
 
@@ -481,10 +491,11 @@ def cook_title_string(title):
     :param title:
     :return:
     """
+    stop_words = get_settings().stop_words
     return " ".join(p
                     for p in re.sub(r"[^\w]+", " ",
                                     title).split()
-                    if p not in current_app.config["REFERENCE_SERVICE_STOP_WORDS"]
+                    if p not in stop_words
                     and len(p) > 5)
 
 
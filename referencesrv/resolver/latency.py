@@ -0,0 +1,210 @@
+"""
+Latency aware requests to solr.
+
+The hypotheses of a reference are evaluated one after the other, so a single slow replica
+of solr stalls all of them, and it is the tail of the latencies, not their average, that the
+resolving time of a reference is made of. The latencies of the latest requests to each endpoint
+are kept, and their percentiles give
+
+  - the timeout of a request, the observed p99 times a factor, within bounds, instead of
+    the fixed timeout for all of them,
+  - the delay after which, if a request has not returned yet, a duplicate of it is sent,
+    hoping for another replica, and the response of the first one to return is used.
+
+Until enough requests to an endpoint have been observed, the fixed timeout is used and
+no request is hedged.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from flask import current_app
+
+from referencesrv.metrics import counters
+
+
+class LatencyTracker(object):
+    """
+    the latencies of the latest requests to each endpoint, that can be recorded from multiple threads
+    """
+    def __init__(self, window, min_samples):
+        """
+
+        :param window: number of the latest requests to each endpoint kept
+        :param min_samples: number of requests to an endpoint to observe before giving its percentiles
+        """
+        self.lock = threading.Lock()
+        self.window = window
+        self.min_samples = min_samples
+        # endpoint -> latencies in seconds, the latest last
+        self.latencies = {}
+
+    def record(self, endpoint, seconds):
+        """
+
+        :param endpoint:
+        :param seconds:
+        :return:
+        """
+        with self.lock:
+            self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, endpoint, percent):
+        """
+        returns the percentile of the latencies of endpoint, nearest rank, None if too few were observed
+
+        :param endpoint:
+        :param percent:
+        :return:
+        """
+        with self.lock:
+            latencies = sorted(self.latencies.get(endpoint, []))
+        if len(latencies) < max(self.min_samples, 1):
+            return None
+        return latencies[max(int(math.ceil(percent / 100.0 * len(latencies))) - 1, 0)]
+
+    def to_dict(self):
+        """
+
+        :return: dict of endpoint to the number of latencies kept, and their p50, p95 and p99 in ms
+        """
+        with self.lock:
+            stats = dict((endpoint, {'count': len(latencies)}) for endpoint, latencies in self.latencies.items())
+        for endpoint in stats:
+            for percent in [50, 95, 99]:
+                latency = self.percentile(endpoint, percent)
+                stats[endpoint]['p%d' % percent] = None if latency is None else latency * 1000
+        return stats
+
+    def reset(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.latencies = {}
+
+
+# the tracker and the thread pool of the worker are created on first use, from the request threads
+# and the threads of the speculative queries, the lock makes sure only one of each is created
+extensions_lock = threading.Lock()
+
+
+def get_latency_tracker():
+    """
+    returns the latency tracker of this worker
+
+    :return:
+    """
+    tracker = current_app.extensions.get('solr_latency_tracker', None)
+    if tracker is None:
+        with extensions_lock:
+            tracker = current_app.extensions.get('solr_latency_tracker', None)
+            if tracker is None:
+                tracker = LatencyTracker(current_app.config['REFERENCE_SERVICE_SOLR_LATENCY_WINDOW'],
+                                         current_app.config['REFERENCE_SERVICE_SOLR_LATENCY_MIN_SAMPLES'])
+                current_app.extensions['solr_latency_tracker'] = tracker
+    return tracker
+
+
+def get_hedge_executor():
+    """
+    returns the thread pool of this worker the hedged requests are sent from
+
+    :return:
+    """
+    executor = current_app.extensions.get('solr_hedge_executor', None)
+    if executor is None:
+        with extensions_lock:
+            executor = current_app.extensions.get('solr_hedge_executor', None)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=current_app.config['REFERENCE_SERVICE_SOLR_HEDGE_THREADS'])
+                current_app.extensions['solr_hedge_executor'] = executor
+    return executor
+
+
+def get_timeout(tracker, endpoint):
+    """
+    returns the timeout of a request to endpoint, the observed p99 times a factor, within bounds
+
+    :param tracker:
+    :param endpoint:
+    :return: timeout in seconds
+    """
+    max_timeout = current_app.config['REFERENCE_SERVICE_SOLR_TIMEOUT']
+    latency = tracker.percentile(endpoint, 99)
+    if latency is None:
+        return max_timeout
+    return min(max_timeout, max(current_app.config['REFERENCE_SERVICE_SOLR_MIN_TIMEOUT'],
+                                latency * current_app.config['REFERENCE_SERVICE_SOLR_TIMEOUT_FACTOR']))
+
+
+def get_hedge_delay(tracker, endpoint):
+    """
+    returns the delay after which a duplicate of a request to endpoint is sent, the observed percentile
+
+    :param tracker:
+    :param endpoint:
+    :return: delay in seconds, None if requests are not hedged
+    """
+    percent = current_app.config['REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE']
+    if percent is None:
+        return None
+    return tracker.percentile(endpoint, percent)
+
+
+def send_timed(send, tracker, endpoint):
+    """
+    returns the response of send, after recording its latency; the ones timed out are recorded
+    as well, so that the timeout follows the latencies when they go up
+
+    :param send: function sending the request
+    :param tracker:
+    :param endpoint:
+    :return:
+    """
+    start_time = time.time()
+    try:
+        response = send()
+    except requests.exceptions.Timeout:
+        tracker.record(endpoint, time.time() - start_time)
+        raise
+    tracker.record(endpoint, time.time() - start_time)
+    return response
+
+
+def send_hedged(send, hedge_delay, executor):
+    """
+    returns the response of send, sending it a second time if the first has not returned after hedge_delay,
+    in which case the response of the first one to return is used, unless it failed
+
+    :param send: function sending the request, that can be called from any thread
+    :param hedge_delay: delay in seconds, None to send it once
+    :param executor:
+    :return:
+    """
+    if hedge_delay is None:
+        return send()
+
+    first = executor.submit(send)
+    done, _ = wait([first], timeout=hedge_delay)
+    if done:
+        return first.result()
+
+    counters.increment('solr_hedged_requests')
+    pending = {first, executor.submit(send)}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                # the request still pending cannot be stopped, its response is ignored
+                if future is not first:
+                    counters.increment('solr_hedged_requests_won')
+                return future.result()
+            error = future.exception()
+    raise error
@@ -0,0 +1,329 @@
+"""
+Local indexes answering some of the hypotheses without querying solr, or with cheaper queries.
+
+The identifier index maps the doi, arXiv id and ascl id of the records to their bibcodes.
+The mapping is static, so it is exported in bulk and built into a key file by
+build_identifier_index.py, one line `<key>\t<bibcode>` per identifier, sorted by key.
+The key file is memory mapped and searched with binary search, so looking up an
+identifier takes microseconds, and the pages of the file are shared by the workers
+through the page cache, instead of each keeping a copy of the mapping in memory.
+
+An identifier that is not in the index, or that is in it for more than one record, is
+queried in solr as usual.
+
+The bibcode index is a snapshot of the bibcodes of the records, including the alternate ones,
+built by build_identifier_index.py with -b, to match the patterns construct_bibcode makes
+with ? wildcards. Each bibcode is kept twice in the key file, as is, so that the bibcodes of
+a year and bibstem are next to each other, and rotated to start with the volume and page,
+so that the patterns with a wildcard journal can be matched as well. A pattern is matched
+by scanning the lines starting with the longest literal prefix of either, which has to be
+long enough to make the scan short, otherwise the pattern is queried in solr as usual.
+"""
+
+import os
+import io
+import mmap
+
+import regex as re
+
+from flask import current_app
+
+# hint keys of the hypotheses the identifier index answers
+IDENTIFIER_KEYS = ['doi', 'arxiv', 'ascl']
+
+BIBCODE_LENGTH = 19
+# the year and bibstem, the rotated bibcode starts with the rest, volume, qualifier, page and initial
+BIBCODE_ROTATION = 9
+# shorter literal prefixes of a pattern mean scanning too many bibcodes
+MIN_PREFIX_LENGTH = 8
+# key prefixes of the two layouts of the bibcodes in the key file
+BIBCODE_PREFIX = 'b:'
+ROTATED_PREFIX = 'r:'
+
+
+def make_identifier_key(key, identifier):
+    """
+    returns the key of the identifier in the index, identifiers are compared case insensitive
+
+    :param key: one of IDENTIFIER_KEYS
+    :param identifier:
+    :return:
+    """
+    return ('%s:%s' % (key, identifier.strip())).lower()
+
+
+def get_record_identifier_key(identifier):
+    """
+    returns the key of an identifier of the identifier field of a record, None if it is not
+    a doi, arXiv id or ascl id
+
+    :param identifier:
+    :return:
+    """
+    identifier = identifier.strip()
+    if not identifier or len(identifier.split()) > 1:
+        return None
+    lower = identifier.lower()
+    if lower.startswith('arxiv:'):
+        return make_identifier_key('arxiv', identifier[len('arxiv:'):])
+    if lower.startswith('ascl:'):
+        return make_identifier_key('ascl', identifier[len('ascl:'):])
+    if lower.startswith('doi:'):
+        return make_identifier_key('doi', identifier[len('doi:'):])
+    if lower.startswith('10.'):
+        return make_identifier_key('doi', identifier)
+    return None
+
+
+def write_key_file(entries, filename):
+    """
+    writes the (key, value) entries, sorted and without duplicates, to filename, which is replaced atomically
+
+    :param entries: iterator of (key, value)
+    :param filename:
+    :return: number of lines written
+    """
+    # sorting the encoded lines, so that the file is in the order the binary search compares in
+    lines = sorted(set(('%s\t%s\n' % (key, value)).encode('utf-8') for key, value in entries))
+    tmp_file = '%s.%d.tmp' % (filename, os.getpid())
+    with io.open(tmp_file, 'wb') as f:
+        f.writelines(lines)
+    os.replace(tmp_file, filename)
+    return len(lines)
+
+
+def build_identifier_index(lines, filename):
+    """
+    builds the key file of the identifier index from a bulk export of the identifiers
+
+    :param lines: lines of the export, `<bibcode>\t<identifier>[\t<identifier>...]`
+    :param filename:
+    :return: number of identifiers in the index
+    """
+    def iter_entries():
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            bibcode = fields[0].strip()
+            if not bibcode:
+                continue
+            for identifier in fields[1:]:
+                key = get_record_identifier_key(identifier)
+                if key:
+                    yield key, bibcode
+    return write_key_file(iter_entries(), filename)
+
+
+def rotate_bibcode(bibcode):
+    """
+    returns the bibcode starting with its volume
+
+    :param bibcode:
+    :return:
+    """
+    return bibcode[BIBCODE_ROTATION:] + bibcode[:BIBCODE_ROTATION]
+
+
+def unrotate_bibcode(rotated):
+    """
+
+    :param rotated:
+    :return:
+    """
+    return rotated[-BIBCODE_ROTATION:] + rotated[:-BIBCODE_ROTATION]
+
+
+def get_literal_prefix(pattern):
+    """
+    returns the part of pattern before its first wildcard
+
+    :param pattern:
+    :return:
+    """
+    return pattern.split('?')[0]
+
+
+def build_bibcode_index(lines, filename):
+    """
+    builds the key file of the bibcode index from a bulk export of the bibcodes
+
+    :param lines: lines of the export, `<bibcode>[\t<alternate bibcode>...]`
+    :param filename:
+    :return: number of bibcodes in the index, including the alternate ones
+    """
+    def iter_entries():
+        for line in lines:
+            fields = [field.strip() for field in line.rstrip('\n').split('\t')]
+            bibcode = fields[0]
+            if len(bibcode) != BIBCODE_LENGTH:
+                continue
+            for alternate in fields:
+                if len(alternate) == BIBCODE_LENGTH and len(alternate.split()) == 1:
+                    # bibcodes are matched case insensitive, as the identifier queries are
+                    yield BIBCODE_PREFIX + alternate.lower(), bibcode
+                    yield ROTATED_PREFIX + rotate_bibcode(alternate.lower()), bibcode
+    return write_key_file(iter_entries(), filename) // 2
+
+
+class KeyFileIndex(object):
+    """
+    a memory mapped key file, of lines `<key>\t<value>` sorted by key, searched with binary search
+    """
+    def __init__(self, filename):
+        """
+
+        :param filename:
+        """
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # an empty file cannot be mapped
+            self.data = b''
+
+    def find_first(self, prefix):
+        """
+        returns the position of the first line not sorting before prefix
+
+        :param prefix: bytes
+        :return:
+        """
+        low, high = 0, len(self.data)
+        # the lines starting before low sort before prefix, the ones starting at high or after do not
+        while low < high:
+            middle = (low + high) // 2
+            start = self.data.rfind(b'\n', 0, middle) + 1
+            end = self.data.find(b'\n', start)
+            if self.data[start:end + 1] < prefix:
+                low = end + 1
+            else:
+                high = start
+        return low
+
+    def iter_lines(self, prefix):
+        """
+        yields the lines starting with prefix, without their line end
+
+        :param prefix: bytes
+        :return:
+        """
+        position = self.find_first(prefix)
+        while self.data[position:position + len(prefix)] == prefix:
+            end = self.data.find(b'\n', position)
+            yield self.data[position:end]
+            position = end + 1
+
+    def lookup(self, key):
+        """
+        returns the list of values of key
+
+        :param key:
+        :return:
+        """
+        prefix = ('%s\t' % key).encode('utf-8')
+        return [line[len(prefix):].decode('utf-8') for line in self.iter_lines(prefix)]
+
+    def close(self):
+        """
+
+        :return:
+        """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+
+class IdentifierIndex(KeyFileIndex):
+    """
+    the doi, arXiv id and ascl id of the records to their bibcodes
+    """
+    def get_bibcodes(self, key, identifier):
+        """
+        returns the bibcodes of the records having the identifier
+
+        :param key: one of IDENTIFIER_KEYS
+        :param identifier:
+        :return:
+        """
+        return self.lookup(make_identifier_key(key, identifier))
+
+
+class BibcodeIndex(KeyFileIndex):
+    """
+    the bibcodes of the records, including the alternate ones, to the bibcodes of the records
+    """
+    def match(self, pattern, max_matches):
+        """
+        returns the sorted list of the bibcodes of the records matching pattern, None if the pattern
+        cannot be matched here, or it matches max_matches records or more, that is an overflow
+
+        :param pattern: bibcode with ? wildcards, see construct_bibcode
+        :param max_matches:
+        :return:
+        """
+        if len(pattern) != BIBCODE_LENGTH:
+            return None
+        pattern = pattern.lower()
+        prefix = get_literal_prefix(pattern)
+        rotated_prefix = get_literal_prefix(rotate_bibcode(pattern))
+        if max(len(prefix), len(rotated_prefix)) < MIN_PREFIX_LENGTH:
+            return None
+        rotated = len(rotated_prefix) > len(prefix)
+        if rotated:
+            key_prefix = ROTATED_PREFIX + rotated_prefix
+        else:
+            key_prefix = BIBCODE_PREFIX + prefix
+        matcher = re.compile('^%s$' % ''.join('.' if char == '?' else re.escape(char) for char in pattern))
+        matches = set()
+        for line in self.iter_lines(key_prefix.encode('utf-8')):
+            key, bibcode = line.decode('utf-8').split('\t')
+            # both layouts have a key prefix of the same length
+            key = key[len(BIBCODE_PREFIX):]
+            if matcher.match(unrotate_bibcode(key) if rotated else key):
+                matches.add(bibcode)
+                if len(matches) >= max_matches:
+                    return None
+        return sorted(matches)
+
+
+def get_local_index(config_key, index_class):
+    """
+    returns the local index of this worker in the file named by the configuration key, opened the first
+    time it is needed, None if there is no index configured or it could not be opened
+
+    :param config_key:
+    :param index_class:
+    :return:
+    """
+    filename = current_app.config[config_key]
+    if not filename:
+        return None
+    local_indexes = current_app.extensions.setdefault('local_indexes', {})
+    local_index = local_indexes.get(config_key, None)
+    if local_index is None or (local_index and local_index.filename != filename):
+        try:
+            local_index = index_class(filename)
+        except (IOError, OSError, ValueError) as e:
+            current_app.logger.error('unable to open %s %s: %s, querying solr instead' % (config_key, filename, str(e)))
+            # do not try again for every reference
+            local_index = False
+        local_indexes[config_key] = local_index
+    return local_index or None
+
+
+def get_identifier_index():
+    """
+    returns the identifier index of this worker, None if there is none
+
+    :return:
+    """
+    return get_local_index('REFERENCE_SERVICE_IDENTIFIER_INDEX', IdentifierIndex)
+
+
+def get_bibcode_index():
+    """
+    returns the bibcode index of this worker, None if there is none
+
+    :return:
+    """
+    return get_local_index('REFERENCE_SERVICE_BIBCODE_INDEX', BibcodeIndex)
@@ -0,0 +1,142 @@
+"""
+Statistics of which hypothesis resolves references, and the ordering of hypotheses learned from them.
+
+References are grouped by their shape, which fields were parsed and what kind of bibstem the
+publication was matched to. For each shape, the hypothesis producing the solution and the
+number of solr queries it took are recorded. Once there are enough observations for a shape,
+the hypotheses that most often produced the solution can be tried first.
+
+The ordering is selected by REFERENCE_SERVICE_HYPOTHESIS_ORDERING:
+    fixed   the order of Hypotheses.iter_hypotheses
+    learned the hypotheses that most often resolved references of the shape are tried first
+    shadow  the fixed order is used, and the learned order is evaluated as well to count how often
+            they agree, without affecting the solution
+"""
+
+import threading
+
+from referencesrv.resolver.common import SOURCE_MATCHER
+
+# fields of the digested record that make up the shape of a reference
+SHAPE_FIELDS = ['doi', 'arxiv', 'ascl', 'pub', 'volume', 'page', 'title', 'author', 'year']
+
+# source_hypothesis of the solutions not produced by a single hypothesis, these are not learned
+UNRESOLVED = 'not resolved'
+
+
+def get_bibstem_class(bibstem):
+    """
+    returns the kind of bibstem the publication was matched to
+
+    :param bibstem: bibstem of the digested record, None if there was no publication
+    :return:
+    """
+    if bibstem is None:
+        return 'none'
+    if not bibstem:
+        return 'unmatched'
+    if bibstem.endswith('*'):
+        return 'sections'
+    try:
+        if SOURCE_MATCHER.is_conf_stem(bibstem + '.' * (9 - len(bibstem))):
+            return 'conference'
+    except Exception:
+        # source matcher not loaded
+        pass
+    return 'journal'
+
+
+def get_reference_shape(ref):
+    """
+    returns a key describing which fields were parsed from the reference, and the kind of bibstem
+
+    :param ref: Hypotheses instance
+    :return:
+    """
+    digested_record = ref.get_detail()
+    fields = [field for field in SHAPE_FIELDS if digested_record.get(field, None)]
+    return '%s|%s' % (','.join(fields), get_bibstem_class(digested_record.get('bibstem', None)))
+
+
+class HypothesisStats(object):
+    """
+    per shape of reference, the number of references resolved by each hypothesis, and the solr queries it took
+    """
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        # shape -> hypothesis name -> [number of references, number of solr queries]
+        self.stats = {}
+
+    def record(self, shape, hypothesis_name, num_queries):
+        """
+
+        :param shape:
+        :param hypothesis_name: name of the hypothesis producing the solution, UNRESOLVED if there was none
+        :param num_queries: number of solr queries sent resolving the reference
+        :return:
+        """
+        with self.lock:
+            counts = self.stats.setdefault(shape, {}).setdefault(hypothesis_name, [0, 0])
+            counts[0] += 1
+            counts[1] += num_queries
+
+    def get_ranking(self, shape, min_observations):
+        """
+        returns the names of the hypotheses that resolved references of the shape, the one that resolved
+        the most first, an empty list if fewer than min_observations references of the shape have been seen
+
+        :param shape:
+        :param min_observations:
+        :return:
+        """
+        with self.lock:
+            counts = dict(self.stats.get(shape, {}))
+        if sum(count for count, _ in counts.values()) < min_observations:
+            return []
+        resolved = sorted(((count, name) for name, (count, _) in counts.items() if name != UNRESOLVED), reverse=True)
+        return [name for _, name in resolved]
+
+    def reorder(self, shape, hypotheses, min_observations):
+        """
+        returns the list of hypotheses with the ones named as the best hypothesis of the shape moved to the front,
+        None if there is no best hypothesis or it is tried first already
+
+        the best hypothesis is the one among hypotheses that resolved the most references of the shape,
+        the tied solutions are not produced by any single hypothesis, so are skipped
+
+        :param shape:
+        :param hypotheses: list of the hypotheses in the fixed order
+        :param min_observations:
+        :return:
+        """
+        names = set(hypothesis.name for hypothesis in hypotheses)
+        best = next((name for name in self.get_ranking(shape, min_observations) if name in names), None)
+        if best is None or hypotheses[0].name == best:
+            return None
+        return [hypothesis for hypothesis in hypotheses if hypothesis.name == best] + \
+               [hypothesis for hypothesis in hypotheses if hypothesis.name != best]
+
+    def to_dict(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            return dict((shape, dict((name, {'references': count, 'solr_queries': num_queries})
+                                     for name, (count, num_queries) in counts.items()))
+                        for shape, counts in self.stats.items())
+
+    def reset(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.stats = {}
+
+
+# statistics are kept per process
+hypothesis_stats = HypothesisStats()
@@ -0,0 +1,183 @@
+"""
+A deldict is a fuzzy dictionary like a trigdict, but it finds its
+candidates through a deletion index (as in SymSpell) rather than
+a trigram index.
+
+Each expansion is indexed under all the strings obtained by deleting
+up to max_distance characters from its prefix.  A search term then
+only needs to generate the deletions of its own prefix to find all
+the expansions within its edit distance, the candidates are verified
+by computing the actual edit distance.
+
+Unlike the trigram index, this finds nothing for search terms that
+are further off than the maximum edit distance, but for short
+abbreviations, which have only a few trigrams each matching a
+large number of expansions, it is both faster and more precise.
+"""
+
+import editdistance
+
+from referencesrv.resolver.pytrigdict import Trigdict
+
+
+def get_deletes(a_string, max_distance):
+    """
+    returns the set of strings obtained by deleting up to max_distance
+    characters from a_string, including a_string itself.
+
+    :param a_string:
+    :param max_distance:
+    :return:
+    """
+    deletes = set([a_string])
+    current = [a_string]
+    for _ in range(max_distance):
+        next_level = set()
+        for word in current:
+            for i in range(len(word)):
+                next_level.add(word[:i] + word[i+1:])
+        next_level -= deletes
+        deletes |= next_level
+        current = next_level
+    return deletes
+
+
+class DelIndex(object):
+    """
+    A deletion index.
+
+    This is a helper class for Deldict, a drop in replacement for
+    TrigIndex.  It is constructed with a list of strings (here: expansions).
+
+    The lookup method returns the expansions within the maximum edit
+    distance of its first argument, scored by their edit distance
+    relative to the length of the argument.
+    """
+    def __init__(self, expansions, max_distance=2, prefix_length=7):
+        """
+
+        :param expansions:
+        :param max_distance: maximum edit distance of a match
+        :param prefix_length: number of leading characters deletions are computed for
+        """
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.expansions = list(expansions)
+        self.build_index()
+
+    def build_index(self):
+        """
+
+        :return:
+        """
+        self.index = {}
+        self.positions = {}
+        for exp_ind, expansion in enumerate(self.expansions):
+            self.positions[expansion] = exp_ind
+            self.add_postings(exp_ind, expansion)
+
+    def add_postings(self, exp_ind, expansion):
+        """
+        adds exp_ind to the postings of all the deletions of the prefix of expansion.
+
+        :param exp_ind:
+        :param expansion:
+        :return:
+        """
+        for delete in get_deletes(expansion[:self.prefix_length], self.max_distance):
+            self.index.setdefault(delete, []).append(exp_ind)
+
+    def add(self, expansion):
+        """
+        adds expansion to the index.
+
+        :param expansion:
+        :return: True if expansion was added, False if it was already indexed
+        """
+        if expansion in self.positions:
+            return False
+        exp_ind = len(self.expansions)
+        self.expansions.append(expansion)
+        self.positions[expansion] = exp_ind
+        self.add_postings(exp_ind, expansion)
+        return True
+
+    def remove(self, expansion):
+        """
+        removes expansion from the index, its slot in self.expansions is left empty (None).
+
+        :param expansion:
+        :return: True if expansion was removed, False if it was not indexed
+        """
+        exp_ind = self.positions.pop(expansion, None)
+        if exp_ind is None:
+            return False
+        self.expansions[exp_ind] = None
+        for delete in get_deletes(expansion[:self.prefix_length], self.max_distance):
+            postings = self.index.get(delete)
+            if postings is not None:
+                postings.remove(exp_ind)
+                if not postings:
+                    del self.index[delete]
+        return True
+
+    def get_max_distance(self, search_term):
+        """
+        returns the maximum edit distance allowed for search_term, one edit
+        for every three characters, up to max_distance.
+
+        :param search_term:
+        :return:
+        """
+        return min(self.max_distance, len(search_term)//3)
+
+    def lookup(self, search_term, num_best=10):
+        """
+        returns a list of (expansion, score) for the expansions within the
+        maximum edit distance of search_term, where score is one minus the
+        edit distance relative to the length of search_term.
+
+        The result is sorted ascending, i.e., the best match is at
+        the end of the list.
+
+        :param search_term:
+        :param num_best:
+        :return:
+        """
+        max_distance = self.get_max_distance(search_term)
+        term_length = len(search_term)
+
+        exp_inds = set()
+        for delete in get_deletes(search_term[:self.prefix_length], max_distance):
+            exp_inds.update(self.index.get(delete, []))
+
+        candidates = []
+        for exp_ind in exp_inds:
+            expansion = self.expansions[exp_ind]
+            if abs(len(expansion)-term_length) > max_distance:
+                continue
+            distance = editdistance.eval(expansion, search_term)
+            if distance <= max_distance:
+                candidates.append((expansion, 1-float(distance)/term_length))
+
+        # the sort by key is so results are stable.
+        candidates.sort(key=lambda p: (p[1], p[0]))
+
+        return candidates[-num_best:]
+
+    def lookup_many(self, search_terms, num_best=10):
+        """
+        returns a list of lookup(search_term, num_best) for each of search_terms.
+
+        :param search_terms:
+        :param num_best:
+        :return:
+        """
+        return [self.lookup(search_term, num_best) for search_term in search_terms]
+
+
+class Deldict(Trigdict):
+    """A fuzzy dictionary with the interface of Trigdict, using a deletion index
+    instead of a trigram index.
+    """
+    index_class = DelIndex
@@ -10,7 +10,14 @@ the same, though.
 """
 
 import editdistance
+import numpy as np
 from itertools import chain
+from collections import defaultdict
+
+# the postings of the trigrams not in the index, shared and not cached, so that the trigrams
+# of the search terms do not grow the cache
+EMPTY_POSTINGS = np.empty(0, dtype=np.int64)
+EMPTY_POSTINGS.setflags(write=False)
 
 def get_trigrams(a_string):
     """
@@ -51,16 +58,90 @@ class TrigIndex(object):
 
     def build_index(self):
         """
+        builds the index in one pass over the expansions
         
         :return: 
         """
-        self.index = {}
+        index = defaultdict(set)
+        self.positions = {}
         for exp_ind, expansion in enumerate(self.expansions):
-            for trig in get_trigrams(expansion):
-               if trig in self.index:
-                   self.index[trig].add(exp_ind)
-               else:
-                   self.index[trig] = set([exp_ind])
+            self.positions[expansion] = exp_ind
+            for i in range(len(expansion)-2):
+                index[expansion[i:i+3]].add(exp_ind)
+        self.index = dict(index)
+        self.posting_arrays = None
+
+    def add_postings(self, exp_ind, expansion):
+        """
+        adds exp_ind to the postings of all the trigrams of expansion.
+
+        :param exp_ind:
+        :param expansion:
+        :return:
+        """
+        posting_arrays = getattr(self, 'posting_arrays', None)
+        for trig in get_trigrams(expansion):
+           if trig in self.index:
+               self.index[trig].add(exp_ind)
+           else:
+               self.index[trig] = set([exp_ind])
+           if posting_arrays:
+               posting_arrays.pop(trig, None)
+
+    def get_positions(self):
+        """
+        returns the mapping of expansions to their position in self.expansions
+
+        indexes pickled before incremental updates were supported do not
+        have this mapping, so build it on demand.
+
+        :return:
+        """
+        if getattr(self, 'positions', None) is None:
+            self.positions = dict((expansion, exp_ind) for exp_ind, expansion in enumerate(self.expansions)
+                                  if expansion is not None)
+        return self.positions
+
+    def add(self, expansion):
+        """
+        adds expansion to the index, only the postings of its trigrams are touched.
+
+        :param expansion:
+        :return: True if expansion was added, False if it was already indexed
+        """
+        positions = self.get_positions()
+        if expansion in positions:
+            return False
+        exp_ind = len(self.expansions)
+        self.expansions.append(expansion)
+        positions[expansion] = exp_ind
+        self.add_postings(exp_ind, expansion)
+        return True
+
+    def remove(self, expansion):
+        """
+        removes expansion from the index, only the postings of its trigrams are touched.
+
+        The slot of expansion in self.expansions is left empty (None), so that
+        positions of the other expansions remain valid.
+
+        :param expansion:
+        :return: True if expansion was removed, False if it was not indexed
+        """
+        exp_ind = self.get_positions().pop(expansion, None)
+        if exp_ind is None:
+            return False
+        self.expansions[exp_ind] = None
+        posting_arrays = getattr(self, 'posting_arrays', None)
+        for trig in set(get_trigrams(expansion)):
+            if posting_arrays:
+                posting_arrays.pop(trig, None)
+            postings = self.index.get(trig)
+            if postings is not None:
+                postings.discard(exp_ind)
+                if not postings:
+                    del self.index[trig]
+        return True
 
 
     def lookup(self, search_term, num_best=10):
@@ -95,6 +176,17 @@ class TrigIndex(object):
         min_hits = candidates[0][1]//2 or 1
         candidates = [c for c in candidates if c[1] >= min_hits]
 
+        return self.score_candidates(search_term, candidates, num_best)
+
+    def score_candidates(self, search_term, candidates, num_best):
+        """
+        helper for lookup and lookup_many, scores (exp_ind, hits) candidates of search_term
+
+        :param search_term:
+        :param candidates:
+        :param num_best:
+        :return:
+        """
         # Do some normalisation by the lengths of the search and
         # matched strings (this is badly heuristic and could do
         # with some principled approach)
@@ -123,6 +215,103 @@ class TrigIndex(object):
 
         return candidates[-num_best:]
 
+    def get_posting_array(self, trig):
+        """
+        returns the postings of trig as a numpy array, these are cached until
+        the postings of trig change, the trigrams not in the index are not cached.
+
+        :param trig:
+        :return:
+        """
+        posting_arrays = getattr(self, 'posting_arrays', None)
+        if posting_arrays is None:
+            posting_arrays = self.posting_arrays = {}
+        postings = posting_arrays.get(trig)
+        if postings is None:
+            if trig not in self.index:
+                return EMPTY_POSTINGS
+            postings = posting_arrays[trig] = np.fromiter(self.index[trig], dtype=np.int64)
+        return postings
+
+    def lookup_many(self, search_terms, num_best=10, max_postings=1<<20, max_counts=1<<22):
+        """
+        returns a list of lookup(search_term, num_best) for each of search_terms.
+
+        The trigram hits of the search terms are counted in vectorized passes
+        over the postings, each covering as many search terms as fit in
+        max_postings postings and max_counts (search term, expansion) counters,
+        only the edit distances of the candidates are computed one at a time.
+
+        :param search_terms:
+        :param num_best:
+        :param max_postings:
+        :param max_counts:
+        :return:
+        """
+        max_terms = max(max_counts // max(len(self.expansions), 1), 1)
+        results = []
+        postings = []
+        num_postings = 0
+        first = 0
+        for query_id, search_term in enumerate(search_terms):
+            term_postings = [self.get_posting_array(trig) for trig in get_trigrams(search_term)]
+            num_term_postings = sum(len(posting_array) for posting_array in term_postings)
+            if postings and (num_postings + num_term_postings > max_postings or len(postings) == max_terms):
+                results.extend(self.count_and_score(search_terms[first:query_id], postings, num_best))
+                postings, num_postings, first = [], 0, query_id
+            postings.append(term_postings)
+            num_postings += num_term_postings
+        if postings:
+            results.extend(self.count_and_score(search_terms[first:], postings, num_best))
+        return results
+
+    def count_and_score(self, search_terms, postings, num_best):
+        """
+        helper for lookup_many, counts the hits of search_terms given the postings of
+        their trigrams, and scores the candidates.
+
+        :param search_terms:
+        :param postings: for each search term, the list of posting arrays of its trigrams
+        :param num_best:
+        :return:
+        """
+        results = [[] for _ in search_terms]
+        lengths = [sum(len(posting_array) for posting_array in term_postings) for term_postings in postings]
+        if not sum(lengths):
+            return results
+
+        # count hits per (search term, expansion) pair, the keys come out sorted by search term
+        num_expansions = len(self.expansions)
+        query_ids = np.repeat(np.arange(len(search_terms), dtype=np.int64), lengths)
+        exp_inds = np.concatenate([posting_array for term_postings in postings for posting_array in term_postings])
+        counts = np.bincount(query_ids * num_expansions + exp_inds, minlength=len(search_terms) * num_expansions)
+        keys = np.flatnonzero(counts)
+        hits = counts[keys]
+        query_ids, exp_inds = np.divmod(keys, num_expansions)
+
+        # the same cut as in lookup, on half the number of hits of the top candidate of each search term
+        boundaries = np.flatnonzero(np.r_[True, query_ids[1:] != query_ids[:-1]])
+        ends = np.r_[boundaries[1:], len(keys)]
+        min_hits = np.maximum(np.maximum.reduceat(hits, boundaries) // 2, 1)
+        keep = hits >= np.repeat(min_hits, ends - boundaries)
+
+        for start, end in zip(boundaries.tolist(), ends.tolist()):
+            query_id = int(query_ids[start])
+            selected = keep[start:end]
+            candidates = zip(exp_inds[start:end][selected].tolist(), hits[start:end][selected].tolist())
+            results[query_id] = self.score_candidates(search_terms[query_id], candidates, num_best)
+        return results
+
+    def __getstate__(self):
+        """
+        the cached posting arrays are not pickled
+
+        :return:
+        """
+        state = self.__dict__.copy()
+        state.pop('posting_arrays', None)
+        return state
+
 
 class Trigdict(object):
     """A fuzzy dictionary.
@@ -142,14 +331,20 @@ class Trigdict(object):
     Feed a Trigdict using conventional assignments of expansions to
     bibstems.  
 
-    Note that after any change, the index will have to be re-computed, which
-    can be relatively time-consuming.  Hence, you should ideally build this
-    once and not add more items later.
+    The index is built on the first lookup, which can be relatively
+    time-consuming.  Once built, later assignments and removals only update
+    the postings of the trigrams of the affected expansions, so small
+    changes do not require the index to be re-computed.
 
     The expansions going in here are case-normalised (to uppercase).
     Consequently, the search terms are uppercased before matching,
     too.
+
+    The index is an instance of index_class, subclasses can plug in a
+    different index, implementing add, remove, lookup and lookup_many.
     """
+    index_class = TrigIndex
+
     def __init__(self):
         """
         
@@ -169,8 +364,56 @@ class Trigdict(object):
         if len(expansion)<3:
             self.shortdict.setdefault(expansion, []).append(value)
         else:
+            if self.index is not None and expansion not in self.val_dict:
+                self.index.add(expansion)
             self.val_dict.setdefault(expansion, []).append(value)
-        self.index = None
+
+    def __delitem__(self, expansion):
+        """
+
+        :param expansion:
+        :return:
+        """
+        if not self.remove(expansion):
+            raise KeyError(expansion)
+
+    def remove(self, expansion, value=None):
+        """
+        removes value from the values of expansion, or all the values if value is None.
+
+        If no values remain for expansion, it is removed from the index as well.
+
+        :param expansion:
+        :param value:
+        :return: number of values removed
+        """
+        expansion = expansion.upper()
+        the_dict = self.shortdict if len(expansion)<3 else self.val_dict
+        values = the_dict.get(expansion)
+        if not values:
+            return 0
+        if value is None:
+            num_removed = len(values)
+            values = []
+        else:
+            num_removed = values.count(value)
+            values = [v for v in values if v != value]
+        if values:
+            the_dict[expansion] = values
+        else:
+            del the_dict[expansion]
+            if self.index is not None and the_dict is self.val_dict:
+                self.index.remove(expansion)
+        return num_removed
+
+    def build_index(self):
+        """
+        builds the index of all the expansions entered so far, instead of
+        on the first lookup.
+
+        :return:
+        """
+        self.index = self.index_class(self.val_dict.keys())
 
     def exactmatch(self, expansion):
         """
@@ -192,7 +435,7 @@ class Trigdict(object):
         """
         expansion = expansion.upper()
         if self.index is None:
-            self.index = TrigIndex(self.val_dict.keys())
+            self.build_index()
 
         if len(expansion)<3:
             return [(1, w) for w in self.shortdict.get(expansion, [])]
@@ -218,6 +461,37 @@ class Trigdict(object):
         """
         return self.__getitem__(word, numitem)
 
+    def bestmatches_many(self, words, numitem):
+        """
+        returns bestmatches(word, numitem) for each of words.
+
+        Duplicate words are looked up once, and all the words are matched
+        against the index in one pass.
+
+        :param words:
+        :param numitem:
+        :return:
+        """
+        if self.index is None:
+            self.build_index()
+
+        matches = {}
+        to_lookup = []
+        for word in words:
+            expansion = word.upper()
+            if expansion in matches:
+                continue
+            if len(expansion)<3:
+                matches[expansion] = [(1, w) for w in self.shortdict.get(expansion, [])]
+            else:
+                matches[expansion] = None
+                to_lookup.append(expansion)
+
+        for expansion, candidates in zip(to_lookup, self.index.lookup_many(to_lookup, numitem)):
+            matches[expansion] = [(score, stem) for match, score in candidates for stem in self.val_dict[match]]
+
+        return [matches[word.upper()] for word in words]
+
     def values(self):
         """
         
@@ -225,6 +499,20 @@ class Trigdict(object):
         """
         return set(list(chain(*self.val_dict.values())))
 
+    def get_expansions(self, values):
+        """
+        returns a dict of each of values to the expansions it is a value of
+
+        :param values: set of values
+        :return:
+        """
+        expansions = dict((value, []) for value in values)
+        for the_dict in [self.shortdict, self.val_dict]:
+            for expansion, expansion_values in the_dict.items():
+                for value in values.intersection(expansion_values):
+                    expansions[value].append(expansion)
+        return expansions
+
     def has_key(self, key):
         """
 
@@ -9,20 +9,19 @@ generator.  The docstrings should say what kind of details they need.
 
 import regex as re
 
-from flask import current_app
-
 from referencesrv.resolver.authors import add_author_evidence, normalize_author_list
-from referencesrv.resolver.common import Evidences, Hypothesis
+from referencesrv.resolver.common import Evidences, Hypothesis, score_fields
 from referencesrv.resolver.journalfield import add_year_evidence, add_page_evidence, \
     add_publication_evidence, add_volume_evidence, has_thesis_indicators, add_title_evidence
 
-def get_author_year_score_for_input_fields(result_record, hypothesis):
+@score_fields('author_norm', 'first_author_norm')
+def get_author_score_for_input_fields(result_record, hypothesis):
     """
-    returns evidences based on just author and year.
+    returns evidences based on just author.
 
     :param result_record:
-    :param hypothesis: 
-    :return: 
+    :param hypothesis:
+    :return:
     """
     input_fields = hypothesis.get_detail('input_fields')
 
@@ -36,27 +35,59 @@ def get_author_year_score_for_input_fields(result_record, hypothesis):
         normalized_authors,
         result_record.get('author_norm'),
         result_record.get('first_author_norm'),
-        has_etal=hypothesis.get_detail('has_etal'))
+        has_etal=hypothesis.get_detail('has_etal'),
+        author_matcher=hypothesis.get_detail('author_matcher'))
+
+    return evidences
+
+
+@score_fields('year')
+def get_year_score_for_input_fields(result_record, hypothesis):
+    """
+    returns evidences based on just year.
+
+    :param result_record:
+    :param hypothesis:
+    :return:
+    """
+    input_fields = hypothesis.get_detail('input_fields')
+
+    evidences = Evidences()
 
     add_year_evidence(evidences,
         input_fields.get('year'),
-        result_record.get('year'))
+        result_record.get('year'),
+        hypothesis.get_detail('numeric_evidences'))
 
     return evidences
 
 
-def get_author_year_pub_score_for_input_fields(result_record, hypothesis):
+@score_fields(get_author_score_for_input_fields, get_year_score_for_input_fields)
+def get_author_year_score_for_input_fields(result_record, hypothesis):
     """
-    returns evidences based on just author, year and publication.
+    returns evidences based on just author and year.
+
+    :param result_record:
+    :param hypothesis: 
+    :return: 
+    """
+    return get_author_score_for_input_fields(result_record, hypothesis) + \
+           get_year_score_for_input_fields(result_record, hypothesis)
+
+
+@score_fields('pub', 'bibcode', 'bibstem')
+def get_pub_score_for_input_fields(result_record, hypothesis):
+    """
+    returns evidences based on just publication.
 
     :param result_record:
     :param hypothesis:
     :return:
     """
-    evidences = get_author_year_score_for_input_fields(result_record, hypothesis)
-
     input_fields = hypothesis.get_detail("input_fields")
 
+    evidences = Evidences()
+
     add_publication_evidence(evidences,
         input_fields.get("pub", ""),
         input_fields.get("bibstem",""),
@@ -68,6 +99,56 @@ def get_author_year_pub_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
+@score_fields(get_author_year_score_for_input_fields, get_pub_score_for_input_fields)
+def get_author_year_pub_score_for_input_fields(result_record, hypothesis):
+    """
+    returns evidences based on just author, year and publication.
+
+    :param result_record:
+    :param hypothesis:
+    :return:
+    """
+    return get_author_year_score_for_input_fields(result_record, hypothesis) + \
+           get_pub_score_for_input_fields(result_record, hypothesis)
+
+
+def score_cheap_first(result_record, hypothesis, steps, cheap_steps):
+    """
+    returns the evidences of the steps, in their order, computing the cheap steps first
+
+    When the evidences of the cheap steps already rule the candidate out, that is,
+    it has a veto not from the page, so it is neither the single non vetoed candidate
+    nor one with just a page veto inspect_doubtful_solutions stashes, and it cannot
+    reach the score choose_solution requires even if the other steps all add the
+    highest evidence, the other steps are skipped. The candidate is then rejected
+    just the same, only with fewer evidences.
+
+    Every one of the steps that are not cheap must add at most one evidence.
+
+    :param result_record:
+    :param hypothesis:
+    :param steps: score functions, in the order their evidences are added
+    :param cheap_steps: the ones to compute first, in the order of steps
+    :return:
+    """
+    cheap_evidences = [step(result_record, hypothesis) for step in cheap_steps]
+    settings = cheap_evidences[0].settings
+    if settings.lazy_evidences:
+        has_veto = False
+        # the largest margin over the score choose_solution requires the candidate can still reach
+        margin = (len(steps) - len(cheap_steps)) * max(0, settings.max_score - settings.min_score_first_round)
+        for evidences in cheap_evidences:
+            for evidence, label in zip(evidences.evidences, evidences.labels):
+                has_veto = has_veto or (evidence <= 0 and label != 'page')
+                margin += evidence - settings.min_score_first_round
+        if has_veto and margin < -1e-6:
+            steps = cheap_steps
+    evidences = Evidences(settings)
+    for step in steps:
+        evidences += cheap_evidences[cheap_steps.index(step)] if step in cheap_steps else step(result_record, hypothesis)
+    return evidences
+
+
 def match_ads_numeric_in_ref_str(ads_value, ref_str):
     """
 
@@ -107,6 +188,7 @@ def match_ads_numerics_with_ref_numeric(ads_numeric, ref_numeric, ads_numeric_ot
 
     return ref_matched, ref_found
 
+@score_fields('volume', 'page', 'issue', 'pub_raw', 'page_range', 'eid')
 def get_volume_page_score_for_input_fields(result_record, hypothesis):
     """
 
@@ -146,7 +228,8 @@ def get_volume_page_score_for_input_fields(result_record, hypothesis):
                             ref_volume,
                             ads_volume,
                             result_record.get('issue'),
-                            result_record.get('pub_raw'))
+                            result_record.get('pub_raw'),
+                            hypothesis.get_detail('numeric_evidences'))
     if ref_page:
         add_page_evidence(evidences,
                           ref_page,
@@ -159,6 +242,7 @@ def get_volume_page_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
+@score_fields(get_author_year_pub_score_for_input_fields, 'page', 'page_range', 'eid', 'title')
 def get_basic_score_for_input_fields(result_record, hypothesis):
     """
     returns a score between result_record and hypothesis.
@@ -210,20 +294,19 @@ def get_basic_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
-def get_serial_score_for_input_fields(result_record, hypothesis):
+@score_fields('title')
+def get_title_score_for_input_fields(result_record, hypothesis):
     """
-    returns Evidences for result_record matching hypothesis as a serial
-    publication.
+    returns evidences based on just title.
 
     :param result_record:
     :param hypothesis:
     :return:
     """
-    evidences = get_author_year_pub_score_for_input_fields(result_record, hypothesis) + \
-                get_volume_page_score_for_input_fields(result_record, hypothesis)
-
     input_fields = hypothesis.get_detail("input_fields")
 
+    evidences = Evidences()
+
     add_title_evidence(evidences,
         input_fields.get('title'),
         result_record.get('title', ''))
@@ -231,6 +314,25 @@ def get_serial_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
+@score_fields(get_author_year_pub_score_for_input_fields, get_volume_page_score_for_input_fields,
+              get_title_score_for_input_fields)
+def get_serial_score_for_input_fields(result_record, hypothesis):
+    """
+    returns Evidences for result_record matching hypothesis as a serial
+    publication.
+
+    :param result_record:
+    :param hypothesis:
+    :return:
+    """
+    return score_cheap_first(result_record, hypothesis,
+        [get_author_score_for_input_fields, get_year_score_for_input_fields, get_pub_score_for_input_fields,
+         get_volume_page_score_for_input_fields, get_title_score_for_input_fields],
+        [get_year_score_for_input_fields, get_volume_page_score_for_input_fields])
+
+
+@score_fields(get_author_year_score_for_input_fields, 'doctype', 'title', 'volume', 'issue', 'pub_raw',
+              'page', 'page_range', 'eid', 'bibcode', 'bibstem')
 def get_book_score_for_input_fields(result_record, hypothesis):
     """
     returns Evidences for result_record matching hypothesis as a book.
@@ -247,12 +349,12 @@ def get_book_score_for_input_fields(result_record, hypothesis):
 
     # if ads record is a book and reference record has no volume and page resolve it as if it is a book
     if result_record["doctype"] in ["book", "inbook", "techreport", "proceedings"]:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "doctype")
+        evidences.add_evidence(evidences.max_score, "doctype")
         if all([input_fields.get(key, None) == None for key in ['volume', 'page']]):
             add_title_evidence(evidences, input_fields.get("title", ""), result_record.get("title", ""))
             return evidences
     else:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][0], "doctype")
+        evidences.add_evidence(evidences.min_score, "doctype")
 
     # book does not have volume and page number
     # but if reference has score it so that we would not have false positive
@@ -260,7 +362,8 @@ def get_book_score_for_input_fields(result_record, hypothesis):
                         input_fields.get('volume', None),
                         result_record.get('volume', None),
                         result_record.get('issue'),
-                        result_record.get('pub_raw'))
+                        result_record.get('pub_raw'),
+                        hypothesis.get_detail('numeric_evidences'))
     add_page_evidence(evidences,
                       input_fields.get('page', None),
                       result_record.get('page', None),
@@ -280,6 +383,7 @@ def get_book_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
+@score_fields(get_author_year_pub_score_for_input_fields)
 def get_catalog_score_for_input_fields(result_record, hypothesis):
     """
 
@@ -300,6 +404,7 @@ def get_catalog_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
+@score_fields('doctype', 'author_norm', 'year', 'aff_raw')
 def get_thesis_score_for_input_fields(result_record, hypothesis):
     """
     returns Evidences for result_record being some sort of thesis matching
@@ -318,9 +423,9 @@ def get_thesis_score_for_input_fields(result_record, hypothesis):
 
     # consider only thesis records
     if result_record["doctype"] in ["phdthesis", "mastersthesis"]:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "doctype")
+        evidences.add_evidence(evidences.max_score, "doctype")
     else:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][0], "doctype")
+        evidences.add_evidence(evidences.min_score, "doctype")
 
     input_fields = hypothesis.get_detail("input_fields")
 
@@ -330,15 +435,16 @@ def get_thesis_score_for_input_fields(result_record, hypothesis):
         ref_lastname, ref_first_init = re.sub(r"[\s.]", "", hypothesis.get_detail("normalized_authors")).lower().split(",")
         ads_lastname, ads_first_init = re.sub(r"[\s.]", "", result_record["author_norm"][0].lower()).split(",")
         # lastname match is worth 0.7, first inital 0.3
-        author_score = int(ref_lastname==ads_lastname) * current_app.config["EVIDENCE_SCORE_RANGE"][1] * 0.7 + \
-                       int(ref_first_init==ads_first_init) * current_app.config["EVIDENCE_SCORE_RANGE"][1] * 0.3
+        author_score = int(ref_lastname==ads_lastname) * evidences.max_score * 0.7 + \
+                       int(ref_first_init==ads_first_init) * evidences.max_score * 0.3
     else:
-        author_score = current_app.config["EVIDENCE_SCORE_RANGE"][0]
+        author_score = evidences.min_score
     evidences.add_evidence(author_score, "author")
 
     add_year_evidence(evidences,
         input_fields.get('year'),
-        result_record.get('year'))
+        result_record.get('year'),
+        hypothesis.get_detail('numeric_evidences'))
 
     # count how many words of affiliation is in reference string
     ref_str = input_fields.get('refstr')
@@ -349,6 +455,8 @@ def get_thesis_score_for_input_fields(result_record, hypothesis):
     return evidences
 
 
+@score_fields(get_author_year_score_for_input_fields, get_volume_page_score_for_input_fields,
+              'title', 'pub_raw', 'bibcode', 'bibstem')
 def get_chapter_score_for_input_fields(result_record, hypothesis):
     """
     returns evidences based on author, year, volume and/or page, and publication or title,
@@ -358,9 +466,22 @@ def get_chapter_score_for_input_fields(result_record, hypothesis):
     :param hypothesis:
     :return:
     """
-    evidences = get_author_year_score_for_input_fields(result_record, hypothesis) + \
-                get_volume_page_score_for_input_fields(result_record, hypothesis)
+    return score_cheap_first(result_record, hypothesis,
+        [get_author_score_for_input_fields, get_year_score_for_input_fields,
+         get_volume_page_score_for_input_fields, get_chapter_pub_score_for_input_fields],
+        [get_year_score_for_input_fields, get_volume_page_score_for_input_fields])
+
+
+@score_fields('title', 'pub_raw', 'bibcode', 'bibstem')
+def get_chapter_pub_score_for_input_fields(result_record, hypothesis):
+    """
+    returns the evidence of the best match of the publication or title of the reference
+    against the title or publication of the chapter
 
+    :param result_record:
+    :param hypothesis:
+    :return:
+    """
     input_fields = hypothesis.get_detail("input_fields")
 
     # if comparing against inproceedigns record in solr, compare both pub and title
@@ -386,10 +507,11 @@ def get_chapter_score_for_input_fields(result_record, hypothesis):
     # add in a neutral pubstring evidence, it is needed not to have false positive
     if not track_evidence:
         track_evidence.add_evidence(0, "pubstring")
-    evidences = evidences + track_evidence
-    return evidences
+    return track_evidence
 
 
+@score_fields(get_chapter_score_for_input_fields, get_book_score_for_input_fields,
+              get_catalog_score_for_input_fields, get_serial_score_for_input_fields, 'doctype', 'year', 'volume')
 def get_score_for_input_fields(result_record, hypothesis):
     """
     computes the score based on the solr record doctype
@@ -410,6 +532,7 @@ def get_score_for_input_fields(result_record, hypothesis):
     return get_serial_score_for_input_fields(result_record, hypothesis)
 
 
+@score_fields('doi', 'identifier', 'bibcode')
 def get_score_for_reference_identifier(result_record, hypothesis):
     """
     returns Evidences for result_record matching if an identifier (doi or arXiv id) was matched
@@ -422,15 +545,15 @@ def get_score_for_reference_identifier(result_record, hypothesis):
     input_fields = hypothesis.get_detail("input_fields")
 
     if compare_doi(input_fields.get("doi", None), result_record.get("doi", [])):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     elif input_fields.get("arxiv", "not in ref") == get_arxiv_id_or_ascl_id(result_record):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     elif input_fields.get("ascl", "not in ref") == get_arxiv_id_or_ascl_id(result_record):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     elif compare_bibcode(input_fields.get("bibcode", None), result_record.get("bibcode", None), result_record.get("identifier", None)):
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][1], "bibcode")
+        evidences.add_evidence(evidences.max_score, "bibcode")
     else:
-        evidences.add_evidence(current_app.config["EVIDENCE_SCORE_RANGE"][0], "bibcode")
+        evidences.add_evidence(evidences.min_score, "bibcode")
 
     return evidences
 
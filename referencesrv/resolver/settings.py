@@ -0,0 +1,90 @@
+"""
+The configuration the resolver core reads while scoring.
+
+The scoring and evidence code used to read current_app.config for every candidate,
+which both costs a lookup through the flask context proxy in the innermost loops
+and ties the resolver to an app context. Instead, the values are taken from the
+configuration once, into an immutable ResolverSettings, that create_app installs
+for the process. Outside of the app, for example in the workers of a process pool
+or in an offline batch job, build the settings from a configuration dict and
+install them with configure_settings (in the initializer of the pool).
+
+Evidences keeps the settings it was created with, so the evidence functions read
+them from the evidences they add to.
+"""
+
+import logging
+
+from collections import namedtuple
+from types import MappingProxyType
+
+import regex as re
+
+from flask import current_app, has_app_context
+
+ResolverSettings = namedtuple('ResolverSettings', [
+    # EVIDENCE_SCORE_RANGE
+    'min_score', 'max_score',
+    'missing_first_author_factor',
+    'missing_volume_factor',
+    'no_letter_demerit',
+    'min_score_first_round',
+    'thesis_indicator_words',
+    # REFERENCE_SERVICE_STOP_WORDS, as a set for the title words and as a pattern for the pub string
+    'stop_words', 'stop_words_pattern',
+    'journal_abbreviation',
+    # REFERENCE_SERVICE_LAZY_EVIDENCES
+    'lazy_evidences',
+    'logger',
+])
+
+_settings = None
+
+
+def make_settings(config, logger=None):
+    """
+    returns the settings of the resolver taken from config
+
+    :param config: the app configuration, or a dict with the same keys
+    :param logger: defaults to the referencesrv logger
+    :return:
+    """
+    return ResolverSettings(
+        min_score=config['EVIDENCE_SCORE_RANGE'][0],
+        max_score=config['EVIDENCE_SCORE_RANGE'][1],
+        missing_first_author_factor=config['MISSING_FIRST_AUTHOR_FACTOR'],
+        missing_volume_factor=config['MISSING_VOLUME_FACTORY'],
+        no_letter_demerit=config['NO_LETTER_DEMERIT'],
+        min_score_first_round=config['MIN_SCORE_FIRST_ROUND'],
+        thesis_indicator_words=tuple(config['THESIS_INDICATOR_WORDS']),
+        stop_words=frozenset(config['REFERENCE_SERVICE_STOP_WORDS']),
+        stop_words_pattern=re.compile("\b({})\b".format("|".join(config['REFERENCE_SERVICE_STOP_WORDS']))),
+        journal_abbreviation=MappingProxyType(dict(config['JOURNAL_ABBREVIATION'])),
+        lazy_evidences=config['REFERENCE_SERVICE_LAZY_EVIDENCES'],
+        logger=logger or logging.getLogger('referencesrv'),
+    )
+
+
+def configure_settings(settings):
+    """
+    installs settings as the settings of the resolver in this process
+
+    :param settings: ResolverSettings
+    :return:
+    """
+    global _settings
+    _settings = settings
+
+
+def get_settings():
+    """
+    returns the settings of the resolver in this process, taken from the configuration
+    of the current app if none were installed
+
+    :return:
+    """
+    if _settings is None:
+        if not has_app_context():
+            raise RuntimeError('no resolver settings, call configure_settings outside of the app')
+        configure_settings(make_settings(current_app.config, current_app.logger))
+    return _settings
@@ -1,13 +1,299 @@
-import unidecode
 import json
 import requests
 import time
+import regex as re
+from functools import partial
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from flask import current_app, request
 from referencesrv.client import client
 
-from referencesrv.resolver.common import Solr
+from referencesrv.resolver.common import Solr, SolrTimeout, SolrUnavailable
+from referencesrv.resolver.authors import normalize_single_author, transliterate_author
+from referencesrv.metrics import counters
 from referencesrv.resolver.solrtestdata import get_test_data
+from referencesrv.resolver.latency import get_latency_tracker, get_hedge_executor, get_timeout, get_hedge_delay, \
+    send_timed, send_hedged
+from referencesrv.resolver.circuitbreaker import get_circuit_breaker
+
+# fields read from every solution, whatever the score function of the hypothesis (see solve.py)
+ALWAYS_QUERIED_FIELDS = ['bibcode', 'title']
+# fields massage_solution fills in from other fields of the record
+DERIVED_FIELDS = {
+    'author_norm': ['author', 'first_author_norm'],
+    'first_author_norm': ['author', 'author_norm'],
+    'eid': ['bibcode', 'identifier'],
+}
+# an entry of the fl parameter, either a field or a transformer, ie [fields author=10]
+QUERY_FIELD_ENTRY = re.compile(r"\[[^\]]*\]|[^,\[]+")
+TRANSFORMER_FIELD = re.compile(r"^\[fields (\w+)=")
+
+
+def get_query_fields(solr_fields):
+    """
+    returns the fields to request from solr for a score function reading solr_fields
+
+    :param solr_fields: fields declared for the score function, None if it did not declare them
+    :return: None to request all the configured fields
+    """
+    if solr_fields is None:
+        return None
+    query_fields = set(ALWAYS_QUERIED_FIELDS)
+    for field in solr_fields:
+        query_fields.add(field)
+        query_fields.update(DERIVED_FIELDS.get(field, []))
+    return frozenset(query_fields)
+
+
+def split_query_fields(query_fields):
+    """
+    returns the entries of the fl parameter, as a list of (field name, entry)
+
+    :param query_fields: fl parameter
+    :return:
+    """
+    entries = []
+    for entry in QUERY_FIELD_ENTRY.findall(query_fields):
+        entry = entry.strip()
+        if entry:
+            transformer = TRANSFORMER_FIELD.match(entry)
+            entries.append((transformer.group(1) if transformer else entry, entry))
+    return entries
+
+
+def decode_solr_response(response, use_orjson=True):
+    """
+    returns the decoded body of a response of solr
+
+    With orjson, if it is installed, the body is parsed straight from its bytes. Otherwise,
+    or if orjson rejects it, the body is decoded to a str and parsed with json.
+
+    :param response: with the content and text of the body, as a response of requests
+    :param use_orjson:
+    :return:
+    """
+    if use_orjson and orjson is not None:
+        try:
+            return orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(response.text)
+
+
+def normalize_authors(authors):
+    """
+    returns the author_norm of a record normalized, see normalize_single_author
+
+    :param authors:
+    :return:
+    """
+    return [normalize_single_author(author) for author in authors]
+
+
+def transliterate_authors(authors):
+    """
+    returns the author field of a record standing in for its author_norm
+
+    :param authors:
+    :return:
+    """
+    return [transliterate_author(author) for author in authors]
+
+
+def transliterate_first_author(author):
+    """
+    returns the first author of the author field of a record standing in for its first_author_norm
+
+    :param author:
+    :return:
+    """
+    return transliterate_author(author.lower())
+
+
+class SolrRecord(dict):
+    """
+    a record solr returned, with some of the fields normalized only when they are read
+
+    massage_solution puts the values of the author fields as they came from solr, and the
+    functions normalizing them in pending, so that the authors of the records that are
+    not scored on them (see score_cheap_first) are not normalized for nothing. Reading
+    a pending field, with [] or get, normalizes it. Anything working on the record as a
+    whole, copying it into another dict, comparing it, iterating its values, normalizes
+    all the pending fields first, so that the record can be used as the dict it was.
+
+    massage_solution also keeps the number of values of the page field, that it joins.
+    """
+    __slots__ = ('pending', 'num_pages')
+
+    def __init__(self, *args, **kwargs):
+        """
+
+        :param args:
+        :param kwargs:
+        """
+        dict.__init__(self, *args, **kwargs)
+        # field -> function normalizing its value
+        self.pending = {}
+        # number of values of the page field solr returned, None if not known
+        self.num_pages = None
+
+    def normalize(self, key=None):
+        """
+        normalizes the field key if it is pending, all the pending fields if key is None
+
+        :param key:
+        :return:
+        """
+        for field in ([key] if key is not None else list(self.pending)):
+            normalize = self.pending.pop(field, None)
+            if normalize is not None and dict.__contains__(self, field):
+                dict.__setitem__(self, field, normalize(dict.__getitem__(self, field)))
+
+    def __getitem__(self, key):
+        """
+
+        :param key:
+        :return:
+        """
+        if key in self.pending:
+            self.normalize(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        """
+
+        :param key:
+        :param default:
+        :return:
+        """
+        if key in self.pending:
+            self.normalize(key)
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        """
+
+        :param key:
+        :param value:
+        :return:
+        """
+        self.pending.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        """
+
+        :param key:
+        :return:
+        """
+        self.pending.pop(key, None)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *args):
+        """
+
+        :param key:
+        :param args:
+        :return:
+        """
+        self.normalize(key)
+        return dict.pop(self, key, *args)
+
+    def setdefault(self, key, default=None):
+        """
+
+        :param key:
+        :param default:
+        :return:
+        """
+        self.normalize(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        """
+
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        for key in dict(*args, **kwargs):
+            self.pending.pop(key, None)
+        dict.update(self, *args, **kwargs)
+
+    def __iter__(self):
+        """
+
+        :return:
+        """
+        # defined so that dict(record) and {**record} read the values with __getitem__
+        return dict.__iter__(self)
+
+    def items(self):
+        """
+
+        :return:
+        """
+        self.normalize()
+        return dict.items(self)
+
+    def values(self):
+        """
+
+        :return:
+        """
+        self.normalize()
+        return dict.values(self)
+
+    def copy(self):
+        """
+
+        :return:
+        """
+        self.normalize()
+        record = SolrRecord(self)
+        record.num_pages = self.num_pages
+        return record
+
+    def __eq__(self, other):
+        """
+
+        :param other:
+        :return:
+        """
+        self.normalize()
+        if isinstance(other, SolrRecord):
+            other.normalize()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        """
+
+        :param other:
+        :return:
+        """
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        """
+
+        :return:
+        """
+        self.normalize()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        """
+
+        :return:
+        """
+        self.normalize()
+        return (SolrRecord, (dict(self),), (None, {'num_pages': self.num_pages}))
+
 
 class Querier(object):
     def __init__(self):
@@ -17,6 +303,7 @@ class Querier(object):
         self.endpoint = current_app.config['REFERENCE_SERVICE_SOLRQUERY_URL']
         self.query_fields = current_app.config['REFERENCE_SERVICE_QUERY_FIELDS_SOLR']
         self.max_rows = current_app.config['REFERENCE_SERVICE_MAX_RECORDS_SOLR']
+        self.use_orjson = current_app.config['REFERENCE_SERVICE_SOLR_ORJSON']
         self.connect_solr = current_app.config['REFERENCE_SERVICE_LIVE']
         # some options return with the Bearer keyword and some do not
         # so grab the one that is available, remove the Bearer if present, to add it at the end
@@ -24,50 +311,100 @@ class Querier(object):
                         request.headers.get('X-Forwarded-Authorization', request.headers.get('Authorization', ''))
         self.Authorization = Authorization if 'Bearer' in Authorization else 'Bearer %s'%Authorization
 
-    def make_params(self, query):
+    def make_params(self, query, fields=None, rows=None):
         """
         returns a dictionary of params suitable for the ADS API.
 
         :param query:
+        :param fields: fields to request (see get_query_fields), None for all the configured ones
+        :param rows: number of documents to return, None for max_rows
         :return:
         """
+        if fields is None:
+            query_fields = self.query_fields
+        else:
+            query_fields = ','.join(entry for field, entry in split_query_fields(self.query_fields) if field in fields)
         return {
-            'fl': self.query_fields,
-            'rows': str(self.max_rows),
+            'fl': query_fields,
+            'rows': str(self.max_rows if rows is None else rows),
             'q': query,
         }
 
+    def send(self, params):
+        """
+        sends the query to solr, and returns the decoded response
 
-    def query(self, query):
+        :param params:
+        :return:
+        """
+        if not self.connect_solr:
+            return get_test_data()
+
+        breaker = get_circuit_breaker()
+        if not breaker.allow():
+            counters.increment('solr_circuit_rejections')
+            raise SolrUnavailable("circuit breaker open")
+
+        tracker = get_latency_tracker()
+        timeout = get_timeout(tracker, self.endpoint)
+        # the session is read here, the hedged requests are sent from other threads
+        send = partial(client().get, url=self.endpoint, headers={'Authorization': self.Authorization},
+                       params=params, timeout=timeout)
+        start_time = time.time()
+        succeeded = False
+        try:
+            try:
+                response = send_hedged(partial(send_timed, send, tracker, self.endpoint),
+                                       get_hedge_delay(tracker, self.endpoint), get_hedge_executor())
+            except requests.exceptions.Timeout:
+                counters.increment('solr_timeouts')
+                current_app.logger.error('Solr did not respond within {timeout:.2f} seconds.'.format(timeout=timeout))
+                raise SolrTimeout("timeout %.2f seconds"%timeout)
+            # a query solr rejected is not solr being degraded
+            succeeded = response.status_code < 500
+        finally:
+            # whatever went wrong, a request let through is accounted for
+            breaker.record(succeeded, time.time() - start_time)
+        current_app.logger.debug("Query executed in %s ms" % ((time.time() - start_time)*1000))
+
+        # all non-200 responses
+        if response.status_code != 200:
+            current_app.logger.error('Solr returned {response}.'.format(response=response))
+            raise Solr("status_code %s"%response.status_code)
+        return decode_solr_response(response, self.use_orjson)
+
+    def count(self, query):
+        """
+        returns the number of documents matching query, without fetching any of them
+
+        :param query:
+        :return:
+        """
+        counters.increment('count_probes')
+        from_solr = self.send(self.make_params(query, fields=['bibcode'], rows=0))
+        return from_solr['response'].get('numFound', 0)
+
+    def query(self, query, fields=None, probe=False):
         """
         executes query, and returns the result.
 
         If query yields exactly max_rows fields, we have an overflow.
 
         :param query:
+        :param fields: fields to request, None for all the configured ones
+        :param probe: if True, the documents are counted first, and fetched only if they do not overflow
         :return:
         """
         current_app.logger.debug('Query is %s' % (query))
+        if probe and self.count(query) >= self.max_rows:
+            counters.increment('count_probes_overflowed')
+            current_app.logger.error('solr overflow exception: query {query} counted more than {num_rows} rows'.format(query=query, num_rows=self.max_rows))
+            return None
+
+        counters.increment('solr_queries')
         solutions = []
 
-        if self.connect_solr:
-            start_time = time.time()
-            response = client().get(
-                url=self.endpoint,
-                headers={'Authorization': self.Authorization},
-                params=self.make_params(query),
-                timeout=10
-            )
-            current_app.logger.debug("Query executed in %s ms" % ((time.time() - start_time)*1000))
-
-            # all non-200 responses
-            if response.status_code != 200:
-                current_app.logger.error('Solr returned {response}.'.format(response=response))
-                raise Solr("status_code %s"%response.status_code)
-            else:
-                from_solr = json.loads(response.text)
-        else:
-            from_solr = get_test_data()
+        from_solr = self.send(self.make_params(query, fields))
 
         num_docs = from_solr['response'].get('numFound', 0)
         current_app.logger.debug('YIELD num_docs=%s' %(num_docs))
@@ -94,7 +431,7 @@ class Querier(object):
         :param author_string:
         :return:
         """
-        return unidecode.unidecode(author_string).replace('-', ' ').lower()
+        return normalize_single_author(author_string)
 
     def massage_solution(self, raw_sol):
         """
@@ -105,26 +442,31 @@ class Querier(object):
 
         raw_sol is processed in-place, but that's an implementation detail.
         Just append what this function returns and don't use the reference
-        to the argument any more.
+        to the argument any more. What it returns is a SolrRecord, with the
+        author fields normalized when they are read.
 
         :param raw_sol:
         :return:
         """
+        raw_sol = SolrRecord(raw_sol)
+        # the authors are normalized when they are read
         if 'author_norm' in raw_sol:
-            raw_sol['author_norm'] = [self.normalize_single_author(author) for author in raw_sol['author_norm']]
-            raw_sol['first_author_norm'] = self.normalize_single_author(raw_sol['first_author_norm'])
+            raw_sol.pending.update(author_norm=normalize_authors, first_author_norm=normalize_single_author)
         else:
             # some records don't have author_norm; put in some emergency
             # stuff and fix as we understand the problem better (we need
             # author_norm for verification)
-            raw_sol['author_norm'] = [unidecode.unidecode(s) for s in raw_sol.get('author', [])]
+            raw_sol['author_norm'] = raw_sol.get('author', [])
+            raw_sol.pending['author_norm'] = transliterate_authors
             # unidecode posts warning if passed an empty string
-            first_author = raw_sol.get('author', [''])[0].lower()
+            first_author = raw_sol.get('author', [''])[0]
             if first_author:
-                raw_sol['first_author_norm'] = unidecode.unidecode(first_author)
+                raw_sol['first_author_norm'] = first_author
+                raw_sol.pending['first_author_norm'] = transliterate_first_author
 
         # two fields of page, and title are lists, turn them into strings
         if 'page' in raw_sol:
+            raw_sol.num_pages = len(raw_sol['page']) if isinstance(raw_sol['page'], list) else 1
             raw_sol['page'] = ''.join(raw_sol['page'])
         if 'title' in raw_sol:
             raw_sol['title'] = ''.join(raw_sol['title'])
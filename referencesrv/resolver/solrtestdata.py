@@ -1,3 +1,8 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 
 def get_test_data():
     """
@@ -45,4 +50,87 @@ def get_test_data():
                       u'page': [u'381.08']}
                  ]
                  }
-            }
\ No newline at end of file
+            }
+
+
+class FakeSolrServer(ThreadingMixIn, HTTPServer):
+    """
+    answers each request in its own thread, so that a slow response does not hold up the others
+    """
+    daemon_threads = True
+
+
+class FakeSolr(object):
+    """
+    a local solr, answering every query with the test data after a delay, to exercise the requests
+    to solr against slow responses
+    """
+    def __init__(self, get_delay=None):
+        """
+
+        :param get_delay: function returning the delay in seconds of the next response, no delay if None
+        """
+        self.get_delay = get_delay or (lambda: 0)
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        fake_solr = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                """
+
+                :return:
+                """
+                with fake_solr.lock:
+                    fake_solr.num_requests += 1
+                    delay = fake_solr.get_delay()
+                time.sleep(delay)
+                body = json.dumps(get_test_data()).encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting
+                    pass
+
+            def log_message(self, format, *args):
+                """
+
+                :param format:
+                :param args:
+                :return:
+                """
+                pass
+
+        self.server = FakeSolrServer(('127.0.0.1', 0), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        """
+
+        :return: the url to query
+        """
+        return 'http://127.0.0.1:%d/v1/search/query' % self.server.server_address[1]
+
+    def start(self):
+        """
+
+        :return:
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -5,13 +5,23 @@ Evaluating hypotheses and working out which is acceptable.
 import regex as re
 import urllib
 import traceback
+import logging
 
+from functools import lru_cache, partial
 from flask import current_app
 
-from referencesrv.resolver.common import Undecidable, NoSolution, Solution, OverflowOrNone, Solr, Incomplete, sorted2
-from referencesrv.resolver.solrquery import Querier
+from referencesrv.resolver.common import Undecidable, NoSolution, Solution, OverflowOrNone, Solr, Incomplete, \
+    Evidences, SolrTimeout
+from referencesrv.resolver.solrquery import Querier, get_query_fields
 from referencesrv.resolver.hypotheses import Hypotheses
-from referencesrv.resolver.authors import normalize_author_list
+from referencesrv.resolver.candidatepool import CandidatePool
+from referencesrv.resolver.speculative import SpeculativeQuerier
+from referencesrv.resolver.ordering import get_reference_shape, hypothesis_stats, UNRESOLVED
+from referencesrv.resolver.localindex import get_identifier_index, get_bibcode_index, IDENTIFIER_KEYS
+from referencesrv.metrics import counters, hypothesis_counters
+from referencesrv.resolver.authors import normalize_author_list, AUTHOR_MEMO_SIZE
+from referencesrv.resolver.settings import get_settings
+from referencesrv.resolver.columnar import get_numeric_evidences
 
 # metacharacters and reserved words of the ADS solr parser
 SOLR_ESCAPABLE = re.compile(r"""(?i)([-]|\bto\b|\band\b|\bor\b|\bnot\b|\bnear\b)""")
@@ -21,13 +31,19 @@ REMOVE_PUNCTUATION = re.compile(r"[()\[\]:\\/*?\"+~^,=#'{}]")
 AUTHOR_LAST_NAME = re.compile(r"([A-Z][A-Za-z\-]+)")
 AUTHOR_LAST_NAME_CASE_INSENSITIVE = re.compile(r"([A-Za-z]+)")
 
+# the characters the first character of a page is replaced with in the page condition
+PAGE_FIRST_CHARACTERS = [chr(i) for i in range(ord('a'),ord('z')+1)] + [chr(i) for i in range(ord('0'),ord('9')+1)]
+
 # mappings from standard hint keys to actual solr keywords
 # this is so that renaming solr indices would not affect hypothesis generation.
 HINT_TO_SOLR_KEYS = {
 }
 
+@lru_cache(maxsize=AUTHOR_MEMO_SIZE)
 def make_solr_condition_author(value):
     """
+    returns the query fragment of the author list value, memoized, since the hypotheses
+    of a reference query on the same author list
 
     :param value:
     :return:
@@ -116,8 +132,7 @@ def make_solr_condition(key, value):
         # return "page:(%s)"%(" or ".join('"%s"'%(value[:i]+'?'+value[i+1:]) for i in range(len(value))))
         # 8/22 wildcard ? preceding any character has gone away
         # as per Roman setup query with all lower and single digits
-        first_char = [chr(i) for i in range(ord('a'),ord('z')+1)] + [chr(i) for i in range(ord('0'),ord('9')+1)]
-        return "page:(%s or %s)"%(" or ".join(['"' + i +  value[1:] + '"' for i in first_char]),
+        return "page:(%s or %s)"%(" or ".join(['"' + i +  value[1:] + '"' for i in PAGE_FIRST_CHARACTERS]),
                                   " or ".join('"%s"'%(value[:i]+'?'+value[i+1:]) for i in range(1,len(value))))
 
     if key=='title':
@@ -188,19 +203,20 @@ def inspect_ambiguous_solutions(scored_solutions, query_string, hypothesis):
     :return:
     """
     # Let's see if the problem goes away if we discard all vetoed solutions
+    settings = get_settings()
     non_vetoed = [(evidences, sol) for evidences, sol in scored_solutions if not evidences.has_veto()]
 
     if len(non_vetoed) == 1:
-        current_app.logger.debug("Only one non-vetoed solution, returning it.")
+        settings.logger.debug("Only one non-vetoed solution, returning it.")
         return non_vetoed[0]
 
     if not non_vetoed:
-        current_app.logger.debug("All ambiguous solutions vetoed, inspecting with doubts.")
+        settings.logger.debug("All ambiguous solutions vetoed, inspecting with doubts.")
         return inspect_doubtful_solutions(scored_solutions, query_string, hypothesis)
 
     # If the leader has at least one evidence more than the runner-up, accept it
     if len(non_vetoed[-1][0])>len(non_vetoed[-2][0]):
-        current_app.logger.debug("Accepting solution on larger number of evidences.")
+        settings.logger.debug("Accepting solution on larger number of evidences.")
         return non_vetoed[-1]
 
     # With books, it frequently happens that two entries exist for the
@@ -209,15 +225,28 @@ def inspect_ambiguous_solutions(scored_solutions, query_string, hypothesis):
     t1 = non_vetoed[-1][1]["title"].lower().strip()
     t2 = non_vetoed[-2][1]["title"].lower().strip()
     if t1 and t2 and t1.startswith(t2) or t2.startswith(t1):
-        current_app.logger.debug("Breaking ambiguity with %s suspecting it's a duplicate book"%non_vetoed[-2][1]["bibcode"])
+        settings.logger.debug("Breaking ambiguity with %s suspecting it's a duplicate book", non_vetoed[-2][1]["bibcode"])
         return non_vetoed[-1]
 
     to_stash = [(score.get_score(), sol["bibcode"])
-                for score, sol in non_vetoed if score>current_app.config['EVIDENCE_SCORE_RANGE'][0]]
-    current_app.logger.debug("Unsolved ambiguity, stashing %s"%(to_stash))
+                for score, sol in non_vetoed if score>settings.min_score]
+    settings.logger.debug("Unsolved ambiguity, stashing %s", to_stash)
     raise Undecidable("Ambiguous %s."%(query_string), considered_solutions=to_stash)
 
 
+def sort_scored(scored):
+    """
+    returns the (evidences, solution) pairs in the order sorted2 puts them in
+
+    sorted2 orders the pairs by their string form, which starts with the repr of the evidences,
+    that differs for every pair, so the solutions do not need to be formatted to sort them
+
+    :param scored: list of (evidences, solution)
+    :return:
+    """
+    return sorted(scored, key=lambda item: repr(item[0]))
+
+
 def choose_solution(candidates, query_string, hypothesis):
     """
     returns the preferred solution from among candidates.
@@ -232,22 +261,23 @@ def choose_solution(candidates, query_string, hypothesis):
     :param hypothesis:
     :return:
     """
-    min_score = current_app.config['MIN_SCORE_FIRST_ROUND']
+    settings = get_settings()
+    min_score = settings.min_score_first_round
     filtered = [(score, solution) for score, solution in candidates if score >= min_score*len(score)]
 
     if len(filtered)==0:
         if candidates:
-            current_app.logger.debug("No score above minimal score, inspecting doubtful solutions.")
+            settings.logger.debug("No score above minimal score, inspecting doubtful solutions.")
             return inspect_doubtful_solutions(candidates, query_string, hypothesis)
         raise NoSolution("Not even a doubtful solution")
 
     elif len(filtered)==1:
-        current_app.logger.debug("Accepting single unique solution")
+        settings.logger.debug("Accepting single unique solution")
         evidence, solution =  filtered[0]
         return evidence, solution
 
     elif len(filtered)>1:
-        current_app.logger.debug("Trying to disentangle multiple equal-scored solutions")
+        settings.logger.debug("Trying to disentangle multiple equal-scored solutions")
         # get all equal-scored matches with the highest scores
         best_score = max(item[0].get_score() for item in filtered)
         best_solution = [(ev, solution) for ev, solution in filtered if ev.get_score()==best_score]
@@ -255,40 +285,215 @@ def choose_solution(candidates, query_string, hypothesis):
             evidence, solution = best_solution[0]
             return evidence, solution
         else:
-            current_app.logger.debug("...impossible")
+            settings.logger.debug("...impossible")
             raise Undecidable("%s solutions with equal (good) score."%len(best_solution))
 
 
-def solve_for_fields(hypothesis):
+class QueryCompiler(object):
     """
-    returns a record matching hypothesis or raises NoSolution.
+    the solr query fragments of the hints of the hypotheses of one reference
 
-    This does the actual query of the solr server and has the
-    hypothesis evaluate whatever comes back.
+    The hypotheses of a reference share most of their hints, the same authors, year,
+    page, in different combinations, so each fragment is made once, the first time
+    a hypothesis has the hint, and the queries of the others are put together from
+    the fragments already made.
+    """
+    def __init__(self):
+        """
+
+        """
+        # (key, value) -> solr query fragment, None if the hint makes no condition
+        self.conditions = {}
+
+    def make_condition(self, key, value):
+        """
+        returns the solr query fragment of the hint, see make_solr_condition
+
+        :param key:
+        :param value:
+        :return:
+        """
+        try:
+            return self.conditions[(key, value)]
+        except KeyError:
+            condition = self.conditions[(key, value)] = make_solr_condition(key, value)
+            return condition
+
+
+def make_solr_conditions(hints, query_compiler=None):
+    """
+    returns a dict of hint key to solr query fragment, for the hints that make a condition
+
+    :param hints:
+    :param query_compiler: QueryCompiler of the reference, if given the fragments it made already are reused
+    :return:
+    """
+    make_condition = query_compiler.make_condition if query_compiler is not None else make_solr_condition
+    conditions = {}
+    for key, value in hints.items():
+        condition = make_condition(key, value)
+        if condition is not None:
+            conditions[key] = condition
+    return conditions
+
+
+def make_query_string(hypothesis, query_compiler=None):
+    """
+    returns the solr query for hypothesis
 
     :param hypothesis:
+    :param query_compiler: QueryCompiler of the reference
     :return:
     """
-    if not hasattr(solve_for_fields, "query"):
-        QUERIER = Querier()
-        query = QUERIER.query
+    return " AND ".join(make_solr_conditions(hypothesis.hints, query_compiler).values())
+
+
+def get_hypothesis_conditions(hypothesis, query_compiler=None):
+    """
+    returns a dict of hint key to solr query fragment, for the hints of hypothesis that make a condition
 
-    current_app.logger.debug("HINTS IN %s: %s"%(hypothesis.name, hypothesis.hints))
+    :param hypothesis:
+    :param query_compiler: QueryCompiler of the reference
+    :return:
+    """
+    return make_solr_conditions(hypothesis.hints, query_compiler)
 
-    query_string = " AND ".join(cond for cond in (make_solr_condition(*item)
-                                                  for item in hypothesis.hints.items()) if cond is not None)
 
-    solutions = query(query_string)
+def get_hypothesis_fields(hypothesis):
+    """
+    returns the fields to request from solr for hypothesis, None for all of them
+
+    :param hypothesis:
+    :return:
+    """
+    if not current_app.config['REFERENCE_SERVICE_FIELD_PROJECTION']:
+        return None
+    return get_query_fields(hypothesis.get_solr_fields())
+
+
+def probe_first(hypothesis):
+    """
+    returns True if the documents matching hypothesis are to be counted before they are fetched,
+    for the broad hypotheses that often overflow
+
+    :param hypothesis:
+    :return:
+    """
+    return bool(hypothesis.get_detail('broad')) and current_app.config['REFERENCE_SERVICE_COUNT_PROBE']
+
+
+def get_query_args(hypothesis, query_compiler=None):
+    """
+    returns the arguments of Querier.query for hypothesis, the query string, the fields and probe,
+    None if the query of hypothesis is not sent to solr, but answered from the bibcode index
+
+    :param hypothesis:
+    :param query_compiler: QueryCompiler of the reference
+    :return:
+    """
+    if match_bibcode_index(hypothesis) is not None:
+        return None
+    return make_query_string(hypothesis, query_compiler), get_hypothesis_fields(hypothesis), probe_first(hypothesis)
+
+
+def match_bibcode_index(hypothesis):
+    """
+    returns the bibcodes of the records matching the constructed bibcode of hypothesis, if it is
+    a fielded-bibcode one and the local bibcode index can match its pattern, otherwise None
+
+    :param hypothesis:
+    :return:
+    """
+    if list(hypothesis.hints.keys()) != ['bibcode']:
+        return None
+    bibcode_index = get_bibcode_index()
+    if bibcode_index is None:
+        return None
+    return bibcode_index.match(hypothesis.hints['bibcode'], current_app.config['REFERENCE_SERVICE_MAX_RECORDS_SOLR'])
+
+
+def query_bibcode_index(hypothesis, query, fields):
+    """
+    returns the documents solr would return for the constructed bibcode of hypothesis, by fetching
+    the records the bibcode index matches in one query on their bibcodes, None if the index does not
+    match the pattern
+
+    :param hypothesis:
+    :param query:
+    :param fields:
+    :return:
+    """
+    bibcodes = match_bibcode_index(hypothesis)
+    if bibcodes is None:
+        return None
+    counters.increment('bibcode_index_matched')
+    if not bibcodes:
+        return []
+    return query('bibcode:(%s)' % ' OR '.join('"%s"' % bibcode for bibcode in bibcodes), fields)
+
+
+def solve_for_fields(hypothesis, candidate_pool=None, query=None, query_compiler=None):
+    """
+    returns a record matching hypothesis or raises NoSolution.
+
+    This does the actual query of the solr server and has the
+    hypothesis evaluate whatever comes back.
+
+    :param hypothesis:
+    :param candidate_pool: if given, a query already executed for the reference is not executed again,
+                           the hypothesis is evaluated on the documents of an earlier query when possible,
+                           and the documents solr returns are added to it
+    :param query: function executing the query, if not given a Querier is created
+    :param query_compiler: QueryCompiler of the reference, the query is put together from the fragments
+                           it made for the hypotheses evaluated before
+    :return:
+    """
+    if query is None:
+        query = Querier().query
+
+    logger = get_settings().logger
+    # the solutions and their evidences are only formatted when they are logged
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("HINTS IN %s: %s", hypothesis.name, hypothesis.hints)
+
+    conditions = make_solr_conditions(hypothesis.hints, query_compiler)
+    query_string = " AND ".join(conditions.values())
+    fields = get_hypothesis_fields(hypothesis)
+    probe = probe_first(hypothesis)
+
+    if candidate_pool is None:
+        solutions = query_bibcode_index(hypothesis, query, fields)
+        if solutions is None:
+            solutions = query(query_string, fields, probe)
+            hypothesis_counters.record(hypothesis.name, solutions is None, probe)
+    elif candidate_pool.has_result(query_string, fields):
+        # the query came back with the same documents, empty, or overflowed for an earlier
+        # hypothesis, the documents are scored again under this hypothesis
+        solutions = candidate_pool.get_result(query_string)
+    else:
+        solutions = candidate_pool.refine(hypothesis.hints, conditions, fields)
+        if solutions is None:
+            solutions = query_bibcode_index(hypothesis, query, fields)
+        if solutions is None:
+            solutions = query(query_string, fields, probe)
+            candidate_pool.num_queried += 1
+            hypothesis_counters.record(hypothesis.name, solutions is None, probe)
+        candidate_pool.add(query_string, conditions, solutions, fields)
 
     if solutions:
         if len(solutions) > 0:
-            current_app.logger.debug("solutions: %s"%(solutions))
+            if debug:
+                logger.debug("solutions: %s", solutions)
 
-            scored = list(sorted2((hypothesis.get_score(s, hypothesis), s) for s in solutions))
+            if current_app.config['REFERENCE_SERVICE_COLUMNAR_SCORING']:
+                hypothesis.details['numeric_evidences'] = get_numeric_evidences(hypothesis, solutions)
+            scored = sort_scored([(hypothesis.get_score(s, hypothesis), s) for s in solutions])
 
-            current_app.logger.debug("evidences from %s"%(hypothesis.name))
-            for score, sol in sorted2(scored):
-                current_app.logger.debug("score %s %s %s"%(sol['bibcode'], score.get_score(), score))
+            if debug:
+                logger.debug("evidences from %s", hypothesis.name)
+                for score, sol in scored:
+                    logger.debug("score %s %s %s", sol['bibcode'], score.get_score(), score)
 
             score, sol = choose_solution(scored, query_string, hypothesis)
 
@@ -321,34 +526,101 @@ def enough_to_proceed(ref):
     return False
 
 
-def solve_reference(ref):
+def lookup_identifier_index(ref):
     """
-    returns a solution for what record is presumably meant by ref.
+    returns (hypothesis name, bibcode) of the leading identifier hypotheses of ref, doi, arXiv id and
+    ascl id, if the local identifier index answers them, otherwise None and these are queried in solr
+
+    the hypotheses are answered in order, up to the first one the index does not answer, so that
+    an identifier that is not in the index is still queried in solr before the next one is tried
+
+    :param ref:
+    :return:
+    """
+    identifier_index = get_identifier_index()
+    if identifier_index is None:
+        return None
+    for hypothesis in Hypotheses.iter_hypotheses(ref):
+        if len(hypothesis.hints) != 1:
+            break
+        key, value = list(hypothesis.hints.items())[0]
+        if key not in IDENTIFIER_KEYS:
+            break
+        bibcodes = identifier_index.get_bibcodes(key, value)
+        if len(bibcodes) != 1:
+            # solr would return either nothing or more than one record, let solr and the scoring decide
+            break
+        return hypothesis.name, bibcodes[0]
+    return None
+
+
+def solve_from_identifier_index(ref):
+    """
+    returns the solution of ref if the local identifier index answers its identifier hypotheses, otherwise None
+
+    :param ref:
+    :return:
+    """
+    if get_identifier_index() is None:
+        return None
+    found = lookup_identifier_index(ref)
+    if found is None:
+        counters.increment('identifier_index_misses')
+        return None
+    counters.increment('identifier_index_hits')
+    hypothesis_name, bibcode = found
+    # the same evidence get_score_for_reference_identifier gives for a matching identifier
+    evidences = Evidences()
+    evidences.add_evidence(evidences.max_score, 'bibcode')
+    return Solution(bibcode, evidences, hypothesis_name)
+
+
+def solve_hypotheses(ref, hypotheses, candidate_pool, query_compiler=None):
+    """
+    returns the solution of the first of hypotheses that has one, or the best of the tied solutions.
 
-    ref is an instance of Reference (or rather, its subclasses).
     If no matching record is found, NoSolution is raised.
+
     :param ref:
+    :param hypotheses: iterator of the hypotheses, in the order they are to be evaluated
+    :param candidate_pool:
+    :param query_compiler: QueryCompiler of ref, a new one if not given
     :return:
     """
-    if not enough_to_proceed(ref):
-        current_app.logger.error("Not enough information to resolve the record")
-        raise Incomplete("Not enough information to resolve the record.", str(ref))
+    if query_compiler is None:
+        query_compiler = QueryCompiler()
+    querier = Querier()
+    window = current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW']
+    if window > 1:
+        # send the queries of the next hypotheses ahead of time, they are still evaluated in order
+        querier = SpeculativeQuerier(querier, partial(get_query_args, query_compiler=query_compiler),
+                                     partial(get_hypothesis_conditions, query_compiler=query_compiler),
+                                     candidate_pool, window, current_app.config['REFERENCE_SERVICE_SPECULATIVE_BUDGET'])
+        hypotheses = querier.iter_hypotheses(hypotheses)
 
     possible_solutions = []
     reason = None
-    for hypothesis in Hypotheses.iter_hypotheses(ref):
-        try:
-            return solve_for_fields(hypothesis)
-        except Undecidable as ex:
-            possible_solutions.extend(ex.considered_solutions)
-            reason = ex.reason
-        except (NoSolution, OverflowOrNone) as ex:
-            current_app.logger.debug("(%s)"%ex.__class__.__name__)
-        except (Solr, KeyboardInterrupt):
-            raise
-        except Exception as ex:
-            current_app.logger.error("Unhandled exception of type {0} occurred with arguments:{1!r}, thus killing a single hypothesis.".format(type(ex).__name__, ex.args))
-            current_app.logger.error(traceback.format_exc())
+    try:
+        for hypothesis in hypotheses:
+            try:
+                return solve_for_fields(hypothesis, candidate_pool, querier.query, query_compiler)
+            except Undecidable as ex:
+                possible_solutions.extend(ex.considered_solutions)
+                reason = ex.reason
+            except (NoSolution, OverflowOrNone) as ex:
+                current_app.logger.debug("(%s)"%ex.__class__.__name__)
+            except SolrTimeout as ex:
+                # a slow query is not solr being down, the next hypotheses are still tried
+                hypothesis_counters.record_timeout(hypothesis.name)
+                current_app.logger.error("Solr timed out ({0}), thus killing a single hypothesis {1}.".format(ex, hypothesis.name))
+            except (Solr, KeyboardInterrupt):
+                raise
+            except Exception as ex:
+                current_app.logger.error("Unhandled exception of type {0} occurred with arguments:{1!r}, thus killing a single hypothesis.".format(type(ex).__name__, ex.args))
+                current_app.logger.error(traceback.format_exc())
+    finally:
+        if isinstance(querier, SpeculativeQuerier):
+            querier.close()
 
     # if we have collected possible solutions for which we didn't want
     # to decide the first time around, now see if any one is better than
@@ -372,3 +644,84 @@ def solve_reference(ref):
     if reason:
         raise NoSolution("Hypotheses exhausted", "%s -- %s"%(reason, str(ref)))
     raise NoSolution("Hypotheses exhausted", str(ref))
+
+
+def shadow_learned_ordering(ref, shape, solution, candidate_pool, query_compiler=None):
+    """
+    resolves ref with the learned ordering of hypotheses as well, and counts if the solution agrees
+    with the one of the fixed ordering
+
+    the queries sent for the fixed ordering are answered from the candidate pool; whatever goes wrong
+    here is counted and logged, the outcome of the fixed ordering is what ref is resolved to
+
+    :param ref:
+    :param shape:
+    :param solution: solution of the fixed ordering, None if there was none
+    :param candidate_pool:
+    :param query_compiler: QueryCompiler of ref
+    :return:
+    """
+    try:
+        hypotheses = hypothesis_stats.reorder(shape, list(Hypotheses.iter_hypotheses(ref)),
+                                              current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING_MIN_OBSERVATIONS'])
+        if hypotheses is None:
+            return
+        learned_solution = solve_hypotheses(ref, hypotheses, candidate_pool, query_compiler)
+    except NoSolution:
+        learned_solution = None
+    except Exception as ex:
+        counters.increment('ordering_shadow_failed')
+        current_app.logger.error("learned ordering failed to resolve %s: %s %r"%(str(ref), type(ex).__name__, ex.args))
+        return
+    fixed_bibcode = solution.cited_bibcode if solution else None
+    learned_bibcode = learned_solution.cited_bibcode if learned_solution else None
+    if fixed_bibcode == learned_bibcode:
+        counters.increment('ordering_shadow_agreed')
+    else:
+        counters.increment('ordering_shadow_disagreed')
+        current_app.logger.info("learned ordering resolved %s to %s instead of %s"%(str(ref), learned_bibcode, fixed_bibcode))
+
+
+def solve_reference(ref, candidate_pool=None):
+    """
+    returns a solution for what record is presumably meant by ref.
+
+    ref is an instance of Reference (or rather, its subclasses).
+    If no matching record is found, NoSolution is raised.
+    :param ref:
+    :param candidate_pool: the candidate pool of ref, if seeded already (see batch.py)
+    :return:
+    """
+    if not enough_to_proceed(ref):
+        current_app.logger.error("Not enough information to resolve the record")
+        raise Incomplete("Not enough information to resolve the record.", str(ref))
+
+    shape = get_reference_shape(ref)
+    solution = solve_from_identifier_index(ref)
+    if solution is not None:
+        hypothesis_stats.record(shape, solution.source_hypothesis, 0)
+        return solution
+
+    if candidate_pool is None:
+        candidate_pool = CandidatePool(refine_locally=current_app.config['REFERENCE_SERVICE_CANDIDATE_POOL'])
+
+    ordering = current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING']
+    hypotheses = Hypotheses.iter_hypotheses(ref)
+    if ordering == 'learned':
+        hypotheses = list(hypotheses)
+        hypotheses = hypothesis_stats.reorder(shape, hypotheses,
+                        current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING_MIN_OBSERVATIONS']) or hypotheses
+
+    # the query fragments of the hints are made once for all the hypotheses of ref
+    query_compiler = QueryCompiler()
+    try:
+        solution = solve_hypotheses(ref, hypotheses, candidate_pool, query_compiler)
+    except NoSolution:
+        hypothesis_stats.record(shape, UNRESOLVED, candidate_pool.num_queried)
+        if ordering == 'shadow':
+            shadow_learned_ordering(ref, shape, None, candidate_pool, query_compiler)
+        raise
+    hypothesis_stats.record(shape, solution.source_hypothesis, candidate_pool.num_queried)
+    if ordering == 'shadow':
+        shadow_learned_ordering(ref, shape, solution, candidate_pool, query_compiler)
+    return solution
@@ -5,9 +5,9 @@ people use to reference publications into bibstems.
 """
 
 import os
-import regex as re
 import time
 import traceback
+from itertools import chain
 
 try:
     import cPickle as pickle
@@ -15,11 +15,30 @@ except ImportError:
     import pickle
 
 from flask import current_app
-from referencesrv.resolver import pytrigdict
+from referencesrv.resolver import pytrigdict, pydeldict
 
 class Error(Exception):
     pass
 
+
+class KeyTranslation(dict):
+    """
+    a translation table for str.translate, mapping all the characters that are not
+    letters, digits or ampersand to blank, filled in as characters are encountered
+    """
+    KEEP = set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789&')
+
+    def __missing__(self, code_point):
+        """
+
+        :param code_point:
+        :return:
+        """
+        self[code_point] = chr(code_point) if chr(code_point) in self.KEEP else ' '
+        return self[code_point]
+
+KEY_TRANSLATION = KeyTranslation()
+
 class SourceMatcher(object):
     """An abstract base for all source matchers.
 
@@ -49,6 +68,19 @@ class SourceMatcher(object):
         """
         raise Error('bestmatches not implemented for this SourceMatcher')
 
+    def bestmatches_many(self, source_specs, num_best):
+        """
+        returns the list of bestmatches(source_spec, num_best) for each of source_specs.
+
+        Matchers that can match many source_specs more efficiently than
+        one at a time should override this.
+
+        :param source_specs:
+        :param num_best:
+        :return:
+        """
+        return [self.bestmatches(source_spec, num_best) for source_spec in source_specs]
+
     def is_conf_stem(self, stem):
         """
         returns True if we believe stem belongs to a conference.  It
@@ -91,6 +123,9 @@ class TrigdictSourceMatcher(SourceMatcher):
     If constucted without an argument, this uses the default ADS bibstem
     definitions.
     """
+    # the fuzzy dictionary class holding the sources
+    dict_class = pytrigdict.Trigdict
+
     def __init__(self, authority_files=None, load_sources=True):
         """
 
@@ -112,6 +147,16 @@ class TrigdictSourceMatcher(SourceMatcher):
             self.bibstem_words = {}
             self.load_sources()
 
+    def make_key(self, source):
+        """
+        returns the normalized form of source used as key in the source dictionary,
+        runs of characters other than letters, digits and ampersand become a single blank.
+
+        :param source:
+        :return:
+        """
+        return ' '.join(source.translate(KEY_TRANSLATION).split()).upper()
+
     def add_pub(self, stem, source):
         """
         enters stem as value for source.
@@ -120,10 +165,45 @@ class TrigdictSourceMatcher(SourceMatcher):
         :param source:
         :return:
         """
-        key = re.sub('[^A-Za-z0-9&]+', ' ', source).strip().upper()
+        key = self.make_key(source)
         self.source_dict[key] = stem
         self.bibstem_words.setdefault(stem, set()).update(key.lower().split())
 
+    def remove_pub(self, stem, source, update_words=True):
+        """
+        removes stem as value for source.
+
+        :param stem:
+        :param source:
+        :param update_words: if False, update_bibstem_words is to be called for stem afterward
+        :return: number of entries removed
+        """
+        num_removed = self.source_dict.remove(self.make_key(source), stem)
+        if num_removed and update_words:
+            self.update_bibstem_words(set([stem]))
+        return num_removed
+
+    def update_bibstem_words(self, stems):
+        """
+        recomputes the words of stems from the sources they are still entered for, so that after
+        removing sources the words are the same as if built without them; the stems without any
+        source left lose their naked bibstem as well (see load_sources)
+
+        :param stems: set of stems
+        :return:
+        """
+        naked_stems = set()
+        for stem, keys in self.source_dict.get_expansions(stems).items():
+            if keys:
+                self.bibstem_words[stem] = set(word for key in keys for word in key.lower().split())
+                continue
+            self.bibstem_words.pop(stem, None)
+            naked_stem = stem.strip('.').upper()
+            if self.source_dict.remove(self.make_key(stem), naked_stem):
+                naked_stems.add(naked_stem)
+        if naked_stems:
+            self.update_bibstem_words(naked_stems)
+
     def load_two_part_source(self, source_filename, source_lines):
         """
         helps for load_one_source.
@@ -132,30 +212,11 @@ class TrigdictSourceMatcher(SourceMatcher):
         :param source_lines:
         :return:
         """
-        read_with_errors = False
-        lineno = 1
-        confstems_type = 0
-        if source_filename.find('conferences')!=-1:
-            confstems_type = 1
-        for ln in source_lines:
-            lineno += 1
-            try:
-                stem, source = ln.split('\t', 1)
-                stem = stem.strip()[-9:]
-                # bibstem is at least 3 characters
-                if len(stem.strip()) < 3:
-                    current_app.logger.error('sourcematchers.py: warning: skipping entry %s in file %s\n'%(ln.strip(),source_filename))
-                    read_with_errors = True
-                    continue
-                self.add_pub(stem, source)
-                if confstems_type:
-                    self.confstems[stem] = 1
-            except ValueError:
-                current_app.logger.error('sourcematchers.py: %s (%d): skipping source line: %s'%(source_filename,lineno,ln))
-                read_with_errors = True
-        if read_with_errors:
+        num_errors = self.load_lines(source_filename, source_lines, num_parts=2,
+                                     pubType='C' if source_filename.find('conferences')!=-1 else None)
+        if num_errors:
             raise Error('Some entries in %s have errors and were skipped' % (source_filename))
-        return read_with_errors
+        return False
 
     def load_three_part_source(self, source_filename, source_lines):
         """
@@ -165,49 +226,87 @@ class TrigdictSourceMatcher(SourceMatcher):
         :param source_lines:
         :return:
         """
-        read_with_errors = False
+        return self.load_lines(source_filename, source_lines, num_parts=3) > 0
+
+    def load_lines(self, source_filename, source_lines, num_parts, pubType=None):
+        """
+        enters the authority lines of source_lines, either in two part format, in which case
+        pubType applies to all the stems, or in three part format.
+
+        :param source_filename:
+        :param source_lines:
+        :param num_parts: 2 or 3
+        :param pubType:
+        :return: number of lines skipped due to errors
+        """
+        stats = self.load_stats.setdefault(source_filename, {'entries': 0, 'errors': 0})
+        num_errors = num_entries = 0
         lineno = 1
         for ln in source_lines:
             lineno += 1
-            try:
-                stem, pubType, source = ln.split('\t', 2)
-                stem = stem.strip()[-9:]
-                if len(stem.strip()) < 3:
-                    current_app.logger.error('sourcematchers.py: warning: skipping entry %s in file %s\n'%(ln.strip(),source_filename))
-                    read_with_errors = True
-                    continue
-                self.add_pub(stem, source)
-                if pubType=='C':
-                    self.confstems[stem] = 1
-            except ValueError:
+            parts = ln.split('\t', num_parts-1)
+            if len(parts) == 3:
+                stem, pubType, source = parts
+            elif len(parts) == 2 and num_parts == 2:
+                stem, source = parts
+            else:
                 current_app.logger.error('sourcematchers.py: %s (%d): skipping source line: %s'%(source_filename,lineno,ln))
-                read_with_errors = True
-        return read_with_errors
+                num_errors += 1
+                continue
+            stem = stem.strip()[-9:]
+            # bibstem is at least 3 characters
+            if len(stem) < 3:
+                current_app.logger.error('sourcematchers.py: warning: skipping entry %s in file %s\n'%(ln.strip(),source_filename))
+                num_errors += 1
+                continue
+            self.add_pub(stem, source)
+            num_entries += 1
+            if pubType=='C':
+                self.confstems[stem] = 1
+        stats['entries'] += num_entries
+        stats['errors'] += num_errors
+        return num_errors
 
     def load_one_source(self, source_filename):
         """
         handles one authority file including format auto-detection.
 
+        the file is read line by line, the format is detected from the first authority line.
+
         :param source_filename:
         :return:
         """
-        source_lines = open(source_filename, encoding='ISO-8859-1').readlines()
-        del source_lines[0]
-        if len(source_lines[0].split('\t'))==2:
-            return self.load_two_part_source(source_filename, source_lines)
-        elif len(source_lines[0].split('\t'))==3:
-            return self.load_three_part_source(source_filename, source_lines)
-        else:
-            raise Error('%s does not appear to be a source authority file'%(source_filename))
+        start_time = time.time()
+        if not hasattr(self, 'load_stats'):
+            self.load_stats = {}
+        try:
+            with open(source_filename, encoding='ISO-8859-1') as source_lines:
+                # the first line is ignored
+                next(source_lines, None)
+                first_line = next(source_lines, '')
+                num_parts = len(first_line.split('\t'))
+                if num_parts==2:
+                    return self.load_two_part_source(source_filename, chain([first_line], source_lines))
+                elif num_parts==3:
+                    return self.load_three_part_source(source_filename, chain([first_line], source_lines))
+                else:
+                    raise Error('%s does not appear to be a source authority file'%(source_filename))
+        finally:
+            stats = self.load_stats.setdefault(source_filename, {'entries': 0, 'errors': 0})
+            stats['duration'] = (time.time() - start_time) * 1000
+            current_app.logger.info('loaded {entries} entries from {filename} in {duration:.1f} ms, {errors} entries with errors skipped'.format(
+                filename=os.path.basename(source_filename), **stats))
 
     def load_sources(self):
         """
-        creates a trigdict and populates it with data from self.autorityFiles
+        creates a trigdict and populates it with data from self.autorityFiles,
+        and then builds its index
 
         :return:
         """
         self.confstems = {}
-        self.source_dict = pytrigdict.Trigdict()
+        self.load_stats = {}
+        self.source_dict = self.dict_class()
         for filename in self.authority_files:
             self.load_one_source(filename)
         # We want to allow naked bibstems in references, too
@@ -215,6 +314,79 @@ class TrigdictSourceMatcher(SourceMatcher):
             # clean_stem = stem.replace('.', '').upper()
             clean_stem = stem.strip('.').upper()
             self.add_pub(clean_stem, stem)
+        start_time = time.time()
+        self.source_dict.build_index()
+        current_app.logger.info('built source matcher index in %.1f ms' % ((time.time() - start_time) * 1000))
+
+    def apply_delta(self, source_lines, source_filename='delta'):
+        """
+        adds and removes entries of source_lines to and from the source dictionary,
+        without rebuilding it, only the trigram postings of the affected entries are updated.
+
+        source_lines are in the format of the authority files (ie, new_abbrev.dat), including the
+        ignored first line, in either two or three part format. Lines with a leading `-` are
+        removed rather than added, for example
+
+        -JPhCS....\tJ. Phys. CS
+
+        if any of the lines is not in this format, Error is raised and the source dictionary is not changed
+
+        :param source_lines:
+        :param source_filename: name used in the log and to identify two part conference files
+        :return: tuple of (number of entries added, number of entries removed)
+        """
+        # all the lines are parsed before any is applied, so that a delta with errors changes nothing
+        entries = []
+        read_with_errors = False
+        confstems_type = source_filename.find('conferences')!=-1
+        lineno = 1
+        for ln in source_lines[1:]:
+            lineno += 1
+            if not ln.strip():
+                continue
+            to_remove = ln.startswith('-')
+            parts = (ln[1:] if to_remove else ln).split('\t', 2)
+            if len(parts) == 3:
+                stem, pubType, source = parts
+            elif len(parts) == 2:
+                stem, source = parts
+                pubType = 'C' if confstems_type else None
+            else:
+                current_app.logger.error('sourcematchers.py: %s (%d): error in source line: %s'%(source_filename,lineno,ln))
+                read_with_errors = True
+                continue
+            stem = stem.strip()[-9:]
+            if len(stem.strip()) < 3:
+                current_app.logger.error('sourcematchers.py: error in entry %s in file %s\n'%(ln.strip(),source_filename))
+                read_with_errors = True
+                continue
+            entries.append((to_remove, stem, pubType, source))
+        if read_with_errors:
+            raise Error('Some entries in %s have errors, nothing was applied' % (source_filename))
+
+        num_added = num_removed = 0
+        known_stems = self.source_dict.values()
+        # the words of these are recomputed once all the lines are applied
+        removed_stems = set()
+        for to_remove, stem, pubType, source in entries:
+            if to_remove:
+                num_removed_source = self.remove_pub(stem, source, update_words=False)
+                if num_removed_source:
+                    removed_stems.add(stem)
+                num_removed += num_removed_source
+                continue
+            self.add_pub(stem, source)
+            num_added += 1
+            if pubType=='C':
+                self.confstems[stem] = 1
+            # allow the naked bibstem for the stems that have not been seen before
+            if stem not in known_stems:
+                known_stems.add(stem)
+                self.add_pub(stem.strip('.').upper(), stem)
+        if removed_stems:
+            self.update_bibstem_words(removed_stems)
+        current_app.logger.info('applied %s to source matcher: %d entries added, %d entries removed.'%(source_filename, num_added, num_removed))
+        return num_added, num_removed
 
     def exactmatch(self, source_spec):
         """
@@ -238,6 +410,17 @@ class TrigdictSourceMatcher(SourceMatcher):
         """
         return self.source_dict.bestmatches(source_spec, num_best)
 
+    def bestmatches_many(self, source_specs, num_best):
+        """
+        see SourceMatcher.bestmatches_many, all source_specs are matched in one pass
+        over the trigram index.
+
+        :param source_specs:
+        :param num_best:
+        :return:
+        """
+        return self.source_dict.bestmatches_many(source_specs, num_best)
+
     def is_conf_stem(self, stem):
         """
         see SourceMatcher.is_conf_stem.
@@ -264,47 +447,136 @@ class TrigdictSourceMatcher(SourceMatcher):
         """
         return self.source_dict.has_key(stem)
 
+class DeldictSourceMatcher(TrigdictSourceMatcher):
+    """A SourceMatcher ranking the sources within a small edit distance, found
+    through a deletion index (SymSpell) instead of a trigram index.
+
+    It is constructed and loaded the same way as TrigdictSourceMatcher.
+    Since only small edit distances are considered, source_specs are
+    normalized the same way the sources are, before being matched.
+    """
+    dict_class = pydeldict.Deldict
+
+    def bestmatches(self, source_spec, num_best):
+        """
+        see SourceMatcher.bestmatches.
+
+        :param source_spec:
+        :param num_best:
+        :return:
+        """
+        return self.source_dict.bestmatches(self.make_key(source_spec), num_best)
+
+    def bestmatches_many(self, source_specs, num_best):
+        """
+        see SourceMatcher.bestmatches_many.
+
+        :param source_specs:
+        :param num_best:
+        :return:
+        """
+        return self.source_dict.bestmatches_many([self.make_key(source_spec) for source_spec in source_specs], num_best)
+
+    def __getitem__(self, source_spec):
+        """
+        returns the (score, bibstem) for the best match for source_spec
+
+        :param source_spec:
+        :return:
+        """
+        return self.source_dict[self.make_key(source_spec)]
+
+
+# source matchers to choose from in the configuration (REFERENCE_SERVICE_SOURCE_MATCHER)
+SOURCE_MATCHERS = {
+    'trigdict': TrigdictSourceMatcher,
+    'deldict': DeldictSourceMatcher,
+}
+
+def get_source_matcher_class():
+    """
+    returns the SourceMatcher class selected in the configuration
+
+    :return:
+    """
+    return SOURCE_MATCHERS[current_app.config['REFERENCE_SERVICE_SOURCE_MATCHER']]
+
 source_matcher_pickle_file = os.path.dirname(__file__) + '/serialized_files/sourceMatcher.pkl'
 
-def create_source_matcher():
+def create_source_matcher(filename=source_matcher_pickle_file):
     """
-    create TrigdictSourceMatcher object and save it to a pickle file
+    create the configured SourceMatcher object and save it to a pickle file
 
+    :param filename:
     :return:
     """
     try:
         start_time = time.time()
-        source_matcher = TrigdictSourceMatcher()
-        # to build the index, a time consuming, one time needed operation
-        source_matcher.bestmatches('', 1)
-        with open(source_matcher_pickle_file, "wb") as f:
-            pickler = pickle.Pickler(f, -1)
-            pickler.dump(source_matcher.source_dict)
-            pickler.dump(source_matcher.bibstem_words)
-            pickler.dump(source_matcher.confstems)
-            current_app.logger.info("saved source_matcher in %s."%source_matcher_pickle_file)
-            current_app.logger.debug("source matcher files processed and saved in %s ms" % ((time.time() - start_time) * 1000))
-            return source_matcher
+        source_matcher = get_source_matcher_class()()
+        save_source_matcher(source_matcher, filename)
+        current_app.logger.debug("source matcher files processed and saved in %s ms" % ((time.time() - start_time) * 1000))
+        return source_matcher
+    except Exception as e:
+        current_app.logger.error('Exception: %s' % (str(e)))
+        current_app.logger.error(traceback.format_exc())
+        raise e
+
+def save_source_matcher(source_matcher, filename=source_matcher_pickle_file):
+    """
+    save TrigdictSourceMatcher object to the pickle file
+
+    :param source_matcher:
+    :param filename:
+    :return:
+    """
+    with open(filename, "wb") as f:
+        pickler = pickle.Pickler(f, -1)
+        pickler.dump(source_matcher.source_dict)
+        pickler.dump(source_matcher.bibstem_words)
+        pickler.dump(source_matcher.confstems)
+        current_app.logger.info("saved source_matcher in %s."%filename)
+
+def update_source_matcher(source_matcher, source_lines, source_filename='delta', filename=source_matcher_pickle_file):
+    """
+    apply a delta file to the source matcher and save it to the pickle file,
+    without re-reading all the authority files
+
+    :param source_matcher:
+    :param source_lines: lines of the delta file
+    :param source_filename:
+    :param filename: pickle file to save the updated source matcher to
+    :return: tuple of (number of entries added, number of entries removed)
+    """
+    try:
+        start_time = time.time()
+        num_added, num_removed = source_matcher.apply_delta(source_lines, source_filename)
+        save_source_matcher(source_matcher, filename)
+        current_app.logger.debug("source matcher delta applied and saved in %s ms" % ((time.time() - start_time) * 1000))
+        return num_added, num_removed
     except Exception as e:
         current_app.logger.error('Exception: %s' % (str(e)))
         current_app.logger.error(traceback.format_exc())
         raise e
 
-def load_source_matcher():
+def load_source_matcher(filename=source_matcher_pickle_file):
     """
-    load TrigdictSourceMatcher object from pickle file
+    load the configured SourceMatcher object from pickle file
 
+    :param filename:
     :return:
     """
     try:
         start_time = time.time()
-        source_matcher = TrigdictSourceMatcher(load_sources=False)
-        with open(source_matcher_pickle_file, "rb") as f:
+        source_matcher = get_source_matcher_class()(load_sources=False)
+        with open(filename, "rb") as f:
             unpickler = pickle.Unpickler(f)
             source_matcher.source_dict = unpickler.load()
             source_matcher.bibstem_words = unpickler.load()
             source_matcher.confstems = unpickler.load()
-            current_app.logger.info("loaded source_matcher from %s."%source_matcher_pickle_file)
+            if not isinstance(source_matcher.source_dict, source_matcher.dict_class):
+                current_app.logger.error("source_matcher in %s was built with %s, not %s as configured."%(
+                    filename, source_matcher.source_dict.__class__.__name__, source_matcher.dict_class.__name__))
+            current_app.logger.info("loaded source_matcher from %s."%filename)
             current_app.logger.debug("source matcher loaded in %s ms" % ((time.time() - start_time) * 1000))
             return source_matcher
     except Exception as e:
@@ -4,9 +4,7 @@ Extra hypothesis generators (and verifiers) by individual publication types, giv
 
 import regex as re
 
-from flask import current_app
-
-from referencesrv.resolver.common import Evidences, Hypothesis
+from referencesrv.resolver.common import Evidences, Hypothesis, score_fields
 from referencesrv.resolver.scoring import get_basic_score_for_input_fields, get_serial_score_for_input_fields, \
     get_author_year_pub_score_for_input_fields
 from referencesrv.resolver.authors import add_author_evidence, normalize_author_list
@@ -43,11 +41,12 @@ def add_boolean_evidence(evidences, boolean, hint):
     :return:
     """
     if boolean:
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][1], hint)
+        evidences.add_evidence(evidences.max_score, hint)
     else:
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0], hint)
+        evidences.add_evidence(evidences.min_score, hint)
 
 
+@score_fields('bibcode', 'author_norm', 'first_author_norm', 'pub_raw')
 def get_score_for_baas_match(result_record, hypothesis):
     """
     scores a BAAS->DDA match.
@@ -63,7 +62,7 @@ def get_score_for_baas_match(result_record, hypothesis):
     """
     evidences = Evidences()
     if not re.match(r'....%s'%hypothesis.get_detail('expected_bibstem'), result_record['bibcode']):
-        evidences.add_evidence(current_app.config['EVIDENCE_SCORE_RANGE'][0], 'no DDA bibcode')
+        evidences.add_evidence(evidences.min_score, 'no DDA bibcode')
         return evidences
 
     input_fields = hypothesis.get_detail('input_fields')
@@ -75,7 +74,8 @@ def get_score_for_baas_match(result_record, hypothesis):
     add_author_evidence(evidences,
         normalized_authors,
         result_record['author_norm'],
-        result_record['first_author_norm'])
+        result_record['first_author_norm'],
+        author_matcher=hypothesis.get_detail('author_matcher'))
 
     add_boolean_evidence(evidences,
         'Vol. %s'%input_fields['volume'] in result_record['pub_raw'],
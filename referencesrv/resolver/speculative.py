@@ -0,0 +1,164 @@
+"""
+Speculative execution of the hypotheses of one reference.
+
+Hypotheses are evaluated in order, and most references are resolved by one of the
+first few, but for the ones that are not, every hypothesis costs a round trip to solr.
+The speculative querier sends the queries of the next few hypotheses to solr
+concurrently, while the hypotheses are still evaluated strictly in order, each with
+the result of its own query, so the solution is the same as querying one at a time.
+Once a solution is found, the queries still outstanding are cancelled if they have
+not started yet, and ignored otherwise; these are counted as wasted, as are the ones
+that have not started yet when their hypothesis is evaluated, which are then executed
+in the request thread rather than waiting for the pool.
+"""
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from referencesrv.metrics import counters
+
+
+# the thread pool of the worker is created on first use, possibly from several requests at once,
+# the lock makes sure only one is created
+executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    returns the thread pool of this worker the speculative queries are executed on
+
+    :return:
+    """
+    executor = current_app.extensions.get('speculative_executor', None)
+    if executor is None:
+        with executor_lock:
+            executor = current_app.extensions.get('speculative_executor', None)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=current_app.config['REFERENCE_SERVICE_SPECULATIVE_THREADS'])
+                current_app.extensions['speculative_executor'] = executor
+    return executor
+
+
+class SpeculativeQuerier(object):
+    """
+    wraps a Querier, to have the queries of the upcoming hypotheses sent to solr ahead of time
+    """
+    def __init__(self, querier, get_query_args, get_conditions, candidate_pool, window, budget):
+        """
+
+        :param querier: the Querier, created in the request thread
+        :param get_query_args: function returning the arguments of Querier.query for a hypothesis,
+                               the query string, the fields and probe, None if it is not to be sent ahead
+        :param get_conditions: function returning the dict of hint key to solr condition of a hypothesis
+        :param candidate_pool: the queries the pool already has the result for, or might work out
+                               the result of, are not sent
+        :param window: number of hypotheses, including the one being evaluated, with queries in flight
+        :param budget: maximum number of queries sent ahead of time for the reference
+        """
+        self.querier = querier
+        self.get_query_args = get_query_args
+        self.get_conditions = get_conditions
+        self.candidate_pool = candidate_pool
+        self.window = window
+        self.budget = budget
+        self.app = current_app._get_current_object()
+        self.executor = get_executor()
+        # arguments of the query to future
+        self.futures = {}
+        # conditions of the hypotheses sent ahead of time, or considered for it
+        self.pending_conditions = []
+
+    def execute(self, query_args):
+        """
+        executes the query in a thread of the pool
+
+        :param query_args: query string, fields and probe
+        :return:
+        """
+        with self.app.app_context():
+            return self.querier.query(*query_args)
+
+    def prefetch(self, hypothesis):
+        """
+        sends the query of hypothesis ahead of time, if not sent or answered already, and within budget
+
+        the hypotheses answered from the bibcode index (get_query_args returns None for them), or whose
+        conditions extend those of an earlier hypothesis, so that the candidate pool might work out their
+        documents once the earlier one is evaluated, are not sent, not to query solr for them after all
+
+        :param hypothesis:
+        :return:
+        """
+        if self.budget <= 0:
+            return
+        try:
+            conditions = self.get_conditions(hypothesis)
+            query_args = self.get_query_args(hypothesis)
+        except Exception as ex:
+            # not sent ahead, making the query of the hypothesis fails again when it is evaluated,
+            # and only that hypothesis is dropped
+            current_app.logger.debug('query of hypothesis {name} not sent ahead of time: {error}'.format(
+                name=hypothesis.name, error=ex))
+            return
+        refinable = self.candidate_pool.may_refine(conditions, self.pending_conditions)
+        self.pending_conditions.append(conditions)
+        if query_args is None or refinable:
+            return
+        query_string, fields, _ = query_args
+        if query_args in self.futures or self.candidate_pool.has_result(query_string, fields):
+            return
+        self.budget -= 1
+        self.futures[query_args] = self.executor.submit(self.execute, query_args)
+        counters.increment('speculative_queries')
+
+    def iter_hypotheses(self, hypotheses):
+        """
+        yields hypotheses in order, with the queries of the next window of them sent ahead of time
+
+        :param hypotheses: iterator of the hypotheses
+        :return:
+        """
+        upcoming = deque()
+        for hypothesis in hypotheses:
+            upcoming.append(hypothesis)
+            self.prefetch(hypothesis)
+            if len(upcoming) >= self.window:
+                yield upcoming.popleft()
+        while upcoming:
+            yield upcoming.popleft()
+
+    def query(self, query_string, fields=None, probe=False):
+        """
+        returns the result of the query, waiting for it if it was sent ahead of time and has started,
+        the query still waiting for a thread of the pool, behind the ones of other references, is
+        cancelled and executed here instead
+
+        :param query_string:
+        :param fields:
+        :param probe:
+        :return:
+        """
+        future = self.futures.pop((query_string, fields, probe), None)
+        if future is None:
+            return self.querier.query(query_string, fields, probe)
+        if future.cancel():
+            counters.increment('speculative_queries_wasted')
+            return self.querier.query(query_string, fields, probe)
+        counters.increment('speculative_queries_used')
+        return future.result()
+
+    def close(self):
+        """
+        cancels the queries not started yet, and ignores the ones still running
+
+        :return:
+        """
+        for future in self.futures.values():
+            future.cancel()
+        if self.futures:
+            counters.increment('speculative_queries_wasted', len(self.futures))
+            current_app.logger.debug('%d queries sent ahead of time were not needed' % len(self.futures))
+        self.futures = {}
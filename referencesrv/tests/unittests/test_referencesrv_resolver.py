@@ -8,26 +8,61 @@ from flask_testing import TestCase
 import unittest
 
 import regex as re
+import json
 
 import referencesrv.app as app
 from referencesrv.resolver.authors import get_author_pattern, get_authors, normalize_single_author, \
     normalize_author_list, get_first_author, get_first_author_last_name, count_matching_authors, \
-    add_author_evidence
+    add_author_evidence, AuthorMatcher, get_author_matcher
 from referencesrv.resolver.common import Evidences, NotResolved, Undecidable, NoSolution, DeferredSourceMatcher, \
-    SOURCE_MATCHER, Solution, Hypothesis
+    SOURCE_MATCHER, Solution, Hypothesis, sorted2
 from referencesrv.resolver.pytrigdict import get_trigrams, TrigIndex, Trigdict
-from referencesrv.resolver.sourcematchers import TrigdictSourceMatcher, SourceMatcher
+from referencesrv.resolver.pydeldict import get_deletes, DelIndex, Deldict
+from referencesrv.resolver.sourcematchers import TrigdictSourceMatcher, SourceMatcher, DeldictSourceMatcher, \
+    get_source_matcher_class
 from referencesrv.resolver.scoring import get_score_for_reference_identifier, get_score_for_input_fields, \
-    get_score_for_reference_identifier, get_book_score_for_input_fields, get_thesis_score_for_input_fields
+    get_score_for_reference_identifier, get_book_score_for_input_fields, get_thesis_score_for_input_fields, \
+    get_author_year_score_for_input_fields, get_author_year_pub_score_for_input_fields, \
+    get_volume_page_score_for_input_fields, get_basic_score_for_input_fields, get_serial_score_for_input_fields, \
+    get_catalog_score_for_input_fields, get_chapter_score_for_input_fields
 from referencesrv.resolver.journalfield import get_best_bibstem_for, add_volume_evidence, clean_ads_page, \
     compute_page_delta, add_page_evidence, compute_pubstring_statistics, string_similarity, add_publication_evidence, \
     has_word, has_thesis_indicators, cook_title_string
 from referencesrv.resolver.solve import make_solr_condition, inspect_doubtful_solutions, inspect_ambiguous_solutions, \
-    choose_solution, solve_reference
+    choose_solution, solve_reference, make_solr_conditions, sort_scored, make_solr_condition_author, \
+    make_query_string, get_query_args, QueryCompiler
+from referencesrv.resolver.candidatepool import CandidatePool
+from referencesrv.resolver.speculative import SpeculativeQuerier, get_executor
+from referencesrv.resolver.localindex import build_identifier_index, IdentifierIndex, get_record_identifier_key, \
+    build_bibcode_index, BibcodeIndex, get_bibcode_index
+from referencesrv.resolver.batch import plan_first_round, get_first_round, match_first_round
+from referencesrv.metrics import counters, hypothesis_counters
+from referencesrv.resolver.ordering import get_reference_shape, hypothesis_stats, UNRESOLVED
+from referencesrv.resolver.solrtestdata import get_test_data, FakeSolr
+from referencesrv.resolver.latency import LatencyTracker, get_latency_tracker, get_timeout, get_hedge_delay, \
+    get_hedge_executor
+from referencesrv.resolver.common import Solr, SolrTimeout, SolrUnavailable
+from referencesrv.resolver.circuitbreaker import CircuitBreaker, get_circuit_breaker, CLOSED, OPEN, HALF_OPEN
+from referencesrv.resolver.settings import make_settings, get_settings
+from referencesrv.resolver.columnar import NumericEvidences, get_year_evidences, get_volume_scores, get_numeric_evidences
 from referencesrv.resolver.hypotheses import Hypotheses
-from referencesrv.resolver.solrquery import Querier
+from referencesrv.resolver.solrquery import Querier, get_query_fields, split_query_fields, SolrRecord, \
+    decode_solr_response
 from referencesrv.resolver.specialrules import iter_journal_specific_hypotheses, get_score_for_baas_match
 from referencesrv.resolver.sourcematchers import load_source_matcher
+from referencesrv.modelstore import ModelArtifact, start_build, check_model_versions, get_status, build_jobs, \
+    loader_threads, apply_source_matcher_delta, BuildJob
+import referencesrv.modelstore as modelstore
+import tempfile
+import shutil
+import time
+import copy
+import fnmatch
+import threading
+import math
+import requests
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
 
 
 class TestResolver(TestCase):
@@ -156,6 +191,65 @@ class TestResolver(TestCase):
         self.assertEqual(evidences['authors'], 0)
 
 
+    def test_author_memos(self):
+        """
+        test that the author list normalizations are remembered, and counted in the metrics
+        """
+        for function in [get_authors, normalize_author_list, make_solr_condition_author]:
+            function.cache_clear()
+        authors = 'Smith, J., Jones, K., and Accomazzi, A.'
+        for _ in range(3):
+            self.assertEqual(normalize_author_list(authors, initials=True), 'Smith, J; Jones, K; Accomazzi, A')
+            self.assertEqual(make_solr_condition('author', authors), 'author:("Smith, J" AND "Jones, K" AND "Accomazzi, A")')
+            self.assertEqual(get_authors(authors + ' 2019, ApJ, 1, 2'), authors)
+        self.assertEqual(normalize_author_list(authors, initials=False), 'Smith; Jones; Accomazzi')
+        # the author condition is built once, from the author list normalized just before
+        self.assertEqual(normalize_author_list.cache_info().hits, 3)
+        self.assertEqual(make_solr_condition_author.cache_info().hits, 2)
+        # when there are no authors, that is not remembered
+        for _ in range(2):
+            with self.assertRaises(Undecidable):
+                get_authors('12, 34')
+        self.assertEqual((get_authors.cache_info().hits, get_authors.cache_info().currsize), (2, 1))
+
+        r = self.client.get('/metrics')
+        self.assertEqual(r.status_code, 200)
+        memos = json.loads(r.data)['memos']
+        self.assertEqual(memos['make_solr_condition_author']['hits'], 2)
+        self.assertEqual(memos['get_authors']['misses'], 3)
+
+
+    def test_author_matcher(self):
+        """
+        Test that the authors of a reference prepared once match every record as count_matching_authors does.
+        """
+        ref_authors = "Smith, J.; Henneken, E.; Kurtz, M."
+        author_matcher = AuthorMatcher(ref_authors)
+        records = [
+            ['Smith, John', 'Heneken, Edwin', 'Kurtz, Michael'],
+            ['Heneken, Edwin', 'Smith, John'],
+            ['Brown, Lee'],
+            # a collaboration paper, the ADS last names form a regular expression
+            ['Zhou, Q.'] * 500 + ['Smith, J.'],
+            ['Smith+, J.', 'Kurtz, M.'],
+        ]
+        for ads_authors in records:
+            self.assertEqual(author_matcher.count(ads_authors), count_matching_authors(ref_authors, ads_authors))
+        self.assertEqual(author_matcher.count(records[0]), (0, 0, 2, False))
+        self.assertEqual(author_matcher.count(records[3]), (500, 2, 1, True))
+        # the misspelling was recognized once
+        self.assertEqual(author_matcher.misspellings['heneken'], 'henneken')
+        self.assertEqual(author_matcher.misspellings['zhou'], None)
+
+        # the evidence is the same with the matcher built for the reference
+        for ads_authors in records:
+            evidences, matched = Evidences(), Evidences()
+            add_author_evidence(evidences, 'Smith-Jones, J.', ads_authors, ads_authors[0], True)
+            add_author_evidence(matched, 'Smith-Jones, J.', ads_authors, ads_authors[0], True,
+                                author_matcher=get_author_matcher('Smith-Jones, J.'))
+            self.assertEqual(matched.evidences, evidences.evidences)
+
+
     def test_get_trigrams(self):
         """
         test trigrams present in a_string.
@@ -177,6 +271,9 @@ class TestResolver(TestCase):
         self.assertEqual(ti.lookup("abc cde", 1),
                          [('zzy cde', 0.6938775510204082)])
         self.assertEqual(ti.lookup("knall", 10), [])
+        # the postings of the trigrams not in the index are not cached
+        self.assertEqual(ti.lookup_many(["abc cde", "knall"], 4), [ti.lookup("abc cde", 4), []])
+        self.assertEqual(sorted(ti.posting_arrays), [' cd', 'abc', 'cde'])
 
 
     def test_Trigdict(self):
@@ -196,6 +293,46 @@ class TestResolver(TestCase):
         self.assertEqual(d.values(), set(['Hallo', 'Second', 'Hullo', 'pHullo', 'Hillo']))
 
 
+    def test_TrigIndex_incremental(self):
+        """
+        Test that adding and removing expansions incrementally gives the same lookups as rebuilding the index
+        """
+        ti = TrigIndex(["abcd", "bcde"])
+        self.assertEqual(ti.add("zzy cde"), True)
+        self.assertEqual(ti.add("zzy cde"), False)
+        self.assertEqual(ti.lookup("abc cde", 4), TrigIndex(["abcd", "bcde", "zzy cde"]).lookup("abc cde", 4))
+        self.assertEqual(ti.remove("abcd"), True)
+        self.assertEqual(ti.remove("abcd"), False)
+        self.assertEqual(ti.lookup("abc cde", 4), TrigIndex(["bcde", "zzy cde"]).lookup("abc cde", 4))
+        self.assertEqual(ti.lookup("abcd", 4), TrigIndex(["bcde", "zzy cde"]).lookup("abcd", 4))
+        # removing the last expansion with a trigram removes its postings
+        self.assertEqual('zzy' in ti.index, True)
+        ti.remove("zzy cde")
+        self.assertEqual('zzy' in ti.index, False)
+
+
+    def test_Trigdict_incremental(self):
+        """
+        Test that changes to a Trigdict after the index is built are reflected without rebuilding it
+        """
+        d = Trigdict()
+        d["KLOM"], d["AKLOM"] = "Hallo", "Hillo"
+        self.assertEqual(d["KLOM"], [(1.0, 'Hallo')])
+        index = d.index
+        d["PKLOP"] = "Hullo"
+        d["KLOM"] = "Second"
+        self.assertEqual(d.index is index, True)
+        self.assertEqual(d["PKLOP"], [(1.0, 'Hullo')])
+        self.assertEqual(d["KLOM"], [(1.0, 'Hallo'), (1.0, 'Second')])
+        self.assertEqual(d.remove("KLOM", "Hallo"), 1)
+        self.assertEqual(d["KLOM"], [(1.0, 'Second')])
+        del d["PKLOP"]
+        self.assertEqual(d.exactmatch("PKLOP"), None)
+        self.assertEqual(list(filter(lambda x: x[1] == 'Hullo', d.bestmatches("PKLOP", 3))), [])
+        with self.assertRaises(KeyError):
+            del d["PKLOP"]
+
+
     def test_SourceMatcher(self):
         """
         Test the parent class SourceMatcher
@@ -295,6 +432,174 @@ class TestResolver(TestCase):
         self.assertTrue('%s does not appear to be a source authority file'%(filename) in str(context.exception))
 
 
+    def test_load_sources(self):
+        """
+        test the keys and the statistics of loading the authority files
+        """
+        s = TrigdictSourceMatcher(authority_files=[os.path.dirname(__file__) + '/stubdata/bibstems.dat'])
+        stats = s.load_stats[os.path.dirname(__file__) + '/stubdata/bibstems.dat']
+        self.assertEqual(stats['errors'] > 0, True)
+        self.assertEqual(stats['entries'] > 0, True)
+        self.assertEqual('duration' in stats, True)
+        # index is built when loaded
+        self.assertEqual(s.source_dict.index is not None, True)
+        self.assertEqual(s.make_key(u' J. Phys.--Condens.  Matt\u00e9r & Co. '), 'J PHYS CONDENS MATT R & CO')
+        self.assertEqual(s.make_key(u'...'), '')
+
+
+    def test_apply_delta(self):
+        """
+        test applying a delta file to the source matcher
+        """
+        s = TrigdictSourceMatcher()
+        self.assertEqual(s.exactmatch("JOURNAL OF IMAGINARY ASTRONOMY"), None)
+        delta = ['ignored header\n',
+                 'JIA......\tJournal of Imaginary Astronomy\n',
+                 'JIA......\tJ. Imag. Astron.\n',
+                 '-JPhCS....\tJ. Phys. CS\n']
+        self.assertEqual(s.apply_delta(delta), (2, 1))
+        self.assertEqual(s.exactmatch("JOURNAL OF IMAGINARY ASTRONOMY"), [(1, 'JIA......')])
+        self.assertEqual(s.exactmatch("J IMAG ASTRON"), [(1, 'JIA......')])
+        # naked bibstem is added for the new stem
+        self.assertEqual(s.exactmatch("JIA"), [(1, 'JIA')])
+        self.assertEqual(s.exactmatch("J PHYS CS"), None)
+        self.assertEqual(s.bestmatches("Journal of Imaginary Astronomy", 1)[-1], (1.0, 'JIA......'))
+        # a delta with errors is not applied at all
+        with self.assertRaises(Exception) as context:
+            s.apply_delta(['ignored header\n', 'JXA......\tJournal of Extra Astronomy\n', '..\tNo Stem\n'])
+        self.assertTrue('Some entries in delta have errors, nothing was applied' in str(context.exception))
+        self.assertEqual(s.exactmatch("JOURNAL OF EXTRA ASTRONOMY"), None)
+        self.assertEqual('JXA......' in s.bibstem_words, False)
+
+
+    def test_apply_delta_removals(self):
+        """
+        test that removing entries with a delta gives the same source matcher as building it without them
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            lines = ['ApJ......\tJ\tAstrophysical Journal\n',
+                     'ApJ......\tJ\tAstrophys. J. Letters\n',
+                     'AJ.......\tJ\tAstronomical Journal\n',
+                     'MNRAS....\tJ\tMonthly Notices\n']
+            def make_source_matcher(name, lines):
+                filename = os.path.join(tmp_dir, name)
+                with open(filename, 'w') as f:
+                    f.writelines(['ignored header\n'] + lines)
+                return TrigdictSourceMatcher(authority_files=[filename])
+            s = make_source_matcher('journals.dat', lines)
+            self.assertEqual(s.bibstem_words['ApJ......'], set(['astrophysical', 'journal', 'astrophys', 'j', 'letters']))
+            self.assertEqual(s.apply_delta(['ignored header\n', '-ApJ......\tJ\tAstrophys. J. Letters\n',
+                                            '-AJ.......\tJ\tAstronomical Journal\n']), (0, 2))
+            rebuilt = make_source_matcher('rebuilt.dat', [lines[0], lines[3]])
+            self.assertEqual(s.bibstem_words['ApJ......'], set(['astrophysical', 'journal']))
+            self.assertEqual(s.bibstem_words, rebuilt.bibstem_words)
+            # AJ has no source left, and its naked bibstem is gone too
+            self.assertEqual(s.exactmatch('AJ'), None)
+            self.assertEqual(s.exactmatch('APJ'), [(1, 'APJ')])
+            s.remove_pub('MNRAS....', 'Monthly Notices')
+            self.assertEqual('MNRAS....' in s.bibstem_words, False)
+            self.assertEqual('MNRAS' in s.bibstem_words, False)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+    def test_bestmatches_many(self):
+        """
+        test matching many source specs at once gives the same as matching them one at a time
+        """
+        s = TrigdictSourceMatcher()
+        specs = ["ASTROPHYSICAL JOURNAL", "Astron. Astrophys.", "MON NOT R ASTRON SOC", "APJ", "AJ", "XX",
+                 "PHYS REV D", "ASTROPHYSICAL JOURNAL", "NO SUCH JOURNAL", "ZZZZ", ""]
+        self.assertEqual(s.bestmatches_many(specs, 3), [s.bestmatches(spec, 3) for spec in specs])
+        self.assertEqual(s.source_dict.index.lookup_many([spec.upper() for spec in specs], 5),
+                         [s.source_dict.index.lookup(spec.upper(), 5) for spec in specs])
+        # the base class matches one at a time
+        self.assertEqual(SourceMatcher.bestmatches_many(s, specs, 3), s.bestmatches_many(specs, 3))
+        # cached postings are updated when the index changes
+        s.apply_delta(['ignored header\n', 'JIA......\tJournal of Imaginary Astronomy\n'])
+        self.assertEqual(s.bestmatches_many(["JOURNAL OF IMAGINARY ASTRONOMY"], 1)[0][-1], (1.0, 'JIA......'))
+        s.apply_delta(['ignored header\n', '-JIA......\tJournal of Imaginary Astronomy\n'])
+        self.assertEqual(s.bestmatches_many(["JOURNAL OF IMAGINARY ASTRONOMY"], 3),
+                         [s.bestmatches("JOURNAL OF IMAGINARY ASTRONOMY", 3)])
+        self.assertEqual('JIA......' in [stem for _, stem in s.bestmatches_many(["JOURNAL OF IMAGINARY ASTRONOMY"], 3)[0]], False)
+
+
+    def test_bibstem_endpoint(self):
+        """
+        test the endpoint matching journal strings to bibstems
+        """
+        self.current_app.extensions['source_matcher'] = None
+        r = self.client.post(path='/bibstem', data=json.dumps({'pub': ['Astrophysical Journal']}))
+        self.assertEqual(r.status_code, 400)
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        r = self.client.post(path='/bibstem', data=json.dumps({'pub': ['Astrophysical Journal', 'Astron. J.']}))
+        self.assertEqual(r.status_code, 200)
+        results = json.loads(r.data)['bibstems']
+        self.assertEqual([result['pub'] for result in results], ['Astrophysical Journal', 'Astron. J.'])
+        self.assertEqual(results[0]['candidates'][0], {'bibstem': 'ApJ......', 'score': 1.0})
+        self.assertEqual(len(results[1]['candidates']) <= self.current_app.config['REFERENCE_SERVICE_NUM_BIBSTEM_CANDIDATES'], True)
+        r = self.client.post(path='/bibstem', data=json.dumps({'reference': ['Astrophysical Journal']}))
+        self.assertEqual(r.status_code, 400)
+        for pubs in [[123], [None], ['Astrophysical Journal', ['ApJ']], 123]:
+            r = self.client.post(path='/bibstem', data=json.dumps({'pub': pubs}))
+            self.assertEqual(r.status_code, 400)
+        self.current_app.extensions['source_matcher'] = None
+
+
+    def test_delta_endpoint(self):
+        """
+        test that the endpoint applying a delta to the source matcher rejects an empty delta
+        """
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        r = self.client.put(path='/delta_source_matcher', data='')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.headers['content-type'], 'text/plain; charset=UTF8')
+        self.assertEqual(r.get_data(as_text=True), 'no delta received')
+        self.current_app.extensions['source_matcher'] = None
+
+
+    def test_DelIndex(self):
+        """
+        Test the deletion index
+        """
+        self.assertEqual(get_deletes("abc", 1), set(["abc", "bc", "ac", "ab"]))
+        self.assertEqual(len(get_deletes("abcd", 2)), 1 + 4 + 6)
+        di = DelIndex(["APJ", "APJL", "AJ", "MNRAS", "PHYS REV"], prefix_length=4)
+        self.assertEqual(di.lookup("APJ"), [('AJ', 1 - 1 / 3.), ('APJL', 1 - 1 / 3.), ('APJ', 1.0)])
+        self.assertEqual(di.lookup("MNRSA"), [])
+        self.assertEqual(di.lookup("MNRAZ"), [('MNRAS', 0.8)])
+        self.assertEqual(di.lookup("PHYS REW"), [('PHYS REV', 1 - 1 / 8.)])
+        self.assertEqual(di.add("MNRAS"), False)
+        self.assertEqual(di.add("MNRAZ"), True)
+        self.assertEqual(di.lookup("MNRAZ", 1), [('MNRAZ', 1.0)])
+        self.assertEqual(di.remove("MNRAZ"), True)
+        self.assertEqual(di.lookup("MNRAZ"), DelIndex(["APJ", "APJL", "AJ", "MNRAS", "PHYS REV"], prefix_length=4).lookup("MNRAZ"))
+        self.assertEqual(di.lookup_many(["APJ", "MNRAZ"]), [di.lookup("APJ"), di.lookup("MNRAZ")])
+        d = Deldict()
+        d["KLOM"], d["AKLOM"], d["KL"] = "Hallo", "Hillo", "Short"
+        self.assertEqual(d["KLOX"], [(0.75, 'Hallo')])
+        self.assertEqual(d.bestmatches("KL", 1), [(1, 'Short')])
+        self.assertEqual(d.values(), set(['Hallo', 'Hillo']))
+
+
+    def test_DeldictSourceMatcher(self):
+        """
+        test the source matcher with the deletion index
+        """
+        self.assertEqual(get_source_matcher_class(), TrigdictSourceMatcher)
+        self.current_app.config['REFERENCE_SERVICE_SOURCE_MATCHER'] = 'deldict'
+        self.assertEqual(get_source_matcher_class(), DeldictSourceMatcher)
+        self.current_app.config['REFERENCE_SERVICE_SOURCE_MATCHER'] = 'trigdict'
+        s = DeldictSourceMatcher()
+        self.assertEqual(isinstance(s.source_dict, Deldict), True)
+        self.assertEqual(s.bestmatches("Astrophys. J.", 1)[-1], (1.0, 'ApJ......'))
+        self.assertEqual(s.bestmatches("Astrophys. K.", 1)[-1][1], 'ApJ......')
+        self.assertEqual(s.bestmatches_many(["Astrophys. J.", "MNRAS"], 1), [s.bestmatches("Astrophys. J.", 1), s.bestmatches("MNRAS", 1)])
+        self.assertEqual(s.apply_delta(['ignored header\n', 'JIA......\tJournal of Imaginary Astronomy\n']), (1, 0))
+        self.assertEqual(s["Journal of Imaginery Astronomy"], [(1 - 1 / 30., 'JIA......')])
+
+
     def test_DeferredSourceMatcher(self):
         """
         test DeferredSourceMatcher class
@@ -407,6 +712,26 @@ class TestResolver(TestCase):
         self.assertEqual(make_solr_condition("year~", "1992"), 'year:[1987 TO 1997]')
 
 
+    def test_query_compiler(self):
+        """
+        test that the queries of the hypotheses of a reference are put together from fragments made once
+        """
+        ref = Hypotheses({'authors': 'Accomazzi, A., Kurtz, M. J.', 'journal': 'Astrophysical Journal',
+                          'year': '2019', 'volume': '720', 'page': 'L12', 'title': 'On the stars: and (the) planets'})
+        hypotheses = list(Hypotheses.iter_hypotheses(ref))
+        expected = [make_query_string(hypothesis) for hypothesis in hypotheses]
+        query_compiler = QueryCompiler()
+        with mock.patch('referencesrv.resolver.solve.make_solr_condition', wraps=make_solr_condition) as made:
+            self.assertEqual([make_query_string(hypothesis, query_compiler) for hypothesis in hypotheses], expected)
+            self.assertEqual([get_query_args(hypothesis, query_compiler)[0] for hypothesis in hypotheses], expected)
+        # each hint made into a fragment once
+        hints = set((key, value) for hypothesis in hypotheses for key, value in hypothesis.hints.items())
+        self.assertEqual(made.call_count, len(hints))
+        self.assertEqual(len(hints) < sum(len(hypothesis.hints) for hypothesis in hypotheses), True)
+        self.assertEqual(query_compiler.make_condition('page', 'L12'), make_solr_condition('page', 'L12'))
+        self.assertEqual(query_compiler.make_condition('title', ''), None)
+
+
     def test_solve_reference(self):
         """
         testing solve_reference with various fields
@@ -457,6 +782,784 @@ class TestResolver(TestCase):
         self.assertEqual(str(solve_reference(Hypotheses(ref))), '0.8 2019AAS...23320704A')
 
 
+    def fake_solr(self, query, docs):
+        """
+        a stand in for solr, evaluating the query on docs
+
+        :param query:
+        :param docs:
+        :return:
+        """
+        def matches(key, value, doc):
+            quoted = re.findall(r'"([^"]*)"', value)
+            if key in ['author', 'first_author']:
+                doc_names = [name.split(',')[0].lower() for name in doc.get('author_norm', [])]
+                if key == 'first_author':
+                    doc_names = doc_names[:1]
+                return all(name.split(',')[0].lower() in doc_names for name in quoted)
+            if key == 'year' and value.startswith('['):
+                low, _, high = value.strip('[]').split()
+                return int(low) <= int(doc['year']) <= int(high)
+            if key == 'page':
+                return any(fnmatch.fnmatchcase(doc.get('page', [''])[0], page) for page in quoted or [value.strip('()')])
+            if key == 'bibstem':
+                return fnmatch.fnmatchcase(doc.get('bibstem', [''])[0], value.strip('()'))
+            if key == 'doctype':
+                return doc.get('doctype', '') in value.strip('()').split(' OR ')
+            if key == 'identifier':
+                return any(fnmatch.fnmatchcase(identifier, quoted[0]) for identifier in doc['identifier'])
+            if key == 'bibcode':
+                return doc['bibcode'] in quoted
+            if key in ['year', 'volume']:
+                return doc.get(key, '') == quoted[0]
+            if key == 'title':
+                return all(word.lower() in doc['title'][0].lower() for word in value.strip('()').split(' AND '))
+            return True
+        condition_pattern = r'(\w+):(\((?:[^()]|\([^()]*\))*\)|"[^"]*"~?|\[[^\]]*\])'
+        # the batch queries or the conditions
+        if re.fullmatch(r'%s( OR %s)+' % (condition_pattern, condition_pattern), query):
+            conditions = re.findall(condition_pattern, query)
+            return [doc for doc in docs if any(matches(key, value, doc) for key, value in conditions)]
+        conditions = re.findall(condition_pattern, query)
+        return [doc for doc in docs if all(matches(key, value, doc) for key, value in conditions)]
+
+
+    def get_fake_solr_docs(self):
+        """
+        the documents of the fake solr, the test data and some made up ones
+
+        :return:
+        """
+        def make_doc(bibcode, author, title, volume, page):
+            return {'bibcode': bibcode, 'author': [author], 'author_norm': [author.split()[0] + ' ' + author.split()[1][0]],
+                    'first_author_norm': author.split()[0] + ' ' + author.split()[1][0], 'title': [title],
+                    'year': bibcode[:4], 'volume': volume, 'page': [page], 'doctype': 'article',
+                    'bibstem': [bibcode[4:9].strip('.'), bibcode[4:13]], 'identifier': [bibcode],
+                    'pub': {'ApJ': 'The Astrophysical Journal', 'AJ': 'The Astronomical Journal'}[bibcode[4:9].strip('.')]}
+        return get_test_data()['response']['docs'] + [
+            make_doc('2010ApJ...710..123S', 'Smith, John', 'On the stars', '710', '123'),
+            make_doc('2010ApJ...710..456S', 'Smith, John', 'On the galaxies', '710', '456'),
+            make_doc('2010ApJ...710..129D', 'Doe, Jane', 'On the planets', '710', '129'),
+            make_doc('2010AJ....140..123S', 'Smith, John', 'On the comets', '140', '123'),
+            make_doc('2011ApJ...720..100S', 'Smith, John', 'On the moons', '720', '100'),
+        ]
+
+
+    def get_fake_solr_query(self, queries, requested_fields=None):
+        """
+        returns a replacement for Querier.query that evaluates the query on the fake solr documents
+
+        :param queries: list the query strings are appended to
+        :param requested_fields: if given, list the names of the fields requested are appended to
+        :return:
+        """
+        docs = self.get_fake_solr_docs()
+        lock = threading.Lock()
+        def query(querier, query_string, fields=None, probe=False):
+            names = set(name for name, _ in split_query_fields(querier.make_params(query_string, fields)['fl']))
+            with lock:
+                queries.append(query_string)
+                if requested_fields is not None:
+                    requested_fields.append(names)
+            return [querier.massage_solution(dict((key, value) for key, value in doc.items() if key in names))
+                    for doc in copy.deepcopy(self.fake_solr(query_string, docs))]
+        return query
+
+
+    def resolve_or_reason(self, ref):
+        """
+        returns the solution, or the reason the reference was not resolved
+
+        :param ref:
+        :return:
+        """
+        try:
+            return str(solve_reference(Hypotheses(ref)))
+        except Exception as e:
+            return 'exception: %s' % str(e)
+
+
+    fake_solr_refs = [
+        {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2010'},
+        {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2010', 'page': '456'},
+        {'authors': 'Jones, K.', 'journal': 'Astrophysical Journal', 'year': '2010', 'volume': '710', 'page': '123'},
+        {'authors': 'Smith, J.', 'journal': 'Astron. J.', 'year': '2010', 'volume': '140', 'page': '123'},
+        {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2011', 'volume': '720'},
+        {'authors': 'Accomazzi, A.', 'journal': 'AAS233 Meeting', 'volume': '233', 'year': '2019', 'page': '381.08'},
+        {'authors': 'Acomazi, A., et al', 'volume': '233', 'year': '2019', 'page': '0'},
+        {'authors': 'Smith, J.', 'journal': 'Qqqqqq', 'year': '2010', 'volume': '5'},
+    ]
+
+
+    def test_candidate_pool(self):
+        """
+        test that evaluating hypotheses on the candidates of earlier queries gives the same solutions
+        as querying solr for all of them, with fewer queries
+        """
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        resolve = self.resolve_or_reason
+        refs = self.fake_solr_refs
+        # one query at a time, so that the queries can be counted
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        with mock.patch.object(Querier, 'query', query):
+            self.current_app.config['REFERENCE_SERVICE_CANDIDATE_POOL'] = False
+            sequential = [resolve(ref) for ref in refs]
+            num_sequential = len(queries)
+            del queries[:]
+            self.current_app.config['REFERENCE_SERVICE_CANDIDATE_POOL'] = True
+            pooled = [resolve(ref) for ref in refs]
+            num_pooled = len(queries)
+            # a query is sent once per reference, however many hypotheses compile to it
+            self.current_app.config['REFERENCE_SERVICE_CANDIDATE_POOL'] = False
+            for ref in refs:
+                del queries[:]
+                resolve(ref)
+                self.assertEqual(len(queries), len(set(queries)))
+            self.current_app.config['REFERENCE_SERVICE_CANDIDATE_POOL'] = True
+        self.current_app.extensions['source_matcher'] = None
+        self.assertEqual(pooled, sequential)
+        self.assertEqual(sequential[1], '0.8 2010ApJ...710..456S')
+        self.assertEqual(sequential[3], '1.0 2010AJ....140..123S')
+        self.assertEqual(num_pooled < num_sequential, True)
+
+        # conditions that cannot be evaluated on the documents here are left to solr
+        pool = CandidatePool()
+        querier = Querier()
+        solutions = [querier.massage_solution(doc) for doc in [
+            {'bibcode': '2010ApJ...710..123S', 'year': '2010', 'volume': '710', 'page': ['123'], 'bibstem': ['ApJ']},
+            {'bibcode': '2010AJ....140..123S', 'year': '2010', 'volume': '140', 'page': ['123'], 'bibstem': ['AJ']}]]
+        hints = {'author': 'Smith, J', 'year': '2010'}
+        refine = lambda hints: pool.refine(hints, make_solr_conditions(hints))
+        add = lambda hints, solutions: pool.add(' AND '.join(make_solr_conditions(hints).values()), make_solr_conditions(hints), solutions)
+        add(hints, solutions)
+        add({'author': 'Smith, J', 'year': '2011'}, None)
+        self.assertEqual(refine(hints), solutions)
+        self.assertEqual(refine(dict(hints, bibstem='ApJ')), solutions[:1])
+        self.assertEqual(refine(dict(hints, bibstem='A*')), solutions)
+        self.assertEqual(refine(dict(hints, volume='140', page='124')), solutions[1:])
+        self.assertEqual(refine(dict(hints, page='12')), [])
+        self.assertEqual(refine(dict(hints, bibstem='APJ')), None)
+        self.assertEqual(refine(dict(hints, page='L123')), None)
+        self.assertEqual(refine(dict(hints, title='stars')), None)
+        self.assertEqual(refine({'author': 'Smith, J', 'year': '2011', 'volume': '720'}), None)
+        self.assertEqual(refine({'author': 'Smith, J'}), None)
+        self.assertEqual(pool.num_refined, 5)
+        # solr matches any of the pages of a record, they are joined in the pooled document
+        pool = CandidatePool()
+        solutions = [querier.massage_solution({'bibcode': '2010ApJ...710..123S', 'year': '2010', 'volume': '710',
+                                               'page': ['123', '124'], 'bibstem': ['ApJ']})]
+        add(hints, solutions)
+        self.assertEqual(solutions[0]['page'], '123124')
+        self.assertEqual(solutions[0].copy().num_pages, 2)
+        self.assertEqual(refine(dict(hints, page='123')), None)
+        self.assertEqual(refine(dict(hints, volume='710')), solutions)
+
+
+    def test_speculative_querier(self):
+        """
+        test that sending the queries of the next hypotheses ahead of time gives the same solutions
+        """
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        with mock.patch.object(Querier, 'query', query):
+            self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+            sequential = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+            num_sequential = len(queries)
+            counters.reset()
+            self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 4
+            speculative = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+            num_speculative = len(queries) - num_sequential
+            # the budget limits the queries sent ahead of time
+            self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_BUDGET'] = 0
+            no_budget = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+        self.current_app.extensions['source_matcher'] = None
+        self.assertEqual(speculative, sequential)
+        self.assertEqual(no_budget, sequential)
+        r = self.client.get('/metrics')
+        self.assertEqual(r.status_code, 200)
+        metrics = json.loads(r.data)
+        self.assertEqual(metrics['speculative_queries'] > 0, True)
+        self.assertEqual(metrics['speculative_queries'],
+                         metrics['speculative_queries_used'] + metrics['speculative_queries_wasted'])
+        # the queries sent ahead of time and not needed are the only extra ones
+        self.assertEqual(num_sequential <= num_speculative <= num_sequential + metrics['speculative_queries_wasted'], True)
+
+    def test_speculative_querier_failed_query(self):
+        """
+        test that a hypothesis whose query cannot be made is dropped on its own when sent ahead of time
+        """
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        # the year~ condition cannot be made for a year that is not numeric
+        ref = {'authors': 'Accomazzi, A.', 'year': '2O19', 'page': '381.08', 'title': 'zzz qqq'}
+        with mock.patch.object(Querier, 'query', query):
+            self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+            sequential = self.resolve_or_reason(ref)
+            sequential_queries = list(queries)
+            del queries[:]
+            self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 3
+            speculative = self.resolve_or_reason(ref)
+        self.assertEqual(speculative, sequential)
+        self.assertEqual(speculative.startswith('exception: invalid literal'), False)
+        self.assertEqual(sorted(set(queries)), sorted(set(sequential_queries)))
+
+
+    def test_speculative_querier_prefetch(self):
+        """
+        test that the queries the candidate pool might work out are not sent ahead of time, and that
+        the ones still waiting for a thread of the pool are executed in the request thread
+        """
+        get_conditions = lambda hints: make_solr_conditions(hints)
+        get_query_args = lambda hints: (' AND '.join(make_solr_conditions(hints).values()), None, False)
+        hints = {'author': 'Smith, J', 'year': '2010'}
+        other_hints = {'author': 'Smith, J', 'title': 'stars'}
+        # the only thread of the pool is busy
+        release = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+        executor.submit(release.wait)
+        self.current_app.extensions['speculative_executor'] = executor
+        counters.reset()
+        try:
+            with mock.patch.object(Querier, 'query', lambda querier, query_string, fields=None, probe=False: [query_string]):
+                speculative = SpeculativeQuerier(Querier(), get_query_args, get_conditions, CandidatePool(), 3, 8)
+                for each in [hints, dict(hints, volume='710', page='123'), other_hints]:
+                    speculative.prefetch(each)
+                self.assertEqual(sorted(speculative.futures), sorted([get_query_args(hints), get_query_args(other_hints)]))
+                query_string = get_query_args(hints)[0]
+                self.assertEqual(speculative.query(query_string), [query_string])
+                speculative.close()
+        finally:
+            release.set()
+            executor.shutdown()
+            self.current_app.extensions.pop('speculative_executor')
+        self.assertEqual(counters.get('speculative_queries'), 2)
+        self.assertEqual(counters.get('speculative_queries_used'), 0)
+        self.assertEqual(counters.get('speculative_queries_wasted'), 2)
+        # when the pool does not refine locally, the query is sent ahead
+        self.assertEqual(CandidatePool(refine_locally=False).may_refine(get_conditions(dict(hints, volume='710')), [get_conditions(hints)]), False)
+        self.assertEqual(CandidatePool().may_refine(get_conditions(dict(hints, volume='710')), [get_conditions(hints)]), True)
+        self.assertEqual(CandidatePool().may_refine(get_conditions(dict(hints, title='stars')), [get_conditions(hints)]), False)
+
+
+    def test_hypothesis_timed_out(self):
+        """
+        test that a hypothesis whose query times out is dropped, counted, and the next ones are tried
+        """
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        def slow_query(querier, query_string, fields=None, probe=False):
+            if query_string.startswith('identifier:'):
+                raise SolrTimeout('timeout 5.00 seconds')
+            return query(querier, query_string, fields, probe)
+        ref = {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2011', 'volume': '720'}
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        hypothesis_counters.reset()
+        with mock.patch.object(Querier, 'query', slow_query):
+            self.assertEqual(self.resolve_or_reason(ref), '1.0 2011ApJ...720..100S')
+        self.current_app.extensions['source_matcher'] = None
+        r = self.client.get('/metrics')
+        # one bibcode for each of the bibstems of the journal
+        self.assertEqual(json.loads(r.data)['hypotheses']['fielded-bibcode']['timeouts'], 2)
+        hypothesis_counters.reset()
+
+
+    def test_hypothesis_ordering(self):
+        """
+        test recording which hypotheses resolve references, and trying the best one first
+        """
+        self.assertEqual(get_reference_shape(Hypotheses({'authors': 'Accomazzi, A.', 'year': '2019', 'page': '0'})),
+                         'page,author,year|none')
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        ref = {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2011', 'volume': '720'}
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        hypothesis_stats.reset()
+        counters.reset()
+        with mock.patch.object(Querier, 'query', query):
+            shape = get_reference_shape(Hypotheses(ref))
+            self.assertEqual(shape, 'pub,volume,author,year|journal')
+            self.assertEqual(self.resolve_or_reason(ref), '1.0 2011ApJ...720..100S')
+            self.assertEqual(queries[0].startswith('identifier:'), True)
+            self.assertEqual(hypothesis_stats.to_dict()[shape], {'fielded-bibcode': {'references': 1, 'solr_queries': 1}})
+            # say author/pub/year has been resolving references of this shape
+            for _ in range(3):
+                hypothesis_stats.record(shape, 'fielded-author/pub/year', 1)
+                hypothesis_stats.record(shape, UNRESOLVED, 8)
+            self.assertEqual(hypothesis_stats.get_ranking(shape, 7), ['fielded-author/pub/year', 'fielded-bibcode'])
+            self.assertEqual(hypothesis_stats.get_ranking(shape, 8), [])
+            self.current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING'] = 'learned'
+            self.current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING_MIN_OBSERVATIONS'] = 7
+            del queries[:]
+            self.assertEqual(self.resolve_or_reason(ref), '1.0 2011ApJ...720..100S')
+            self.assertEqual(queries[0], 'author:("Smith") AND bibstem:(ApJ) AND year:"2011"')
+            # not enough observations for the shape
+            self.current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING_MIN_OBSERVATIONS'] = 100
+            del queries[:]
+            self.assertEqual(self.resolve_or_reason(ref), '1.0 2011ApJ...720..100S')
+            self.assertEqual(queries[0].startswith('identifier:'), True)
+            # shadow mode resolves with the fixed order, and counts the agreement of the learned order
+            self.current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING'] = 'shadow'
+            self.current_app.config['REFERENCE_SERVICE_HYPOTHESIS_ORDERING_MIN_OBSERVATIONS'] = 7
+            self.assertEqual(self.resolve_or_reason(ref), '1.0 2011ApJ...720..100S')
+            self.assertEqual(counters.get('ordering_shadow_agreed'), 1)
+            self.assertEqual(counters.get('ordering_shadow_disagreed'), 0)
+
+        def failing_query(querier, query_string, fields=None, probe=False):
+            if query_string.startswith('author:'):
+                raise Solr('status_code 503')
+            return query(querier, query_string, fields, probe)
+        # author/pub/year stays first in the learned order
+        hypothesis_stats.record(shape, 'fielded-author/pub/year', 1)
+        with mock.patch.object(Querier, 'query', failing_query):
+            # the queries of the learned order failing does not change the solution of the fixed order
+            self.assertEqual(self.resolve_or_reason(ref), '1.0 2011ApJ...720..100S')
+            self.assertEqual(counters.get('ordering_shadow_failed'), 1)
+            self.assertEqual(counters.get('ordering_shadow_agreed'), 1)
+        self.current_app.extensions['source_matcher'] = None
+        r = self.client.get('/hypothesis_stats')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data)[shape]['fielded-author/pub/year']['references'], 5)
+        hypothesis_stats.reset()
+
+
+    def test_plan_first_round(self):
+        """
+        test querying solr for the first round of hypotheses of a batch of references at once
+        """
+        self.assertEqual(match_first_round('bibcode', '2010?????...5??????', {'identifier': ['2010ApJ.....5..123S']}), True)
+        self.assertEqual(match_first_round('bibcode', '2010ApJ...710..123?', {'identifier': ['2010ApJ...710..123S']}), True)
+        self.assertEqual(match_first_round('bibcode', '2010ApJ...710..123?', {'identifier': ['2010ApJ...710..456S']}), False)
+        self.assertEqual(match_first_round('arxiv', '1004.1234', {'identifier': ['arXiv:1004.1234']}), True)
+        self.assertEqual(match_first_round('doi', '10.1086/X', {'doi': ['10.1086/x']}), True)
+        self.assertEqual(match_first_round('doi', '10.1086/X', {'identifier': ['10.1086/X']}), False)
+
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        with mock.patch.object(Querier, 'query', query):
+            refs = [Hypotheses(ref) for ref in self.fake_solr_refs]
+            sequential = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+            num_sequential = len(queries)
+            del queries[:]
+            candidate_pools = plan_first_round(refs + [None])
+            self.assertEqual(candidate_pools[-1], None)
+            num_batch = len(queries)
+            seeded = set(condition for ref, candidate_pool in zip(refs, candidate_pools)
+                         for _, _, condition, _ in get_first_round(ref) if condition in candidate_pool.results)
+            batched = []
+            for ref, candidate_pool in zip(refs, candidate_pools):
+                try:
+                    batched.append(str(solve_reference(ref, candidate_pool)))
+                except Exception as e:
+                    batched.append('exception: %s' % str(e))
+
+            # the conditions no document is routed to are not seeded, nor are any of a query returning
+            # a document routed to none of its conditions
+            ref = Hypotheses(dict(self.fake_solr_refs[3], doi='10.1086/123'))
+            first_round = [condition for _, _, condition, _ in get_first_round(ref)]
+            docs = [{'bibcode': '2010AJ....140..123S', 'identifier': ['2010AJ....140..123S']}]
+            batch_query = lambda querier, query_string, fields=None, probe=False: \
+                [querier.massage_solution(doc) for doc in copy.deepcopy(docs)]
+            with mock.patch.object(Querier, 'query', batch_query):
+                results = plan_first_round([ref])[0].results
+                self.assertEqual(len(results) > 0, True)
+                self.assertEqual([condition for condition in first_round if condition.startswith('doi:')], ['doi:"10.1086/123"'])
+                self.assertEqual('doi:"10.1086/123"' in results, False)
+                docs.append({'bibcode': '2010AJ....140..123X', 'identifier': ['10.1086/124']})
+                self.assertEqual(plan_first_round([ref])[0].results, {})
+        self.current_app.extensions['source_matcher'] = None
+        self.assertEqual(batched, sequential)
+        # one query for the exact bibcodes, and one for the ones with wildcards
+        self.assertEqual(num_batch, 2)
+        self.assertEqual(sum(len(get_first_round(ref)) for ref in refs) > num_batch, True)
+        self.assertEqual(len(queries) < num_sequential, True)
+        # the conditions seeded are not queried again, the ones no document was routed to are
+        self.assertEqual(len(seeded) > 0, True)
+        self.assertEqual(seeded.intersection(queries[num_batch:]), set())
+
+    def test_score_fields(self):
+        """
+        test that the score functions read only the fields they declared, and that requesting only
+        these from solr gives the same solutions
+        """
+        class UndeclaredField(Exception):
+            pass
+
+        class DeclaredFieldsOnly(dict):
+            """
+            a solr record failing on any access to a field the score function did not declare
+            """
+            def __init__(self, doc, fields):
+                dict.__init__(self, doc)
+                self.fields = fields
+            def check(self, key):
+                if key not in self.fields:
+                    raise UndeclaredField(key)
+            def __getitem__(self, key):
+                self.check(key)
+                return dict.__getitem__(self, key)
+            def get(self, key, default=None):
+                self.check(key)
+                return dict.get(self, key, default)
+            def __contains__(self, key):
+                self.check(key)
+                return dict.__contains__(self, key)
+
+        input_fields = {'author': 'Smith, J.', 'year': '2010', 'volume': '710', 'page': '123',
+                        'pub': 'Astrophysical Journal', 'bibstem': 'ApJ', 'title': 'On the stars',
+                        'doi': '10.1086/123', 'arxiv': '1004.1234', 'bibcode': '2010ApJ...710..123S',
+                        'refstr': 'Smith, J. 2010, ApJ, 710, 123'}
+        score_functions = [get_author_year_score_for_input_fields, get_author_year_pub_score_for_input_fields,
+                           get_volume_page_score_for_input_fields, get_basic_score_for_input_fields,
+                           get_serial_score_for_input_fields, get_book_score_for_input_fields,
+                           get_catalog_score_for_input_fields, get_thesis_score_for_input_fields,
+                           get_chapter_score_for_input_fields, get_score_for_input_fields,
+                           get_score_for_reference_identifier, get_score_for_baas_match]
+        hypotheses = [Hypothesis('test', {}, score_function, input_fields=input_fields,
+                                 normalized_authors='Smith, J', expected_bibstem='ApJ')
+                      for score_function in score_functions]
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        for ref in self.fake_solr_refs:
+            hypotheses.extend(Hypotheses.iter_hypotheses(Hypotheses(ref)))
+        querier = Querier()
+        num_scored = 0
+        for hypothesis in hypotheses:
+            self.assertNotEqual(hypothesis.get_solr_fields(), None)
+            names = set(name for name, _ in split_query_fields(
+                querier.make_params('', get_query_fields(hypothesis.get_solr_fields()))['fl']))
+            for doc in self.get_fake_solr_docs():
+                doc = querier.massage_solution(dict((key, value) for key, value in copy.deepcopy(doc).items() if key in names))
+                try:
+                    hypothesis.get_score(DeclaredFieldsOnly(doc, hypothesis.get_solr_fields()), hypothesis)
+                    num_scored += 1
+                except UndeclaredField as e:
+                    self.fail('%s reads undeclared field %s' % (hypothesis.get_score_function.__name__, e))
+                except Exception:
+                    # some score functions do not apply to some of the documents
+                    pass
+        self.assertEqual(num_scored > 0, True)
+
+        queries = []
+        requested_fields = []
+        query = self.get_fake_solr_query(queries, requested_fields)
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        with mock.patch.object(Querier, 'query', query):
+            self.current_app.config['REFERENCE_SERVICE_FIELD_PROJECTION'] = False
+            all_fields = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+            num_all_fields = len(queries)
+            self.assertEqual(len(set(frozenset(names) for names in requested_fields)), 1)
+            del queries[:]
+            del requested_fields[:]
+            self.current_app.config['REFERENCE_SERVICE_FIELD_PROJECTION'] = True
+            projected = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+        self.current_app.extensions['source_matcher'] = None
+        self.assertEqual(projected, all_fields)
+        self.assertEqual(len(queries), num_all_fields)
+        # the identifier lookups do not request the authors, affiliations and such
+        self.assertEqual(min(len(names) for names in requested_fields) < 8, True)
+        self.assertEqual('aff_raw' in set.union(*requested_fields), False)
+
+
+    def test_count_probe(self):
+        """
+        test counting the documents of the broad hypotheses before fetching them
+        """
+        querier = Querier()
+        sent = []
+        def send(params, num_found, docs):
+            sent.append(params)
+            return {'response': {'numFound': num_found, 'docs': docs if params['rows'] != '0' else []}}
+        counters.reset()
+        with mock.patch.object(Querier, 'send', lambda querier, params: send(params, 150, [])):
+            self.assertEqual(querier.query('author:("Smith")', probe=True), None)
+        # only the count is sent for an overflow
+        self.assertEqual([params['rows'] for params in sent], ['0'])
+        self.assertEqual(counters.get('count_probes_overflowed'), 1)
+        del sent[:]
+        doc = {'bibcode': '2010ApJ...710..123S', 'author': ['Smith, John'], 'title': ['On the stars']}
+        with mock.patch.object(Querier, 'send', lambda querier, params: send(params, 1, [doc])):
+            self.assertEqual([solution['bibcode'] for solution in querier.query('author:("Smith")', probe=True)],
+                             ['2010ApJ...710..123S'])
+            self.assertEqual(len(querier.query('author:("Smith")')), 1)
+        self.assertEqual([params['rows'] for params in sent], ['0', '100', '100'])
+        self.assertEqual(counters.get('count_probes'), 2)
+
+        queries = []
+        probed = []
+        fake_query = self.get_fake_solr_query(queries)
+        def query(querier, query_string, fields=None, probe=False):
+            if probe:
+                probed.append(query_string)
+            return fake_query(querier, query_string, fields, probe)
+        ref = {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2010'}
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        hypothesis_counters.reset()
+        with mock.patch.object(Querier, 'query', query):
+            solution = self.resolve_or_reason(ref)
+            self.assertEqual(probed, [])
+            self.current_app.config['REFERENCE_SERVICE_COUNT_PROBE'] = True
+            self.assertEqual(self.resolve_or_reason(ref), solution)
+            self.current_app.config['REFERENCE_SERVICE_COUNT_PROBE'] = False
+        self.current_app.extensions['source_matcher'] = None
+        # the broad hypotheses are fielded-author/year and the fuzzy ones
+        self.assertEqual(probed, ['author:("Smith") AND year:"2010"', 'first_author:"Smith"~ AND year:"2010"',
+                                  'author:("Smith") AND year:[2005 TO 2015]'])
+        self.assertEqual(hypothesis_counters.to_dict()['fielded-author/year'],
+                         {'solr_queries': 2, 'overflows': 0, 'overflows_probed': 0, 'timeouts': 0, 'overflow_rate': 0.0})
+        hypothesis_counters.record('fielded-author/year', True, True)
+        r = self.client.get('/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data)['hypotheses']['fielded-author/year']['overflow_rate'], 1.0 / 3)
+        hypothesis_counters.reset()
+
+
+    def test_identifier_index(self):
+        """
+        test resolving the identifiers from the local index, and querying solr for the ones not in it
+        """
+        self.assertEqual(get_record_identifier_key('arXiv:1004.1234'), 'arxiv:1004.1234')
+        self.assertEqual(get_record_identifier_key('10.1086/ABC'), 'doi:10.1086/abc')
+        self.assertEqual(get_record_identifier_key('2010ApJ...710..123S'), None)
+
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'identifiers.idx')
+        lines = ['2010ApJ...710..123S\t2010ApJ...710..123S\t10.1086/ABC\tarXiv:1004.1234\n',
+                 '2010ApJ...710..456S\t10.1086/ab\n',
+                 '2010AJ....140..123S\t10.1086/dup\n',
+                 '2010ApJ...710..129D\t10.1086/dup\tascl:1004.001\n']
+        self.assertEqual(build_identifier_index(lines, filename), 6)
+        identifier_index = IdentifierIndex(filename)
+        self.assertEqual(identifier_index.get_bibcodes('doi', '10.1086/abc'), ['2010ApJ...710..123S'])
+        self.assertEqual(identifier_index.get_bibcodes('doi', '10.1086/AB'), ['2010ApJ...710..456S'])
+        self.assertEqual(identifier_index.get_bibcodes('doi', '10.1086/a'), [])
+        self.assertEqual(identifier_index.get_bibcodes('doi', '10.1086/dup'), ['2010AJ....140..123S', '2010ApJ...710..129D'])
+        self.assertEqual(identifier_index.get_bibcodes('arxiv', '1004.1234'), ['2010ApJ...710..123S'])
+        self.assertEqual(identifier_index.get_bibcodes('ascl', '1004.001'), ['2010ApJ...710..129D'])
+        self.assertEqual(identifier_index.get_bibcodes('zzz', '1'), [])
+        identifier_index.close()
+
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        ref = {'authors': 'Smith, J.', 'journal': 'Astrophysical Journal', 'year': '2010', 'volume': '710', 'page': '123'}
+        self.current_app.config['REFERENCE_SERVICE_IDENTIFIER_INDEX'] = filename
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        with mock.patch.object(Querier, 'query', query):
+            solution = solve_reference(Hypotheses(dict(ref, doi='10.1086/ABC')))
+            self.assertEqual((str(solution), solution.source_hypothesis), ('1.0 2010ApJ...710..123S', 'fielded-DOI'))
+            self.assertEqual(queries, [])
+            # the doi is not in the index, so it is queried before the arXiv id is looked up
+            self.resolve_or_reason(dict(ref, doi='10.1086/XYZ', arxiv='1004.1234'))
+            self.assertEqual(queries[0], 'doi:"10.1086/XYZ"')
+            # more than one record has the doi
+            del queries[:]
+            self.resolve_or_reason(dict(ref, doi='10.1086/dup'))
+            self.assertEqual(queries[0], 'doi:"10.1086/dup"')
+            self.assertEqual(counters.get('identifier_index_hits') >= 1, True)
+        self.current_app.extensions['source_matcher'] = None
+        self.current_app.extensions['local_indexes'].pop('REFERENCE_SERVICE_IDENTIFIER_INDEX').close()
+        self.current_app.config['REFERENCE_SERVICE_IDENTIFIER_INDEX'] = None
+        shutil.rmtree(tmp_dir)
+
+
+    def test_bibcode_index(self):
+        """
+        test matching the constructed bibcodes on the local bibcode index, and fetching the records matched
+        """
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'bibcodes.idx')
+        docs = self.get_fake_solr_docs()
+        lines = ['%s\n' % doc['bibcode'] for doc in docs] + ['2010ApJ...710..123S\t2009arXiv0912.1234S\n', 'not a bibcode\n']
+        self.assertEqual(build_bibcode_index(lines, filename), len(docs) + 1)
+        bibcode_index = BibcodeIndex(filename)
+        self.assertEqual(bibcode_index.match('2010ApJ...710..123?', 100), ['2010ApJ...710..123S'])
+        self.assertEqual(bibcode_index.match('2010apj...710..123s', 100), ['2010ApJ...710..123S'])
+        self.assertEqual(bibcode_index.match('2010ApJ...710..12??', 100), ['2010ApJ...710..123S', '2010ApJ...710..129D'])
+        # the journal is not known
+        self.assertEqual(bibcode_index.match('2010?????.710..123?', 100), ['2010ApJ...710..123S'])
+        self.assertEqual(bibcode_index.match('2010?????.140..123?', 100), ['2010AJ....140..123S'])
+        # an alternate bibcode
+        self.assertEqual(bibcode_index.match('2009arXiv0912.1234S', 100), ['2010ApJ...710..123S'])
+        self.assertEqual(bibcode_index.match('2010ApJ...710..124?', 100), [])
+        # the literal prefixes are too short to match here, or it is an overflow
+        self.assertEqual(bibcode_index.match('2010?????.710?.123?', 100), None)
+        self.assertEqual(bibcode_index.match('2010ApJ...710', 100), None)
+        self.assertEqual(bibcode_index.match('2010ApJ..??????????', 2), None)
+        bibcode_index.close()
+
+        queries = []
+        query = self.get_fake_solr_query(queries)
+        self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 1
+        self.current_app.extensions['source_matcher'] = TrigdictSourceMatcher()
+        with mock.patch.object(Querier, 'query', query):
+            sequential = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+            num_wildcards = len([query_string for query_string in queries if query_string.startswith('identifier:')])
+            del queries[:]
+            self.current_app.config['REFERENCE_SERVICE_BIBCODE_INDEX'] = filename
+            indexed = [self.resolve_or_reason(ref) for ref in self.fake_solr_refs]
+            refs = [Hypotheses(ref) for ref in self.fake_solr_refs]
+            # the batch planner leaves the constructed bibcodes the index matches to it
+            patterns = [entry[1] for ref in refs for entry in get_first_round(ref) if entry[0] == 'bibcode']
+            self.assertEqual([pattern for pattern in patterns if get_bibcode_index().match(pattern, 100) is not None], [])
+            # with the queries sent ahead of time as well
+            self.current_app.config['REFERENCE_SERVICE_SPECULATIVE_WINDOW'] = 4
+            self.assertEqual([self.resolve_or_reason(ref) for ref in self.fake_solr_refs], sequential)
+        self.current_app.extensions['source_matcher'] = None
+        self.current_app.extensions['local_indexes'].pop('REFERENCE_SERVICE_BIBCODE_INDEX').close()
+        self.current_app.config['REFERENCE_SERVICE_BIBCODE_INDEX'] = None
+        shutil.rmtree(tmp_dir)
+        self.assertEqual(indexed, sequential)
+        # the constructed bibcodes with long enough literal prefixes are matched locally, and the records
+        # fetched by their bibcodes, the others are still queried in solr
+        self.assertEqual(len([query_string for query_string in queries if query_string.startswith('identifier:')]) < num_wildcards, True)
+        self.assertEqual('bibcode:("2011ApJ...720..100S")' in queries, True)
+
+
+    def test_resolver_settings(self):
+        """
+        test that the scoring reads the settings it is given, not the app configuration
+        """
+        settings = get_settings()
+        self.assertEqual((settings.min_score, settings.max_score), tuple(self.current_app.config['EVIDENCE_SCORE_RANGE']))
+        self.assertEqual(Evidences().settings, settings)
+
+        # built from a plain dict, as in the workers of a process pool
+        config = dict(self.current_app.config)
+        config['MISSING_VOLUME_FACTORY'] = 0.5
+        config['NO_LETTER_DEMERIT'] = -0.5
+        other = make_settings(config)
+        evidences = Evidences(other)
+        add_volume_evidence(evidences, '233', '', '', 'Proceedings, vol 233')
+        self.assertEqual(evidences.evidences, [0.5])
+        with mock.patch('referencesrv.resolver.settings._settings', other):
+            self.assertEqual(compute_page_delta("32", "L32", "P"), 0.5)
+        self.assertEqual(compute_page_delta("32", "L32", "P"), 1 + self.current_app.config['NO_LETTER_DEMERIT'])
+
+        # the settings cannot be changed by accident
+        with self.assertRaises(AttributeError):
+            settings.max_score = 2
+        with self.assertRaises(TypeError):
+            settings.journal_abbreviation['ApJ'] = 'ApJ'
+
+
+    def test_numeric_evidences(self):
+        """
+        test that the year and volume evidences computed for all the candidates at once are the ones
+        computed for one candidate at a time
+        """
+        self.assertEqual(get_year_evidences('2010', ['2010', '2011', '1910', '201', '20100', 'None']),
+                         [1.0, 0.75, 0.5, 0.75, 1.0, 0.0])
+        self.assertEqual(get_volume_scores('710', ['710', '711', '700', '0', '2010', 'A12', '709', '3'], 1),
+                         [1, 0.3, None, None, None, None, 0.3, 0])
+        self.assertEqual(get_volume_scores('A12', ['710'], 1), None)
+
+        querier = Querier()
+        docs = [querier.massage_solution(doc) for doc in self.get_fake_solr_docs()]
+        solutions = []
+        for i, (year, volume) in enumerate([('2010', '710'), ('2011', '711'), ('2009', '700'), ('2010', '709'),
+                                            ('2010', '0'), ('2010', '2010'), ('2010', 'A12'), ('2010', ''),
+                                            ('201', '7100'), ('2012', '1710'), ('1998', '71'), ('2010', '710')]):
+            doc = dict(docs[i % len(docs)], year=year, volume=volume, doctype='inproceedings' if i % 3 else 'article')
+            solutions.append(doc)
+        input_fields = {'author': 'Smith, J.', 'year': '2010', 'volume': '710', 'page': '123', 'pub': 'ApJ',
+                        'refstr': 'Smith, J. 2010, ApJ, 710, 123'}
+        hypothesis = Hypothesis('test', {}, get_score_for_input_fields, input_fields=input_fields,
+                                normalized_authors='Smith, J')
+        expected = [str(hypothesis.get_score(doc, hypothesis)) for doc in solutions]
+        numeric_evidences = get_numeric_evidences(hypothesis, solutions)
+        self.assertEqual(isinstance(numeric_evidences, NumericEvidences), True)
+        self.assertEqual(numeric_evidences.get_year_evidence('2010', '2011'), 0.75)
+        self.assertEqual(numeric_evidences.get_volume_score('710', '709'), 0.3)
+        # not computed for another reference value
+        self.assertEqual(numeric_evidences.get_volume_score('711', '709'), None)
+        hypothesis.details['numeric_evidences'] = numeric_evidences
+        self.assertEqual([str(hypothesis.get_score(doc, hypothesis)) for doc in solutions], expected)
+        # too few candidates to compute them at once
+        self.assertEqual(get_numeric_evidences(hypothesis, solutions[:2]), None)
+
+        # the scored candidates are put in the order sorted2 puts them in, without formatting the records
+        scored = [(hypothesis.get_score(doc, hypothesis), doc) for doc in solutions]
+        self.assertEqual([id(evidences) for evidences, _ in sort_scored(scored)],
+                         [id(evidences) for evidences, _ in sorted2(scored)])
+
+
+    def test_evidences_compact(self):
+        """
+        test that the slotted evidences compare and look up the way they did
+        """
+        evidences = Evidences()
+        evidences.add_evidence(1, 'authors')
+        evidences.add_evidence(0.5, 'page')
+        evidences.add_evidence(-0.5, 'page')
+        other = Evidences()
+        other.add_evidence(1, 'year')
+        self.assertEqual(evidences['page'], -0.5)
+        self.assertEqual(evidences['volume'], None)
+        self.assertEqual((evidences < other, evidences <= 1, evidences >= 1, evidences == other), (False, True, True, True))
+        # compared with a false value, an evidence is not ordered
+        self.assertEqual((evidences > 0, evidences < None, evidences == 0), (False, False, False))
+        with self.assertRaises(AttributeError):
+            evidences.extra = 1
+        with self.assertRaises(AttributeError):
+            Hypothesis('test', {}, None).extra = 1
+
+        other.add_evidence(1, 'authors')
+        other.add_evidence(1, 'page')
+        self.assertEqual(other.count_votes(), True)
+        self.assertEqual(evidences.count_votes(), False)
+
+
+    def test_lazy_evidences(self):
+        """
+        test that skipping the author, publication and title evidences of the records the year, volume
+        and page already rule out does not change the solution chosen
+        """
+        querier = Querier()
+        docs = [querier.massage_solution(doc) for doc in self.get_fake_solr_docs()]
+        solutions = []
+        for i, (year, volume) in enumerate([('2010', '710'), ('1998', '71'), ('2011', '711'), ('1998', '12'),
+                                            ('2010', '0'), ('1987', '2010')]):
+            solutions.append(dict(docs[i % len(docs)], year=year, volume=volume,
+                                  doctype='inproceedings' if i % 2 else 'article'))
+        input_fields = {'author': 'Smith, J.', 'year': '2010', 'volume': '710', 'page': '123', 'pub': 'ApJ',
+                        'refstr': 'Smith, J. 2010, ApJ, 710, 123'}
+        hypothesis = Hypothesis('test', {}, get_score_for_input_fields, input_fields=input_fields,
+                                normalized_authors='Smith, J')
+
+        def choose(settings):
+            with mock.patch('referencesrv.resolver.settings._settings', settings):
+                scored = [(hypothesis.get_score(doc, hypothesis), doc) for doc in solutions]
+                try:
+                    evidences, solution = choose_solution(scored, 'test', hypothesis)
+                    chosen = (evidences.evidences, solution['bibcode'])
+                except NoSolution as e:
+                    chosen = (e.__class__, [(str(score), bibcode) for score, bibcode in getattr(e, 'considered_solutions', [])])
+            return scored, chosen
+
+        settings = get_settings()
+        lazy_scored, lazy_chosen = choose(settings._replace(lazy_evidences=True))
+        full_scored, full_chosen = choose(settings._replace(lazy_evidences=False))
+        self.assertEqual(lazy_chosen, full_chosen)
+        min_score = settings.min_score_first_round
+        for (lazy, _), (full, _) in zip(lazy_scored, full_scored):
+            if len(lazy) == len(full):
+                self.assertEqual((lazy.evidences, lazy.labels), (full.evidences, full.labels))
+            else:
+                # only a record that is rejected either way is not compared on all the fields
+                self.assertEqual(set(lazy.labels), {'year', 'volume', 'page'})
+                self.assertEqual(lazy.has_veto() and full.has_veto(), True)
+                self.assertEqual(lazy.single_veto_from('page') or full.single_veto_from('page'), False)
+                self.assertEqual(lazy < min_score * len(lazy) and full < min_score * len(full), True)
+        self.assertEqual([len(lazy) < len(full) for (lazy, _), (full, _) in zip(lazy_scored, full_scored)],
+                         [False, True, False, True, True, True])
+
+
     def test_add_volume_evidence(self):
         """
         test add_volume_evidence
@@ -638,6 +1741,9 @@ class TestResolver(TestCase):
                          {'q': 'author:("Accomazzi, A") AND year:"2019" AND bibstem:(AAS)',
                           'rows': '100',
                           'fl': u'author,[fields author=10]author_norm,[fields author_norm=10],first_author_norm,year,title,pub,pub_raw,aff_raw,[fields aff_raw=1],volume,issue,page,page_range,bibstem,bibcode,identifier,doi,doctype'})
+        # only the fields the score function reads, with their transformers
+        self.assertEqual(solrquery.make_params('doi:"10.1086/123"', get_query_fields(frozenset(['doi', 'author_norm'])))['fl'],
+                         'author,[fields author=10],author_norm,[fields author_norm=10],first_author_norm,title,bibcode,doi')
 
         # no author_norm
         solution = {u'bibcode': u'2013JARS....7.3461V',
@@ -659,6 +1765,56 @@ class TestResolver(TestCase):
                           u'page': u'073461'})
 
 
+    def test_decode_solr_response(self):
+        """
+        test that the responses of solr are decoded the same with and without orjson
+        """
+        body = json.dumps(get_test_data(), ensure_ascii=False).encode('utf-8')
+        response = requests.Response()
+        response.status_code = 200
+        response.encoding = 'utf-8'
+        response._content = body
+        self.assertEqual(decode_solr_response(response, use_orjson=True), get_test_data())
+        self.assertEqual(decode_solr_response(response, use_orjson=False), get_test_data())
+        with mock.patch('referencesrv.resolver.solrquery.orjson', None):
+            self.assertEqual(decode_solr_response(response, use_orjson=True), get_test_data())
+        # what orjson rejects is left to json
+        response._content = b'{"response": {"numFound": NaN}}'
+        self.assertEqual(math.isnan(decode_solr_response(response)['response']['numFound']), True)
+
+        querier = Querier()
+        self.assertEqual(querier.use_orjson, self.current_app.config['REFERENCE_SERVICE_SOLR_ORJSON'])
+
+
+    def test_solr_record(self):
+        """
+        test that the authors of a record are normalized when read, and the normalizations remembered
+        """
+        normalize_single_author.cache_clear()
+        solrquery = Querier()
+        solutions = [solrquery.massage_solution({'bibcode': '2013JARS....7.3461V', 'year': '2013',
+                                                 'author_norm': ['M\u00fcller-Schmidt, K', 'Smith, J'],
+                                                 'first_author_norm': 'M\u00fcller-Schmidt, K'})
+                     for _ in range(3)]
+        self.assertEqual(isinstance(solutions[0], SolrRecord), True)
+        # not normalized until read
+        self.assertEqual(sorted(solutions[0].pending), ['author_norm', 'first_author_norm'])
+        self.assertEqual(solutions[0].get('year'), '2013')
+        self.assertEqual(normalize_single_author.cache_info().misses, 0)
+        self.assertEqual(solutions[0].get('first_author_norm'), 'muller schmidt, k')
+        self.assertEqual(solutions[0]['author_norm'], ['muller schmidt, k', 'smith, j'])
+        self.assertEqual(solutions[0].pending, {})
+        # the first author, and the same authors in the other records, are looked up
+        for solution in solutions[1:]:
+            self.assertEqual(dict(solution), solutions[0])
+        self.assertEqual((normalize_single_author.cache_info().misses, normalize_single_author.cache_info().hits), (2, 7))
+        # a copy, or the record compared as a whole, has its authors normalized
+        solution = solrquery.massage_solution({'bibcode': '2013JARS....7.3461V', 'author': ['M\u00fcller, K']})
+        self.assertEqual(json.loads(json.dumps(solution)),
+                         {'bibcode': '2013JARS....7.3461V', 'author': ['M\u00fcller, K'],
+                          'author_norm': ['Muller, K'], 'first_author_norm': 'muller, k'})
+
+
 
 class TestResolverHypotheses(TestCase):
 
@@ -1289,6 +2445,366 @@ class TestResolverSolrQueryCase(TestCase):
         solrquery = Querier()
         self.assertEqual(solrquery.query('author:("Accomazzi, A") AND year:"2019" AND bibstem:(AAS)'), None)
 
+    def test_latency_tracker(self):
+        """
+        test the percentiles of the latencies, and the timeout and hedging delay derived from them
+        """
+        tracker = LatencyTracker(window=100, min_samples=10)
+        for i in range(9):
+            tracker.record('solr', 0.01 * (i + 1))
+        self.assertEqual(tracker.percentile('solr', 99), None)
+        self.assertEqual(get_timeout(tracker, 'solr'), self.current_app.config['REFERENCE_SERVICE_SOLR_TIMEOUT'])
+        self.assertEqual(get_hedge_delay(tracker, 'solr'), None)
+        tracker.record('solr', 0.1)
+        self.assertEqual(tracker.percentile('solr', 50), 0.05)
+        self.assertEqual(tracker.percentile('solr', 99), 0.1)
+        self.assertEqual(get_hedge_delay(tracker, 'solr'), 0.1)
+        # at least the min timeout
+        self.assertEqual(get_timeout(tracker, 'solr'), self.current_app.config['REFERENCE_SERVICE_SOLR_MIN_TIMEOUT'])
+        # only the latest ones are kept
+        for i in range(100):
+            tracker.record('solr', 2)
+        self.assertEqual(tracker.percentile('solr', 50), 2)
+        self.assertEqual(get_timeout(tracker, 'solr'), 6)
+        tracker.record('slow solr', 30)
+        self.assertEqual(tracker.to_dict(), {'solr': {'count': 100, 'p50': 2000, 'p95': 2000, 'p99': 2000},
+                                             'slow solr': {'count': 1, 'p50': None, 'p95': None, 'p99': None}})
+
+    def get_from_threads(self, get_function, num_threads=8):
+        """
+        returns what get_function returns when called from num_threads threads at once
+
+        :param get_function:
+        :param num_threads:
+        :return:
+        """
+        results = []
+        def call():
+            with self.current_app.app_context():
+                results.append(get_function())
+        threads = [threading.Thread(target=call) for _ in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_latency_tracker_created_once(self):
+        """
+        test that the latency tracker and the hedging thread pool of the worker are created once,
+        when first used from several threads at once
+        """
+        slow_tracker = lambda *args: time.sleep(0.05) or LatencyTracker(*args)
+        with mock.patch('referencesrv.resolver.latency.LatencyTracker', side_effect=slow_tracker) as created:
+            trackers = self.get_from_threads(get_latency_tracker)
+        self.assertEqual(created.call_count, 1)
+        self.assertEqual(all(tracker is trackers[0] for tracker in trackers), True)
+        slow_executor = lambda **kwargs: time.sleep(0.05) or ThreadPoolExecutor(**kwargs)
+        with mock.patch('referencesrv.resolver.latency.ThreadPoolExecutor', side_effect=slow_executor) as created:
+            executors = self.get_from_threads(get_hedge_executor)
+        self.assertEqual(created.call_count, 1)
+        self.assertEqual(all(executor is executors[0] for executor in executors), True)
+        executors[0].shutdown()
+
+    def test_speculative_executor_created_once(self):
+        """
+        test that the thread pool of the speculative queries of the worker is created once, when first
+        used from several threads at once
+        """
+        slow_executor = lambda **kwargs: time.sleep(0.05) or ThreadPoolExecutor(**kwargs)
+        with mock.patch('referencesrv.resolver.speculative.ThreadPoolExecutor', side_effect=slow_executor) as created:
+            executors = self.get_from_threads(get_executor)
+        self.assertEqual(created.call_count, 1)
+        self.assertEqual(all(executor is executors[0] for executor in executors), True)
+        executors[0].shutdown()
+
+    def test_latency_aware_requests(self):
+        """
+        test the requests to a local solr injecting slow responses, that they are hedged, and time out
+        """
+        self.current_app.config.update({'REFERENCE_SERVICE_SOLR_LATENCY_MIN_SAMPLES': 10,
+                                        'REFERENCE_SERVICE_SOLR_MIN_TIMEOUT': 0.2,
+                                        'REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE': 90})
+        counters.reset()
+        delays = []
+        fake_solr = FakeSolr(lambda: delays.pop(0) if delays else 0.001).start()
+        try:
+            querier = Querier()
+            querier.connect_solr = True
+            querier.endpoint = fake_solr.url
+            params = querier.make_params('author:("Accomazzi, A") AND year:"2019" AND bibstem:(AAS)')
+            for i in range(10):
+                self.assertEqual(querier.send(params), get_test_data())
+            tracker = get_latency_tracker()
+            self.assertEqual(tracker.to_dict()[fake_solr.url]['count'], 10)
+            self.assertEqual(get_timeout(tracker, fake_solr.url), 0.2)
+
+            # the slow response is not waited for, a second request is sent and answered first
+            delays.append(1)
+            start_time = time.time()
+            self.assertEqual(querier.send(params), get_test_data())
+            self.assertEqual(time.time() - start_time < 0.5, True)
+            self.assertEqual(fake_solr.num_requests, 12)
+            self.assertEqual(counters.get('solr_hedged_requests'), 1)
+            self.assertEqual(counters.get('solr_hedged_requests_won'), 1)
+            # the first request times out in the background, and its timeout is kept as a latency
+            for i in range(100):
+                if tracker.to_dict()[fake_solr.url]['count'] == 12:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(tracker.to_dict()[fake_solr.url]['count'], 12)
+            self.assertEqual(round(get_timeout(tracker, fake_solr.url), 1), 0.6)
+
+            # not hedged, the slow response times out
+            self.current_app.config['REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE'] = None
+            delays.append(2)
+            start_time = time.time()
+            with self.assertRaises(SolrTimeout):
+                querier.send(params)
+            self.assertEqual(time.time() - start_time < 1, True)
+            self.assertEqual(counters.get('solr_timeouts'), 1)
+            self.assertEqual(tracker.to_dict()[fake_solr.url]['count'], 13)
+        finally:
+            fake_solr.stop()
+
+    def test_circuit_breaker(self):
+        """
+        test that the breaker opens on failed and slow requests, lets probes through after a while, and closes
+        """
+        breaker = CircuitBreaker(window=4, min_requests=4, failure_rate=0.5, slow_seconds=1, open_seconds=0.05, num_probes=2)
+        for succeeded, seconds in [(True, 0.1), (False, 0.1), (True, 0.1)]:
+            breaker.record(succeeded, seconds)
+        self.assertEqual(breaker.allow(), True)
+        # slow counts as failed
+        breaker.record(True, 2)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertEqual(breaker.is_open(), True)
+        self.assertEqual(breaker.allow(), False)
+        time.sleep(0.06)
+        self.assertEqual(breaker.is_open(), False)
+        # two probes, and the requests after them are held back until they return
+        self.assertEqual([breaker.allow() for _ in range(3)], [True, True, False])
+        self.assertEqual(breaker.state, HALF_OPEN)
+        breaker.record(True, 0.1)
+        breaker.record(False, 0.1)
+        self.assertEqual(breaker.state, OPEN)
+        time.sleep(0.06)
+        self.assertEqual([breaker.allow() for _ in range(3)], [True, True, False])
+        breaker.record(True, 0.1)
+        breaker.record(True, 0.1)
+        self.assertEqual(breaker.state, CLOSED)
+        self.assertEqual(breaker.to_dict(), {'state': CLOSED, 'requests': 0, 'failure_rate': 0.0})
+
+    def test_circuit_breaker_created_once(self):
+        """
+        test that the circuit breaker of the worker is created once, when first used from several threads at once
+        """
+        slow_breaker = lambda *args: time.sleep(0.05) or CircuitBreaker(*args)
+        with mock.patch('referencesrv.resolver.circuitbreaker.CircuitBreaker', side_effect=slow_breaker) as created:
+            breakers = self.get_from_threads(get_circuit_breaker)
+        self.assertEqual(created.call_count, 1)
+        self.assertEqual(all(breaker is breakers[0] for breaker in breakers), True)
+
+    def test_circuit_breaker_requests(self):
+        """
+        test that the requests to a local solr injecting slow responses open the breaker, and that while
+        it is open the references are answered right away without querying solr
+        """
+        self.current_app.config.update({'REFERENCE_SERVICE_SOLR_BREAKER_MIN_REQUESTS': 3,
+                                        'REFERENCE_SERVICE_SOLR_BREAKER_SLOW_SECONDS': 0.05,
+                                        'REFERENCE_SERVICE_SOLR_HEDGE_PERCENTILE': None})
+        counters.reset()
+        fake_solr = FakeSolr(lambda: 0.1).start()
+        try:
+            querier = Querier()
+            querier.connect_solr = True
+            querier.endpoint = fake_solr.url
+            params = querier.make_params('author:("Accomazzi, A") AND year:"2019" AND bibstem:(AAS)')
+            for i in range(3):
+                self.assertEqual(querier.send(params), get_test_data())
+            self.assertEqual(get_circuit_breaker().is_open(), True)
+            with self.assertRaises(SolrUnavailable):
+                querier.send(params)
+            self.assertEqual(fake_solr.num_requests, 3)
+            self.assertEqual(counters.get('solr_circuit_rejections'), 1)
+
+            start_time = time.time()
+            r = self.client.get('/text/Accomazzi, A. 2019, AAS, 233, 207.04', headers={'Accept': 'application/json'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(time.time() - start_time < 0.1, True)
+            resolved = json.loads(r.data)['resolved']
+            self.assertEqual(resolved['score'], '0.0')
+            self.assertEqual(resolved['comment'].startswith('SolrUnavailable'), True)
+            self.assertEqual(fake_solr.num_requests, 3)
+            self.assertEqual(counters.get('degraded_references'), 1)
+            r = self.client.get('/metrics')
+            self.assertEqual(json.loads(r.data)['solr_circuit']['state'], OPEN)
+        finally:
+            fake_solr.stop()
+
+
+class TestModelStore(TestCase):
+    """
+    test building versioned models in the background and swapping them in
+    """
+    def create_app(self):
+        self.current_app = app.create_app(**{
+            'REFERENCE_SERVICE_LIVE': False,
+            'REFERENCE_SERVICE_MODEL_CHECK_INTERVAL': 0,
+           })
+        return self.current_app
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.tmp_dir, 'input.dat')
+        with open(self.input_file, 'w') as f:
+            f.write('first input\n')
+        self.num_builds = 0
+
+        def create_function(filename):
+            self.num_builds += 1
+            with open(filename, 'w') as f:
+                f.write(open(self.input_file).read())
+            return True
+
+        def load_function(filename):
+            try:
+                return open(filename).read()
+            except IOError:
+                return None
+
+        self.artifact = ModelArtifact('test_model', os.path.join(self.tmp_dir, 'model.pkl'), [self.input_file],
+                                      create_function, load_function)
+        self.saved_artifacts = modelstore.MODEL_ARTIFACTS
+        modelstore.MODEL_ARTIFACTS = {'test_model': self.artifact}
+
+    def tearDown(self):
+        modelstore.MODEL_ARTIFACTS = self.saved_artifacts
+        build_jobs.pop('test_model', None)
+        loader_threads.pop('test_model', None)
+        shutil.rmtree(self.tmp_dir)
+
+    def wait_for(self, thread_or_job):
+        for i in range(100):
+            if not (thread_or_job.is_alive() if hasattr(thread_or_job, 'is_alive') else thread_or_job.is_running()):
+                return
+            time.sleep(0.05)
+
+    def test_artifact_versions(self):
+        """
+        test version naming, the pointer file, and removing the old versions
+        """
+        self.assertEqual(self.artifact.get_latest_version(), None)
+        self.assertEqual(self.artifact.get_filename(None), os.path.join(self.tmp_dir, 'model.pkl'))
+        self.assertEqual(self.artifact.get_filename('abc'), os.path.join(self.tmp_dir, 'model-abc.pkl'))
+        version = self.artifact.compute_version()
+        self.assertEqual(version, self.artifact.compute_version())
+        for i, v in enumerate(['v1', 'v2', 'v3', 'v4']):
+            with open(self.artifact.get_filename(v), 'w') as f:
+                f.write(v)
+            os.utime(self.artifact.get_filename(v), (i, i))
+            self.artifact.publish(v)
+            self.assertEqual(self.artifact.get_latest_version(), v)
+        # only the configured number of versions are kept
+        self.assertEqual(os.path.exists(self.artifact.get_filename('v1')), False)
+        self.assertEqual(all([os.path.exists(self.artifact.get_filename(v)) for v in ['v2', 'v3', 'v4']]), True)
+
+    def test_build_and_swap(self):
+        """
+        test that a build is run in the background only once per version, and the new version is swapped in
+        """
+        job = start_build('test_model')
+        self.wait_for(job)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(self.num_builds, 1)
+        self.assertEqual(self.artifact.get_latest_version(), job.version)
+
+        # building the same inputs again is a no-op
+        job_again = start_build('test_model')
+        self.assertEqual(job_again.stage, 'already built')
+        self.assertEqual(self.num_builds, 1)
+
+        # worker picks up the published version
+        self.assertEqual(get_status()['test_model']['active_version'], None)
+        check_model_versions()
+        self.wait_for(loader_threads['test_model'])
+        self.assertEqual(self.current_app.extensions['test_model'], 'first input\n')
+        self.assertEqual(get_status()['test_model']['active_version'], job.version)
+
+        # new inputs, new version
+        with open(self.input_file, 'w') as f:
+            f.write('second input\n')
+        job = start_build('test_model')
+        self.wait_for(job)
+        self.assertNotEqual(job.version, job_again.version)
+        check_model_versions()
+        self.wait_for(loader_threads['test_model'])
+        self.assertEqual(self.current_app.extensions['test_model'], 'second input\n')
+        status = get_status()['test_model']
+        self.assertEqual(status['active_version'], status['latest_version'])
+        self.assertEqual(status['build_job']['state'], 'done')
+
+    def test_build_failure(self):
+        """
+        test that a failed build does not publish a version
+        """
+        self.artifact.create_function = lambda filename: None
+        job = start_build('test_model')
+        self.wait_for(job)
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(self.artifact.get_latest_version(), None)
+
+    def test_source_matcher_delta(self):
+        """
+        test that a delta is published as a version of the one it is applied on, that it is kept
+        when the same input files are built again, and that it is not applied during a build
+        """
+        def update_source_matcher(source_matcher, source_lines, filename):
+            with open(filename, 'w') as f:
+                f.write(source_matcher + ''.join(source_lines))
+            return len(source_lines), 0
+
+        modelstore.MODEL_ARTIFACTS['source_matcher'] = self.artifact
+        try:
+            with mock.patch.object(modelstore, 'update_source_matcher', update_source_matcher):
+                job = start_build('source_matcher')
+                self.wait_for(job)
+                built_version = job.version
+                self.assertEqual(apply_source_matcher_delta(['first delta\n']), (1, 0))
+                delta_version = self.artifact.get_latest_version()
+                self.assertEqual(self.artifact.get_base_version(delta_version), built_version)
+                self.assertEqual(self.artifact.load_function(self.artifact.get_filename(delta_version)), 'first input\nfirst delta\n')
+                self.assertEqual(get_status()['source_matcher']['active_version'], delta_version)
+
+                # the same input files are not built again, the delta is kept
+                job = start_build('source_matcher')
+                self.assertEqual(job.version, delta_version)
+                self.assertEqual(job.stage, 'already built, with deltas applied')
+                self.assertEqual(self.num_builds, 1)
+
+                # each delta is applied to the version the one before published
+                apply_source_matcher_delta(['second delta\n'])
+                self.assertEqual(self.artifact.load_function(self.artifact.get_filename(self.artifact.get_latest_version())),
+                                 'first input\nfirst delta\nsecond delta\n')
+                self.assertEqual(self.artifact.get_base_version(self.artifact.get_latest_version()), built_version)
+
+                # no delta while the source matcher is being built
+                build_jobs['source_matcher'] = BuildJob(self.artifact, 'building')
+                with self.assertRaises(Exception) as context:
+                    apply_source_matcher_delta(['third delta\n'])
+                self.assertTrue('is being built' in str(context.exception))
+                build_jobs.pop('source_matcher')
+
+                # new input files are built without the deltas, and the job says so
+                with open(self.input_file, 'w') as f:
+                    f.write('second input\n')
+                job = start_build('source_matcher')
+                self.wait_for(job)
+                self.assertEqual(job.state, 'done')
+                self.assertTrue('are not in version %s' % job.version in job.to_dict()['warning'])
+                self.assertEqual(self.artifact.get_latest_version(), self.artifact.compute_version())
+        finally:
+            build_jobs.pop('source_matcher', None)
 
 
 if __name__ == "__main__":
@@ -12,11 +12,20 @@ import urllib.request, urllib.parse, urllib.error
 import regex as re
 import time
 
-from referencesrv.parser.crf import CRFClassifierText, create_text_model, load_text_model
+from referencesrv.parser.crf import CRFClassifierText
 from referencesrv.resolver.solve import solve_reference
+from referencesrv.resolver.batch import plan_first_round
 from referencesrv.resolver.hypotheses import Hypotheses
-from referencesrv.resolver.sourcematchers import create_source_matcher, load_source_matcher
-from referencesrv.resolver.common import NoSolution, Incomplete
+from referencesrv.resolver.common import NoSolution, Incomplete, SolrUnavailable
+from referencesrv.modelstore import load_models, check_model_versions, start_build, apply_source_matcher_delta, \
+    get_status
+from referencesrv.metrics import counters, hypothesis_counters, get_memo_counters
+from referencesrv.resolver.authors import get_authors, normalize_author_list, normalize_single_author, \
+    transliterate_author
+from referencesrv.resolver.solve import make_solr_condition_author
+from referencesrv.resolver.ordering import hypothesis_stats
+from referencesrv.resolver.latency import get_latency_tracker
+from referencesrv.resolver.circuitbreaker import get_circuit_breaker
 
 
 bp = Blueprint('reference_service', __name__)
@@ -24,6 +33,10 @@ redis_db = FlaskRedis()
 
 RE_NUMERIC_VALUE = re.compile(r'\d')
 
+# comment of the references not resolved because solr is not available
+SOLR_UNAVAILABLE_COMMENT = 'SolrUnavailable: only the references in the cache are resolved for now, ' \
+                           'the references can still be parsed with /parse.'
+
 # @bp.before_app_first_request
 def text_model():
     """
@@ -33,11 +46,21 @@ def text_model():
     # start_time = time.time()
     # load only if in production mode
     if current_app.config['REFERENCE_SERVICE_LIVE']:
-        current_app.extensions['text_crf'] = load_text_model()
-        current_app.extensions['source_matcher'] = load_source_matcher()
+        load_models()
     # current_app.logger.debug("Loading neccesary pickels in {duration} ms".format(duration=(time.time() - start_time) * 1000))
 
 
+@bp.before_app_request
+def refresh_models():
+    """
+    pick up newer versions of the models, if any has been published since last checked
+
+    :return:
+    """
+    if current_app.config['REFERENCE_SERVICE_LIVE']:
+        check_model_versions()
+
+
 def text_parser(reference):
     """
 
@@ -137,6 +160,34 @@ def format_resolved_reference(returned_format, resolved, reference, id, cache=Tr
     return result
 
 
+def solr_admitted():
+    """
+    admission control, while the circuit breaker around solr is open the references are answered
+    right away from the cache only, instead of waiting on solr
+
+    :return: False if solr is not to be queried
+    """
+    return not get_circuit_breaker().is_open()
+
+
+def format_unavailable_reference(returned_format, reference, id):
+    """
+    returns the reference not resolved because solr is not available, that is not cached
+
+    :param returned_format:
+    :param reference:
+    :param id:
+    :return:
+    """
+    counters.increment('degraded_references')
+    return format_resolved_reference(returned_format,
+                                     resolved='0.0 %s' % (19 * '.'),
+                                     reference=reference,
+                                     id=id,
+                                     cache=False,
+                                     comment=SOLR_UNAVAILABLE_COMMENT)
+
+
 def check_number_references(references, reference_type):
     """
     truncate number of references if more than what is allowed for one processing call
@@ -158,11 +209,38 @@ def check_number_references(references, reference_type):
     return references, truncated_message
 
 
-def text_resolve(reference, returned_format, id):
+def text_plan(references):
+    """
+    parses the references that are not cached, and queries solr for the first round of hypotheses
+    of all of them at once
+
+    :param references:
+    :return: list of Hypotheses of the references parsed here, and list of their candidate pools,
+             None for the references left to text_resolve
+    """
+    hypotheses = [None] * len(references)
+    if not current_app.config['REFERENCE_SERVICE_BATCH_FIRST_ROUND'] or len(references) < 2 or not solr_admitted():
+        return hypotheses, [None] * len(references)
+    for i, reference in enumerate(references):
+        if not bool(RE_NUMERIC_VALUE.search(reference)) or cache_resolved_get(reference):
+            continue
+        try:
+            parsed_ref = text_parser(reference)
+            if parsed_ref:
+                hypotheses[i] = Hypotheses(parsed_ref)
+        except Exception as e:
+            # text_resolve is going to try again and report the error
+            current_app.logger.error('Exception: {error}'.format(error=str(e)))
+    return hypotheses, plan_first_round(hypotheses)
+
+
+def text_resolve(reference, returned_format, id, hypotheses=None, candidate_pool=None):
     """
 
     :param reference:
     :param returned_format:
+    :param hypotheses: Hypotheses of the reference if parsed already
+    :param candidate_pool: candidate pool of the reference, if seeded already
     :return:
     """
     not_resolved = '0.0 %s' % (19 * '.')
@@ -173,12 +251,17 @@ def text_resolve(reference, returned_format, id):
                                              resolved=resolved,
                                              reference=reference,
                                              id=id)
+        if not solr_admitted():
+            return format_unavailable_reference(returned_format, reference, id)
 
         if bool(RE_NUMERIC_VALUE.search(reference)):
-            parsed_ref = text_parser(reference)
-            if parsed_ref:
+            if hypotheses is None:
+                parsed_ref = text_parser(reference)
+                if parsed_ref:
+                    hypotheses = Hypotheses(parsed_ref)
+            if hypotheses is not None:
                 return format_resolved_reference(returned_format,
-                                                 resolved=str(solve_reference(Hypotheses(parsed_ref))),
+                                                 resolved=str(solve_reference(hypotheses, candidate_pool)),
                                                  reference=reference,
                                                  id=id)
             error_comment = 'NoSolution: unable to parse'
@@ -204,6 +287,9 @@ def text_resolve(reference, returned_format, id):
                                          reference=reference,
                                          id=id,
                                          comment=error_comment)
+    except SolrUnavailable:
+        # the circuit breaker opened while resolving the reference
+        return format_unavailable_reference(returned_format, reference, id)
     except Exception as e:
         error_comment = 'Exception: {error}'.format(error=str(e))
         current_app.logger.error(error_comment)
@@ -221,6 +307,15 @@ def xml_resolve(parsed_reference, returned_format):
     :return:
     """
     not_resolved = '0.0 %s' % (19 * '.')
+    if not solr_admitted():
+        reference_str = parsed_reference.get('refstr', None) or parsed_reference.get('refplaintext', None)
+        resolved = cache_resolved_get(reference_str) if reference_str else None
+        if resolved:
+            return format_resolved_reference(returned_format,
+                                             resolved=resolved,
+                                             reference=reference_str,
+                                             id=parsed_reference.get('id', None))
+        return format_unavailable_reference(returned_format, reference_str, parsed_reference.get('id', None))
     try:
         resolved = str(solve_reference(Hypotheses(parsed_reference)))
         if resolved.startswith('0.0'):
@@ -230,6 +325,10 @@ def xml_resolve(parsed_reference, returned_format):
                                          resolved=resolved,
                                          reference=reference_str,
                                          id=parsed_reference.get('id', None))
+    except SolrUnavailable:
+        return format_unavailable_reference(returned_format,
+                                            parsed_reference.get('refstr', None) or parsed_reference.get('refplaintext', None),
+                                            parsed_reference.get('id', None))
     except Exception as e:
         error_comment = 'Exception: {error}'.format(error=str(e))
         current_app.logger.error('Exception: {error}'.format(error=str(e)))
@@ -254,6 +353,8 @@ def xml_resolve(parsed_reference, returned_format):
                                                      id=parsed_reference.get('id', None),
                                                      comment=error_comment)
 
+                except SolrUnavailable:
+                    return format_unavailable_reference(returned_format, reference_str, parsed_reference.get('id', None))
                 except (NoSolution, Incomplete, ValueError) as e:
                     error_comment = 'Exception: {error}'.format(error=str(e))
                     current_app.logger.error(error_comment)
@@ -329,9 +430,10 @@ def text_post():
         ids = [None]*len(references)
 
     # start_time = time.time()
+    hypotheses, candidate_pools = text_plan(references)
     results = []
-    for reference, id in zip(references, ids):
-        results.append(text_resolve(reference, returned_format, id))
+    for reference, id, ref_hypotheses, candidate_pool in zip(references, ids, hypotheses, candidate_pools):
+        results.append(text_resolve(reference, returned_format, id, ref_hypotheses, candidate_pool))
     # current_app.logger.debug("POST request with {num} reference(s) processed in {duration} ms".format(num=len(references), duration=(time.time() - start_time) * 1000))
 
     if returned_format == 'application/json':
@@ -387,18 +489,75 @@ def xml_post():
     return return_response(response, 200, 'application/text; charset=UTF8')
 
 
+@advertise(scopes=[], rate_limit=[1000, 3600 * 24])
+@bp.route('/bibstem', methods=['POST'])
+def bibstem_post():
+    """
+    endpoint returning the bibstem candidates, best first, with their scores, for a list of journal strings
+
+    :return:
+    """
+    try:
+        payload = request.get_json(force=True)  # post data in json
+    except:
+        payload = dict(request.form)  # post data in form encoding
+
+    if not payload:
+        return {'error': 'no information received'}, 400
+    if 'pub' not in payload:
+        return {'error': 'no journal string found in payload (parameter name is `pub`)'}, 400
+
+    pubs = payload['pub']
+    if not isinstance(pubs, list):
+        pubs = [pubs]
+    if not all(isinstance(pub, str) for pub in pubs):
+        return {'error': 'journal strings must be strings (parameter name is `pub`)'}, 400
+    max_num_pubs = current_app.config['REFERENCE_SERVICE_MAX_BIBSTEM_QUERIES']
+    truncated_message = None
+    if len(pubs) > max_num_pubs:
+        current_app.logger.error('received {num_pubs} journal strings, maximum number of journal strings that can be matched in one call is {max_num_pubs} which shall be matched'.format(
+            num_pubs=len(pubs), max_num_pubs=max_num_pubs))
+        pubs = pubs[:max_num_pubs]
+        truncated_message = 'Matched maximum number of journal strings allowed {max_num_pubs}.'.format(max_num_pubs=max_num_pubs)
+
+    current_app.logger.info('received POST request with {count} journal strings to match to bibstems'.format(count=len(pubs)))
+
+    source_matcher = current_app.extensions.get('source_matcher', None)
+    if not source_matcher:
+        return return_response({'error': 'source matcher is not loaded'}, 400, 'application/json; charset=UTF8')
+
+    num_candidates = current_app.config['REFERENCE_SERVICE_NUM_BIBSTEM_CANDIDATES']
+    results = []
+    for pub, matches in zip(pubs, source_matcher.bestmatches_many(pubs, num_candidates)):
+        # matches are sorted ascending, and a bibstem can come from multiple expansions, keep its best score
+        candidates = []
+        for score, bibstem in reversed(matches):
+            if bibstem not in [candidate['bibstem'] for candidate in candidates]:
+                candidates.append({'bibstem': bibstem, 'score': round(score, 3)})
+        results.append({'pub': pub, 'candidates': candidates[:num_candidates]})
+
+    response = {'bibstems': results}
+    if truncated_message:
+        response['message'] = truncated_message
+    return return_response(response, 200, 'application/json; charset=UTF8')
+
+
 @advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
 @bp.route('/pickle_crf', methods=['PUT'])
 def pickle_crf():
     """
     endpoint to be called locally only whenever the models (either text or xml) has been changed
 
+    the model is trained in the background, see /model_status for the progress,
+    once done all the workers pick it up without a restart
+
     :return:
     """
     # to save a new text model
-    create_text_model()
+    job = start_build('text_crf')
 
-    return return_response({'OK': 'objects saved'}, 200, 'text/plain; charset=UTF8')
+    return return_response({'OK': 'text model version {version} {state}'.format(
+        version=job.version, state=job.stage or job.state)}, 200, 'text/plain; charset=UTF8')
 
 
 @advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
@@ -407,16 +566,91 @@ def pickle_source_matcher():
     """
     endpoint to be called locally only whenever the files of source matcher has been updated
 
+    the source matcher is built in the background, see /model_status for the progress,
+    once done all the workers pick it up without a restart
+
     :return:
     """
     try:
         # to save a new source matcher()
-        create_source_matcher()
-        return return_response({'OK': 'objects saved'}, 200, 'text/plain; charset=UTF8')
+        job = start_build('source_matcher')
+        return return_response({'OK': 'source matcher version {version} {state}'.format(
+            version=job.version, state=job.stage or job.state)}, 200, 'text/plain; charset=UTF8')
     except Exception as e:
         return return_response({'Error: %s'%str(e)}, 400, 'text/plain; charset=UTF8')
 
 
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/delta_source_matcher', methods=['PUT'])
+def delta_source_matcher():
+    """
+    endpoint to be called locally only to apply a delta file (ie, new_abbrev.dat) to the live source matcher,
+    and save it, without rebuilding it from all the files of source matcher
+
+    the content of the delta file is sent as the body of the request, it is applied to a copy
+    of the source matcher that is then published as a new version
+
+    :return:
+    """
+    if not current_app.extensions.get('source_matcher', None):
+        return return_response({'Error': 'source matcher is not loaded'}, 400, 'text/plain; charset=UTF8')
+
+    delta = request.get_data(as_text=True)
+    if not delta:
+        return return_response({'Error': 'no delta received'}, 400, 'text/plain; charset=UTF8')
+
+    try:
+        num_added, num_removed = apply_source_matcher_delta(delta.splitlines(True))
+        return return_response({'OK': 'delta applied, {added} entries added and {removed} entries removed'.format(
+            added=num_added, removed=num_removed)}, 200, 'text/plain; charset=UTF8')
+    except Exception as e:
+        return return_response({'Error': 'Error: %s'%str(e)}, 400, 'text/plain; charset=UTF8')
+
+
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/model_status', methods=['GET'])
+def model_status():
+    """
+    endpoint reporting the versions of the models active in this worker, the latest versions published,
+    and the progress of the build jobs started from this worker
+
+    :return:
+    """
+    return return_response(get_status(), 200, 'application/json; charset=UTF8')
+
+
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    endpoint reporting the counters of this worker, ie, the number of solr queries sent, the ones sent
+    ahead of time that were used and wasted, the ones answered from the documents of earlier queries,
+    for each hypothesis, the queries sent and how many of them overflowed, the hits and misses
+    of the memos of the author normalizations, the percentiles of the latencies of solr, and the state
+    of the circuit breaker around it
+
+    :return:
+    """
+    memos = get_memo_counters([get_authors, normalize_author_list, make_solr_condition_author,
+                               normalize_single_author, transliterate_author])
+    return return_response(dict(counters.to_dict(), hypotheses=hypothesis_counters.to_dict(), memos=memos,
+                                solr_latency=get_latency_tracker().to_dict(),
+                                solr_circuit=get_circuit_breaker().to_dict()), 200,
+                           'application/json; charset=UTF8')
+
+
+@advertise(scopes=['ads:reference-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/hypothesis_stats', methods=['GET'])
+def hypothesis_statistics():
+    """
+    endpoint reporting, for each shape of reference, the number of references each hypothesis resolved
+    in this worker, and the solr queries it took
+
+    :return:
+    """
+    return return_response(hypothesis_stats.to_dict(), 200, 'application/json; charset=UTF8')
+
+
 @advertise(scopes=[], rate_limit=[1000, 3600 * 24])
 @bp.route('/parse', methods=['POST'])
 def parse_text():
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import sys, os, io
 import requests
+import argparse
 
 """
 source matcher files and locations
@@ -22,10 +24,27 @@ this file got deprecated in August 2020
 this file is not being used in source matcher
 the three entries have been added to journals_not_ADS.dat included in source matcher here
 -rw-r--r--  1 gshapurian  staff      64 Jan 18  2011 /proj/ads_references/etc/notinADS.dat
+
+to add (or remove) only a few entries, without rebuilding the source matcher from all the files,
+send a delta file, in the same format as the files above (ie, new_abbrev.dat), with -d option,
+prefix the lines of entries to be removed with a `-`
+
+the source matcher is rebuilt in the background, and picked up by the running service once done,
+GET http://localhost:5000/model_status reports the progress and the active version
 """
 
 
-url = "http://localhost:5000/pickle_source_matcher"
-r = requests.put(url)
-print('code=',r.status_code,'reason=',r.reason)
-print(r.text)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rebuild source matcher, or apply a delta file to it')
+    parser.add_argument('-d', '--delta', help='the path to delta file containing entries to be added/removed to/from source matcher.')
+    args = parser.parse_args()
+    if args.delta:
+        url = "http://localhost:5000/delta_source_matcher"
+        with io.open(os.path.join(os.getcwd(), args.delta), 'r', encoding='ISO-8859-1') as f:
+            r = requests.put(url, data=f.read().encode('utf-8'))
+    else:
+        url = "http://localhost:5000/pickle_source_matcher"
+        r = requests.put(url)
+    print('code=',r.status_code,'reason=',r.reason)
+    print(r.text)
+    sys.exit(0)